@@ -0,0 +1,58 @@
+'''
+Single-pass FeaturePlan vs. the original one-query-per-group get_all_features, and the same plan run over the
+daily rollup (cube.DailyCube).
+
+Generates synthetic transactions / customers in DuckDB (see synthetic.py, no Kaggle download needed) and times both
+approaches.
+
+    python benchmarks/bench_feature_plan.py --rows 5000000 --customers 500000
+'''
+import argparse
+import os
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../pipeline')))
+
+from cube import DailyCube
+from features import Features, QueryConstants
+from synthetic import make_synthetic_db
+
+
+def time_it(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--customers", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    conn = make_synthetic_db(args.rows, args.customers)
+    constants = QueryConstants(end_date=date(2020, 9, 22), response_duration=28, additional_offest=28)
+    features = Features(constants)
+    cube_features = Features(constants, use_daily_cube=True)
+
+    separate = time_it(lambda: features.get_all_features(conn, single_pass=False), args.repeat)
+    single = time_it(lambda: features.get_all_features(conn), args.repeat)
+    cube_build = time_it(lambda: DailyCube.build(conn), 1)
+    cube = time_it(lambda: cube_features.get_all_features(conn), args.repeat)
+
+    print(f"rows={args.rows:,} customers={args.customers:,} (best of {args.repeat})")
+    print(f"separate queries + joins: {separate:.3f}s")
+    print(f"single pass FeaturePlan:  {single:.3f}s")
+    print(f"speedup:                  {separate / single:.2f}x")
+    print(f"daily cube build (once):  {cube_build:.3f}s")
+    print(f"single pass on cube:      {cube:.3f}s ({separate / cube:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
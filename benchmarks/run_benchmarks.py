@@ -0,0 +1,252 @@
+'''
+Benchmark suite: data load, every Features.get_* group, get_all_features_and_response (row level and daily cube),
+evaluation and batch scoring on synthetic H&M shaped data (see synthetic.py).
+
+Each run appends one JSON line per benchmark to the results file, tagged with the run id, git commit, scale and
+library versions, so runs can be compared over time:
+
+    python benchmarks/run_benchmarks.py --scale 1m
+    python benchmarks/run_benchmarks.py --scale 10m --repeat 3 --only features
+    python benchmarks/run_benchmarks.py --scale 10m --compare          # latest run vs the one before, same scale
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime
+
+import duckdb
+import numpy as np
+import polars as pl
+import polars.selectors as cs
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../pipeline')))
+
+from articles import ArticleDimension
+from cube import DailyCube
+from evaluate import Evaluator
+from features import Features, QueryConstants
+from frames import to_float32_matrix
+from scoring import BatchScorer
+from synthetic import SCALES, make_synthetic_db, scale_rows, write_csv
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "results.jsonl")
+END_DATE = date(2020, 9, 22)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_rows(result):
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], str):
+        result = result[1]
+    return result.height if isinstance(result, pl.DataFrame) else None
+
+
+def time_benchmark(fn, repeat: int, setup=None) -> dict:
+    '''
+    :param fn: the work being timed
+    :param setup: untimed, run before every repeat (e.g. dropping what the previous repeat built)
+    '''
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - started)
+    return {"best_seconds": min(seconds), "median_seconds": statistics.median(seconds), "repeat": repeat,
+            "result_rows": result_rows(result)}
+
+
+def load_benchmarks(conn, work_dir: str) -> list:
+    try:
+        from dataset import CSVDataset
+    except ImportError as e:
+        print(f"Skipping the load benchmarks, dataset.py can't be imported: {e}")
+        return []
+
+    csv_dir = os.path.join(work_dir, "csv") + os.sep
+    files = write_csv(conn, csv_dir)
+    parquet_dir = os.path.join(work_dir, "parquet")
+
+    def load(parquet_path=None):
+        dataset = CSVDataset(csv_dir, files, parquet_path=parquet_path)
+        dataset.load()
+        dataset.duckdb_conn.close()
+
+    return [
+        ("load_csv", lambda: load(), None),
+        ("load_parquet_convert", lambda: load(parquet_dir), lambda: shutil.rmtree(parquet_dir, ignore_errors=True)),
+        # the conversion above left the Parquet files behind, so this one only checks fingerprints
+        ("load_parquet_cached", lambda: load(parquet_dir), None),
+    ]
+
+
+def feature_benchmarks(conn) -> list:
+    constants = QueryConstants(END_DATE, response_duration=28)
+    features = Features(constants)
+    extended = Features(constants, season_features=True, product_features=True)
+    cube_features = Features(constants, use_daily_cube=True)
+
+    def drop_cube():
+        conn.execute(f"DROP TABLE IF EXISTS {DailyCube.META_TABLE}")
+
+    def drop_article_dimension():
+        conn.execute(f"DROP TABLE IF EXISTS {ArticleDimension.META_TABLE}")
+
+    benchmarks = [
+        ("features.base_features", lambda: features.get_base_features(conn), None),
+        ("features.customer_features", lambda: features.get_customer_features(conn), None),
+        ("features.time_sliced_months", lambda: features.get_time_sliced_months(conn), None),
+        ("features.season_features", lambda: extended.get_season_features(conn), None),
+        ("features.article_dimension", lambda: ArticleDimension.ensure(conn, extended.feature_end),
+         drop_article_dimension),
+        ("features.product_features", lambda: extended.get_product_features(conn), None),
+        ("features.label", lambda: features.get_response_label(conn), None),
+    ]
+    for channel in (0, 1, 2):
+        benchmarks += [
+            (f"features.time_sliced_overlap_{channel}", lambda c=channel: features.get_time_sliced_overlap(conn, c), None),
+            (f"features.time_sliced_no_overlap_{channel}",
+             lambda c=channel: features.get_time_sliced_no_overlap(conn, c), None),
+        ]
+    benchmarks += [
+        ("features_and_response", lambda: features.get_all_features_and_response(conn), None),
+        ("features_and_response.label_join",
+         lambda: features.get_all_features_and_response(conn, single_pass=False), None),
+        ("features_and_response.separate_queries", lambda: features.get_all_features(conn, single_pass=False), None),
+        ("features_and_response.product_season", lambda: extended.get_all_features_and_response(conn), None),
+        ("daily_cube.build", lambda: DailyCube.ensure(conn), drop_cube),
+        ("features_and_response.daily_cube", lambda: cube_features.get_all_features_and_response(conn), None),
+    ]
+    return benchmarks
+
+
+def model_benchmarks(conn, work_dir: str) -> list:
+    from sklearn.tree import DecisionTreeClassifier
+
+    # a quick model on the numeric features, so evaluation and scoring have realistic scores to work with
+    features = Features(QueryConstants(END_DATE, response_duration=28))
+    df = features.get_all_features_and_response(conn)
+    numeric = df.select(cs.numeric().exclude("label")).columns
+    X = to_float32_matrix(df, numeric)
+    y = df["label"].to_numpy()
+    model = DecisionTreeClassifier(max_depth=8, min_samples_leaf=100, random_state=0).fit(X, y)
+    scores = model.predict_proba(X)[:, 1]
+
+    scoring_sql = "SELECT customer_id, {columns} FROM ({plan})".format(
+        columns=", ".join(f"CAST({name} AS DOUBLE) AS {name}" for name in numeric),
+        plan=features.get_feature_plan().compile())
+    scorer = BatchScorer(None, model, batch_size=100_000)
+    output_path = os.path.join(work_dir, "scores.parquet")
+
+    return [
+        ("evaluate", lambda: Evaluator(y, scores), None),
+        ("score", lambda: scorer.score_query(conn, scoring_sql, output_path), None),
+    ]
+
+
+def run(scale: str, repeat: int, only: str, results_path: str, work_dir: str, threads: int) -> pl.DataFrame:
+    rows = scale_rows(scale)
+    run_info = {"run_id": uuid.uuid4().hex[:12], "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "commit": git_commit(), "scale": scale, "rows": rows, "cpu_count": os.cpu_count(),
+                "threads": threads, "python": platform.python_version(), "duckdb": duckdb.__version__,
+                "polars": pl.__version__, "numpy": np.__version__, "platform": platform.platform()}
+
+    started = time.perf_counter()
+    conn = make_synthetic_db(rows)
+    if threads:
+        conn.execute(f"SET threads = {threads}")
+    generate_seconds = time.perf_counter() - started
+    print(f"Generated {rows:,} transactions in {generate_seconds:.1f}s")
+
+    work_dir = tempfile.mkdtemp(prefix="ptb_bench_", dir=work_dir)
+    try:
+        def wanted(*prefixes):
+            # a group is only set up (CSV files written, model fitted) when --only can match one of its names
+            return not only or any(prefix.startswith(only) or only.startswith(prefix) for prefix in prefixes)
+
+        benchmarks = [("generate", None, None)]
+        if wanted("load_"):
+            benchmarks += load_benchmarks(conn, work_dir)
+        if wanted("features", "daily_cube"):
+            benchmarks += feature_benchmarks(conn)
+        if wanted("evaluate", "score"):
+            benchmarks += model_benchmarks(conn, work_dir)
+        results = []
+        os.makedirs(os.path.dirname(results_path), exist_ok=True)
+        for name, fn, setup in benchmarks:
+            if only and not name.startswith(only):
+                continue
+            if name == "generate":
+                timing = {"best_seconds": generate_seconds, "median_seconds": generate_seconds, "repeat": 1,
+                          "result_rows": rows}
+            else:
+                timing = time_benchmark(fn, repeat, setup)
+            record = {**run_info, "benchmark": name, **timing}
+            results.append(record)
+            with open(results_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            print(f"{name:45s} {timing['best_seconds']:8.3f}s")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        conn.close()
+    return pl.DataFrame(results)
+
+
+def compare(results_path: str, scale: str, baseline: str = None) -> pl.DataFrame:
+    '''
+    Best times of the latest run at a scale against a baseline run (default: the run before it).
+    :return: benchmark, baseline and latest seconds, and latest / baseline
+    '''
+    results = pl.read_ndjson(results_path, infer_schema_length=None).filter(pl.col("scale") == scale)
+    runs = results.group_by("run_id").agg(pl.col("timestamp").min()).sort("timestamp")["run_id"].to_list()
+    if len(runs) < 2 and baseline is None:
+        raise ValueError(f"Need two runs at scale {scale} to compare, found {len(runs)}")
+    latest = runs[-1]
+    baseline = baseline or runs[-2]
+
+    def best(run_id):
+        return results.filter(pl.col("run_id") == run_id).select("benchmark", "best_seconds", "commit")
+
+    return (best(baseline).join(best(latest), on="benchmark", how="full", coalesce=True, suffix="_latest")
+            .rename({"best_seconds": "baseline_seconds", "best_seconds_latest": "latest_seconds",
+                     "commit": "baseline_commit", "commit_latest": "latest_commit"})
+            .with_columns((pl.col("latest_seconds") / pl.col("baseline_seconds")).alias("ratio")))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", default="1m", help=f"{', '.join(SCALES)} or a number of rows")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", default=None, help="run the benchmarks whose name starts with this")
+    parser.add_argument("--results", default=RESULTS_PATH)
+    parser.add_argument("--work-dir", default=None, help="where the CSV / Parquet files of the load benchmarks go")
+    parser.add_argument("--threads", type=int, default=None, help="DuckDB threads, default all cores")
+    parser.add_argument("--compare", action="store_true", help="compare the last two runs instead of running")
+    parser.add_argument("--baseline", default=None, help="run_id to compare the latest run against")
+    args = parser.parse_args()
+
+    with pl.Config(tbl_rows=-1, tbl_width_chars=200):
+        if args.compare:
+            print(compare(args.results, args.scale, args.baseline))
+        else:
+            run(args.scale, args.repeat, args.only, args.results, args.work_dir, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+'''
+Synthetic H&M shaped data for the benchmarks: transactions, customers and articles with the skew the real data has,
+generated inside DuckDB so that 50M rows take seconds and no Kaggle download is needed.
+
+    - purchase frequency follows a power law: a few customers buy very often, most a handful of times, some never
+    - baskets: a customer buys a few items per visit, all on the same day and channel
+    - each customer has their own online / in store mix (sales_channel_id 2 / 1), ~65% online overall
+    - seasonality: a summer and a pre-Christmas peak, busier weekends and growth over the two years
+    - article popularity is skewed too, prices are per article (log-normal) with occasional discounts
+
+Every random draw is a hash of the row number and the seed rather than random(), so the data is the same for a
+seed whatever the number of DuckDB threads.
+
+    conn = make_synthetic_db(10_000_000)
+    write_csv(conn, '../data/synthetic/')     # CSVDataset('../data/synthetic/', ...) reads it like the Kaggle files
+'''
+import os
+
+import duckdb
+
+# rows of transactions per named scale
+SCALES = {"1m": 1_000_000, "10m": 10_000_000, "50m": 50_000_000}
+
+FIRST_DAY = "2018-09-20"
+DAYS = 734
+
+# (index_group_no, index_group_name, share of the articles)
+INDEX_GROUPS = [(1, "Ladieswear", 0.40), (2, "Divided", 0.15), (3, "Menswear", 0.12), (4, "Baby/Children", 0.25),
+                (26, "Sport", 0.08)]
+PRODUCT_GROUPS = ["Garment Upper body", "Garment Lower body", "Garment Full body", "Accessories", "Underwear",
+                  "Shoes", "Swimwear", "Socks & Tights", "Nightwear"]
+
+
+def uniform(*keys) -> str:
+    # SQL for a deterministic draw in [0, 1) from the hash of the keys
+    return "(hash({keys}) / 18446744073709551616.0)".format(keys=", ".join(str(key) for key in keys))
+
+
+def scale_rows(scale) -> int:
+    return SCALES[scale] if scale in SCALES else int(scale)
+
+
+def make_synthetic_db(rows: int, customers: int = None, articles: int = None, seed=0, skew=3.0,
+                      conn: duckdb.DuckDBPyConnection = None) -> duckdb.DuckDBPyConnection:
+    '''
+    :param rows: transactions, exactly
+    :param customers: defaults to one per 20 transactions, about the ratio of the Kaggle data
+    :param articles: defaults to one per 300 transactions (at least 1000)
+    :param seed: same seed, same data
+    :param skew: exponent of the customer draw, higher concentrates purchases on fewer customers
+    :param conn: connection to create the tables in, default a new in-memory database
+    :return: connection with transactions, customers and articles tables
+    '''
+    customers = customers or max(100, rows // 20)
+    articles = articles or max(1000, rows // 300)
+    conn = conn if conn is not None else duckdb.connect()
+
+    conn.execute('''
+        CREATE OR REPLACE TABLE customers AS
+        SELECT
+            md5(CAST(i AS VARCHAR)) AS customer_id,
+            CASE WHEN {u1} < 0.35 THEN 1.0 END AS FN,
+            CASE WHEN {u1} < 0.34 THEN 1.0 END AS active,
+            CASE WHEN {u2} < 0.03 THEN 'PRE-CREATE' ELSE 'ACTIVE' END AS club_member_status,
+            CASE WHEN {u1} < 0.35 THEN 'Regularly' WHEN {u2} < 0.01 THEN NULL ELSE 'NONE' END AS fashion_news_frequency,
+            -- two age bands, the younger one larger, ~1% unknown
+            CASE WHEN {u3} < 0.01 THEN NULL
+                 WHEN {u3} < 0.65 THEN 18 + CAST(FLOOR(15 * {u4}) AS INTEGER)
+                 ELSE 33 + CAST(FLOOR(45 * POW({u4}, 1.5)) AS INTEGER) END AS age
+        FROM range({customers}) r(i)
+    '''.format(customers=customers, u1=uniform("i", 1, seed), u2=uniform("i", 2, seed), u3=uniform("i", 3, seed),
+               u4=uniform("i", 4, seed)))
+
+    index_group = "CASE " + " ".join(
+        f"WHEN {uniform('i', 1, seed)} < {sum(share for _, _, share in INDEX_GROUPS[:k + 1])} THEN {k}"
+        for k in range(len(INDEX_GROUPS) - 1)) + f" ELSE {len(INDEX_GROUPS) - 1} END"
+    conn.execute('''
+        CREATE OR REPLACE TABLE articles AS
+        WITH a AS (
+            SELECT i, {index_group} AS g, CAST(FLOOR({u2} * 130) AS INTEGER) AS product_type
+            FROM range({articles}) r(i)
+        )
+        SELECT
+            LPAD(CAST(108775000 + i AS VARCHAR), 10, '0') AS article_id,
+            CAST(108775 + i // 3 AS INTEGER) AS product_code,
+            product_type + 50 AS product_type_no,
+            {product_groups}[1 + product_type % {n_product_groups}] AS product_group_name,
+            {group_nos}[1 + g] AS index_group_no,
+            {group_names}[1 + g] AS index_group_name,
+            1001 + CAST(FLOOR({u3} * 21) AS INTEGER) AS garment_group_no
+        FROM a
+    '''.format(articles=articles, index_group=index_group, u2=uniform("i", 2, seed), u3=uniform("i", 3, seed),
+               product_groups=PRODUCT_GROUPS, n_product_groups=len(PRODUCT_GROUPS),
+               group_nos=[no for no, _, _ in INDEX_GROUPS], group_names=[name for _, name, _ in INDEX_GROUPS]))
+
+    # day weights: yearly peaks around late June and mid December, weekends +15%, +40% growth over the period.
+    # A transaction's day is the day whose cumulative weight interval its draw falls in (ASOF JOIN)
+    conn.execute('''
+        CREATE OR REPLACE TEMP TABLE synthetic_days AS
+        WITH d AS (
+            SELECT
+                DATE '{first_day}' + CAST(i AS INTEGER) AS t_dat,
+                (1 + 0.35 * EXP(-POW((DAYOFYEAR(DATE '{first_day}' + CAST(i AS INTEGER)) - 175) / 20.0, 2))
+                   + 0.45 * EXP(-POW((DAYOFYEAR(DATE '{first_day}' + CAST(i AS INTEGER)) - 350) / 12.0, 2)))
+                * (CASE WHEN DAYOFWEEK(DATE '{first_day}' + CAST(i AS INTEGER)) IN (0, 6) THEN 1.15 ELSE 1 END)
+                * (1 + 0.4 * i / {days}) AS weight
+            FROM range({days}) r(i)
+        )
+        SELECT t_dat, (SUM(weight) OVER (ORDER BY t_dat) - weight) / SUM(weight) OVER () AS cumulative
+        FROM d
+    '''.format(first_day=FIRST_DAY, days=DAYS))
+
+    # baskets of 1 + a geometric number of items (mean ~2), enough of them to cover rows, cut at exactly rows
+    baskets = int(rows / 1.8) + 100
+    conn.execute('''
+        CREATE OR REPLACE TABLE transactions AS
+        WITH baskets AS (
+            SELECT
+                b,
+                1 + CAST(FLOOR(-LN(1 - {u_size}) * 1.4) AS INTEGER) AS size,
+                -- customer rank r with density ~ (r + r0)^(1/skew - 1), r0 keeping the most frequent buyers sane
+                CAST(FLOOR(POW({u_customer} * (POW({customers} + {r0}, 1 / {skew}) - POW({r0}, 1 / {skew}))
+                               + POW({r0}, 1 / {skew}), {skew}) - {r0}) AS INTEGER) AS customer,
+                {u_day} AS day_draw,
+                {u_channel} AS channel_draw
+            FROM range({baskets}) r(b)
+        ), positioned AS (
+            SELECT *, SUM(size) OVER (ORDER BY b ROWS UNBOUNDED PRECEDING) - size AS first_row
+            FROM baskets
+        ), items AS (
+            SELECT p.*, j, CAST(FLOOR(POW({u_article}, 2) * {articles}) AS INTEGER) AS article
+            FROM positioned p, range(size) s(j)
+            WHERE first_row + j < {rows}
+        )
+        SELECT
+            d.t_dat,
+            md5(CAST(customer AS VARCHAR)) AS customer_id,
+            LPAD(CAST(108775000 + article AS VARCHAR), 10, '0') AS article_id,
+            -- log-normal price per article (median ~0.025), 15% of items bought 30% off
+            ROUND(EXP(LN(0.025) + 0.6 * SQRT(-2 * LN(1 - {u_price1})) * COS(2 * PI() * {u_price2}))
+                  * CASE WHEN {u_discount} < 0.15 THEN 0.7 ELSE 1 END, 6) AS price,
+            -- each customer's own online share, between 30% and 100%
+            CASE WHEN channel_draw < 0.3 + 0.7 * {u_online} THEN 2 ELSE 1 END AS sales_channel_id
+        FROM items
+        ASOF JOIN synthetic_days d ON items.day_draw >= d.cumulative
+        ORDER BY d.t_dat, b, j
+    '''.format(rows=rows, customers=customers, articles=articles, baskets=baskets, skew=skew, r0=customers / 1000,
+               u_size=uniform("b", 10, seed), u_customer=uniform("b", 11, seed), u_day=uniform("b", 12, seed),
+               u_channel=uniform("b", 13, seed), u_article=uniform("b", "j", 14, seed),
+               u_price1=uniform("article", 15, seed), u_price2=uniform("article", 16, seed),
+               u_discount=uniform("b", "j", 17, seed), u_online=uniform("customer", 18, seed)))
+    conn.execute("DROP TABLE synthetic_days")
+    return conn
+
+
+def write_csv(conn: duckdb.DuckDBPyConnection, directory: str) -> list:
+    '''
+    Writes the tables as the Kaggle file names, for benchmarking CSVDataset.load.
+    :return: the file names, as CSVDataset's csv_files
+    '''
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    for table, file in (("articles", "articles.csv"), ("transactions", "transactions_train.csv"),
+                        ("customers", "customers.csv")):
+        path = os.path.join(directory, file).replace("'", "''")
+        conn.execute(f"COPY {table} TO '{path}' (HEADER, DELIMITER ',')")
+        files.append(file)
+    return files
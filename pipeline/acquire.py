@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import shutil
+import zipfile
+
+import duckdb
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from sql import sql_string
+
+# pyarrow type of each DuckDB type name used in CSVDataset.SCHEMA_OVERRIDES
+ARROW_TYPES = {"DATE": pa.date32(), "VARCHAR": pa.string(), "DOUBLE": pa.float64(), "BIGINT": pa.int64()}
+
+
+def sha256_file(path: str, chunk_bytes=1 << 24) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(path: str) -> dict:
+    '''
+    :return: archive file name -> its manifest entry, empty when there is no manifest yet
+    '''
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path: str, manifest: dict):
+    # written aside and renamed, so an interrupted run leaves the previous manifest rather than half of one
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def same_file(path: str, entry: dict) -> bool:
+    # size and modification time as recorded, so an unchanged multi-GB archive isn't hashed again on every run
+    if entry is None or not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns) == (entry.get("size"), entry.get("mtime_ns"))
+
+
+def mirror_copy(source: str, destination: str, sha256: str = None) -> bool:
+    '''
+    Copies source to destination unless it is already there with the same size and modification time.
+    :param sha256: expected checksum of the copy, checked before it takes the destination's name
+    :return: True if the file was copied
+    '''
+    if os.path.exists(destination):
+        source_stat, destination_stat = os.stat(source), os.stat(destination)
+        if (source_stat.st_size, source_stat.st_mtime_ns) == (destination_stat.st_size, destination_stat.st_mtime_ns):
+            return False
+    # a copy cut short stays under the .part name and is started again next time
+    part = destination + ".part"
+    shutil.copy2(source, part)
+    if sha256 is not None and sha256_file(part) != sha256:
+        os.remove(part)
+        raise ValueError(f"{source} does not match its SHA-256 {sha256}")
+    os.replace(part, destination)
+    return True
+
+
+def extract_to_parquet(zip_path: str, parquet_file: str, sort_keys: list = None, column_types: dict = None,
+                       threads: int = None) -> int:
+    '''
+    Streams the CSV inside a zip archive into a sorted, ZSTD compressed Parquet file: pyarrow parses the compressed
+    stream in blocks and DuckDB sorts the batches (spilling to disk if it must) as it writes them, so neither the CSV
+    nor the whole table is ever held on disk or in memory.  Runs in the worker processes of KaggleDataset.extract.
+    :param sort_keys: columns to order the rows by, those missing from the file are ignored
+    :param column_types: column -> DuckDB type name, as CSVDataset.SCHEMA_OVERRIDES, so the file has the types
+    CSVDataset.convert_to_parquet gives the same CSV.  Columns not listed are inferred by pyarrow, which can differ
+    from DuckDB's read_csv (e.g. a column of whole numbers with a decimal point)
+    :param threads: DuckDB threads, default all cores
+    :return: rows written
+    '''
+    with zipfile.ZipFile(zip_path) as archive:
+        members = [name for name in archive.namelist() if name.endswith(".csv")]
+        if len(members) != 1:
+            raise ValueError(f"Expected one CSV in {zip_path}, found {members}")
+
+        with archive.open(members[0]) as stream:
+            reader = pa_csv.open_csv(stream, read_options=pa_csv.ReadOptions(block_size=1 << 24),
+                                     # empty fields are NULL, as DuckDB's read_csv has them
+                                     convert_options=pa_csv.ConvertOptions(
+                                         column_types={column: ARROW_TYPES[duckdb_type]
+                                                       for column, duckdb_type in (column_types or {}).items()},
+                                         strings_can_be_null=True))
+            order_by = ", ".join(key for key in sort_keys or [] if key in reader.schema.names)
+
+            conn = duckdb.connect()
+            try:
+                if threads:
+                    conn.execute(f"SET threads = {threads}")
+                conn.register("csv_stream", reader)
+                tmp_file = parquet_file + ".tmp"
+                conn.execute('''
+                    COPY (SELECT * FROM csv_stream {order_by})
+                    TO {tmp_file} (FORMAT PARQUET, COMPRESSION ZSTD)
+                '''.format(order_by=f"ORDER BY {order_by}" if order_by else "", tmp_file=sql_string(tmp_file)))
+                rows = conn.execute("SELECT COUNT(1) FROM read_parquet(?)", [tmp_file]).fetchone()[0]
+            finally:
+                conn.close()
+    os.replace(tmp_file, parquet_file)
+    return rows
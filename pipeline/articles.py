@@ -0,0 +1,108 @@
+class ArticleDimension:
+    '''
+    One row per article and cut-off date with what the product and price sensitivity features need, so the
+    per-customer aggregation joins a small, narrow table instead of articles.csv and a per-article price aggregate on
+    every run:
+
+        as_of                                               the cut-off, a snapshot's feature_end
+        article_id
+        index_group_no, product_type_no, garment_group_no   category codes straight from articles
+        product_group_code                                  dense code of product_group_name
+        median_price                                        median price paid up to and including as_of
+        price_band                                          1 (cheapest) .. PRICE_BANDS (dearest) quantile of median_price
+
+    The prices stop at as_of: a median over all of transactions would carry prices from the response window and later
+    into the features of a historical snapshot, and so into training and backtests.  Each cut-off in use gets its own
+    rows (built on first use), the feature query joins those of its feature_end.  Articles not sold by as_of have no
+    median_price or price_band.
+
+    Each cut-off's rows are written sorted by article_id.  DuckDB answers the join with a hash join whose build side is
+    one cut-off's rows (~100k), so the cost of the join over the transactions is one probe per row.
+
+    Freshness follows cube.DailyCube, per cut-off: rebuilt when the data fingerprint changes, or without one when the
+    article count or the row count or last day of the transactions up to as_of do.
+    '''
+
+    TABLE = "article_dim"
+    META_TABLE = "article_dim_meta"
+    PRICE_BANDS = 5
+
+    BUILD_SQL = '''
+        WITH prices AS (
+            SELECT article_id, MEDIAN(price) AS median_price
+            FROM transactions
+            WHERE t_dat <= DATE '{as_of}'
+            GROUP BY article_id
+        )
+        SELECT
+            DATE '{as_of}' AS as_of,
+            a.article_id,
+            a.index_group_no,
+            a.product_type_no,
+            a.garment_group_no,
+            CAST(DENSE_RANK() OVER (ORDER BY a.product_group_name) AS SMALLINT) AS product_group_code,
+            p.median_price,
+            CAST(CASE WHEN p.median_price IS NOT NULL
+                      THEN NTILE({price_bands}) OVER (PARTITION BY p.median_price IS NULL ORDER BY p.median_price)
+                 END AS TINYINT) AS price_band
+        FROM articles a
+        LEFT JOIN prices p ON p.article_id = a.article_id
+        ORDER BY a.article_id
+    '''
+
+    @staticmethod
+    def exists(duckdb_conn) -> bool:
+        return duckdb_conn.execute(
+            "SELECT COUNT(1) FROM duckdb_tables() WHERE table_name = ?", [ArticleDimension.META_TABLE]).fetchone()[0] > 0
+
+    @staticmethod
+    def source_state(duckdb_conn, as_of) -> tuple:
+        return duckdb_conn.execute(
+            "SELECT (SELECT COUNT(1) FROM articles), COUNT(1), MAX(t_dat) FROM transactions WHERE t_dat <= ?",
+            [as_of]).fetchone()
+
+    @staticmethod
+    def keyed_by_cutoff(duckdb_conn) -> bool:
+        return duckdb_conn.execute("SELECT COUNT(1) FROM duckdb_columns() WHERE table_name = ? AND column_name = 'as_of'",
+                                   [ArticleDimension.TABLE]).fetchone()[0] > 0
+
+    @staticmethod
+    def build(duckdb_conn, as_of, fingerprint: str = None):
+        print(f"Building {ArticleDimension.TABLE} as of {as_of}")
+        article_count, row_count, max_t_dat = (ArticleDimension.source_state(duckdb_conn, as_of) if fingerprint is None
+                                               else (None, None, None))
+        build_sql = ArticleDimension.BUILD_SQL.format(as_of=as_of, price_bands=ArticleDimension.PRICE_BANDS)
+        if duckdb_conn.execute("SELECT COUNT(1) FROM duckdb_tables() WHERE table_name = ?", [ArticleDimension.TABLE]
+                               ).fetchone()[0] and not ArticleDimension.keyed_by_cutoff(duckdb_conn):
+            # written before the dimension was keyed by cut-off, with prices over all of transactions
+            duckdb_conn.execute(f"DROP TABLE {ArticleDimension.TABLE}")
+            duckdb_conn.execute(f"DROP TABLE IF EXISTS {ArticleDimension.META_TABLE}")
+        duckdb_conn.execute(f"CREATE TABLE IF NOT EXISTS {ArticleDimension.TABLE} AS {build_sql} LIMIT 0")
+        duckdb_conn.execute(f"DELETE FROM {ArticleDimension.TABLE} WHERE as_of = ?", [as_of])
+        duckdb_conn.execute(f"INSERT INTO {ArticleDimension.TABLE} {build_sql}")
+
+        duckdb_conn.execute(f"CREATE TABLE IF NOT EXISTS {ArticleDimension.META_TABLE} "
+                            "(as_of DATE, article_count BIGINT, row_count BIGINT, max_t_dat DATE, fingerprint VARCHAR)")
+        duckdb_conn.execute(f"DELETE FROM {ArticleDimension.META_TABLE} WHERE as_of = ?", [as_of])
+        duckdb_conn.execute(f"INSERT INTO {ArticleDimension.META_TABLE} VALUES (?, ?, ?, ?, ?)",
+                            [as_of, article_count, row_count, max_t_dat, fingerprint])
+
+    @staticmethod
+    def ensure(duckdb_conn, as_of, fingerprint: str = None):
+        '''
+        Builds the dimension's rows for a cut-off if they do not exist or are out of date.
+        :param duckdb_conn: connection with articles and transactions tables or views
+        :param as_of: the cut-off, prices after it are not used - Features.feature_end
+        :param fingerprint: identifies the source data, e.g. CSVDataset.fingerprint()
+        '''
+        if ArticleDimension.exists(duckdb_conn) and ArticleDimension.keyed_by_cutoff(duckdb_conn):
+            built = duckdb_conn.execute(
+                f"SELECT article_count, row_count, max_t_dat, fingerprint FROM {ArticleDimension.META_TABLE} "
+                "WHERE as_of = ?", [as_of]).fetchone()
+            if built is not None:
+                if fingerprint is not None:
+                    if built[3] == fingerprint:
+                        return
+                elif built[3] is None and tuple(built[:3]) == ArticleDimension.source_state(duckdb_conn, as_of):
+                    return
+        ArticleDimension.build(duckdb_conn, as_of, fingerprint)
@@ -0,0 +1,177 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import duckdb
+import polars as pl
+import polars.selectors as cs
+
+from cube import DailyCube
+from evaluate import Evaluator
+from features import Features, QueryConstants
+import profiling
+
+
+def training_constants(backtest_constants: QueryConstants) -> QueryConstants:
+    '''
+    The training window of a backtest window: same durations, labelled one response period earlier.  The training
+    labels end where the backtest features end, so the fold only uses what was known at that point (the README
+    baseline: label 60-30 days ago, backtest the prior 30 days).
+    '''
+    return QueryConstants(backtest_constants.end_date, backtest_constants.response_duration,
+                          backtest_constants.additional_offset + backtest_constants.response_duration,
+                          backtest_constants.feature_duration)
+
+
+def run_fold(database_path: str, backtest_constants: QueryConstants, model_factory, use_daily_cube=False,
+             data_fingerprint=None, top_k=100_000, threads=None, label_col="label", profile_log=None) -> dict:
+    '''
+    One walk-forward fold: features + labels for the training and backtest windows, fit, score, evaluate.
+    Top level so that it can run in a worker process.
+    :param profile_log: run log the fold's stages and queries are appended to (see profiling.RunProfiler), tagged
+    with run_id fold_<end_date>
+    :return: one row of the metrics table
+    '''
+    if profile_log is not None:
+        with profiling.RunProfiler(profile_log, run_id=f"fold_{backtest_constants.end_date}"):
+            return run_fold(database_path, backtest_constants, model_factory, use_daily_cube, data_fingerprint, top_k,
+                            threads, label_col)
+
+    started = time.perf_counter()
+    conn = duckdb.connect(database_path, read_only=True)
+    try:
+        if threads:
+            conn.execute(f"SET threads = {threads}")
+        train_df = Features(training_constants(backtest_constants), use_daily_cube,
+                            data_fingerprint).get_all_features_and_response(conn)
+        test_df = Features(backtest_constants, use_daily_cube, data_fingerprint).get_all_features_and_response(conn)
+    finally:
+        conn.close()
+    features_done = time.perf_counter()
+
+    preprocessor, model = model_factory()
+
+    def preprocess(df):
+        return preprocessor.transform(df) if preprocessor is not None else numeric_matrix(df, label_col)
+
+    if preprocessor is not None:
+        profiling.stage("preprocess_fit", lambda: preprocessor.fit(train_df))
+    X_train = profiling.stage("preprocess", lambda: preprocess(train_df))
+    y_train = train_df[label_col].to_numpy()
+    profiling.stage("train", lambda: model.fit(X_train, y_train))
+    fit_done = time.perf_counter()
+
+    X_test = profiling.stage("preprocess", lambda: preprocess(test_df))
+    y_test = test_df[label_col].to_numpy()
+    train_scores = profiling.stage("score", lambda: model.predict_proba(X_train)[:, 1])
+    test_scores = profiling.stage("score", lambda: model.predict_proba(X_test)[:, 1])
+    # the threshold is chosen on the training window, as it would be in production
+    e_train = Evaluator(y_train, train_scores, top_k=top_k)
+    e_backtest = Evaluator(y_test, test_scores, threshold=e_train.optimal_threshold, top_k=top_k)
+    top_bin = e_backtest.lift_table.row(0, named=True)
+
+    return {
+        "end_date": backtest_constants.end_date,
+        "train_customers": train_df.height,
+        "train_buyers": int(y_train.sum()),
+        "backtest_customers": test_df.height,
+        "backtest_buyers": int(y_test.sum()),
+        "auc": float(e_backtest.auc),
+        "f1_score": float(e_backtest.f1_score),
+        "threshold": float(e_backtest.optimal_threshold),
+        "buyers_in_top_k": e_backtest.buyers_in_top_k,
+        "top_decile_lift": top_bin["lift"],
+        "top_decile_gain": top_bin["cumulative_gain"],
+        "feature_seconds": features_done - started,
+        "fit_seconds": fit_done - features_done,
+        "fold_seconds": time.perf_counter() - started,
+    }
+
+
+def numeric_matrix(df: pl.DataFrame, label_col="label"):
+    return df.select(cs.numeric().exclude(label_col)).to_numpy()
+
+
+class WalkForwardBacktest:
+    '''
+    Walk-forward backtest over a list of cut-offs.  Each fold trains on the window labelled one response period
+    before its cut-off and is evaluated on the cut-off's own window (see training_constants).  Folds are independent,
+    so they run in a process pool with a read-only DuckDB connection each - a 12 fold backtest takes about as long
+    as one fold given enough cores.
+
+    Usage:
+        backtest = WalkForwardBacktest.from_stride('../data/ptb.duckdb', date(2020, 9, 22), 28, 12, model_factory,
+                                                   n_jobs=12)
+        metrics = backtest.run()
+    '''
+
+    def __init__(self, database_path: str, cutoffs: list, model_factory, n_jobs=1, use_daily_cube=False,
+                 data_fingerprint=None, top_k=100_000, label_col="label", profile_log=None):
+        '''
+        :param database_path: DuckDB database file with transactions and customers (e.g. CSVDataset(..., database=)).
+        Workers open it read-only, so no other process may hold it open for writing while the backtest runs.
+        :param cutoffs: one QueryConstants per fold, describing the backtest window
+        :param model_factory: picklable callable (a module level function or functools.partial) returning an unfitted
+        (preprocessor, model).  preprocessor needs fit(df) -> self and transform(df) -> matrix, or None for the
+        numeric columns as is.  model needs fit and predict_proba.
+        :param n_jobs: worker processes, 1 runs the folds in this process
+        :param use_daily_cube: compute features from cube.DailyCube, built once up front if needed
+        :param data_fingerprint: see cube.DailyCube
+        :param top_k: report the buyers in the top_k ranked customers
+        :param label_col:
+        :param profile_log: JSON lines run log every fold appends its stages and queries to, see run_fold
+        '''
+        self.database_path = database_path
+        self.cutoffs = cutoffs
+        self.model_factory = model_factory
+        self.n_jobs = n_jobs
+        self.use_daily_cube = use_daily_cube
+        self.data_fingerprint = data_fingerprint
+        self.top_k = top_k
+        self.label_col = label_col
+        self.profile_log = profile_log
+
+    @staticmethod
+    def from_stride(database_path: str, last_end_date, stride_days: int, count: int, model_factory,
+                    response_duration=28, feature_duration=365, **kwargs) -> 'WalkForwardBacktest':
+        '''
+        :param last_end_date: end date of the most recent backtest window
+        :param stride_days: days between folds, e.g. 28 for monthly
+        :param count: number of folds, going back in time from last_end_date
+        :param kwargs: passed on to the constructor
+        '''
+        cutoffs = [QueryConstants(last_end_date - timedelta(days=stride_days * i), response_duration,
+                                  feature_duration=feature_duration) for i in range(count)]
+        return WalkForwardBacktest(database_path, cutoffs, model_factory, **kwargs)
+
+    def prepare(self):
+        # the cube is written once here, the read-only workers only read it
+        if self.use_daily_cube:
+            conn = duckdb.connect(self.database_path)
+            try:
+                DailyCube.ensure(conn, self.data_fingerprint)
+            finally:
+                conn.close()
+
+    def run(self) -> pl.DataFrame:
+        '''
+        :return: one row of metrics per fold, ordered by end_date
+        '''
+        self.prepare()
+        fold_args = [(self.database_path, constants, self.model_factory, self.use_daily_cube, self.data_fingerprint,
+                      self.top_k) for constants in self.cutoffs]
+
+        if self.n_jobs == 1:
+            rows = [run_fold(*args, label_col=self.label_col, profile_log=self.profile_log) for args in fold_args]
+        else:
+            # split the cores between the workers rather than each DuckDB using all of them.  spawn rather than fork,
+            # see scoring.BatchScorer
+            threads = max(1, (os.cpu_count() or 1) // self.n_jobs)
+            with ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [pool.submit(run_fold, *args, threads=threads, label_col=self.label_col,
+                                       profile_log=self.profile_log) for args in fold_args]
+                rows = [future.result() for future in futures]
+
+        return pl.DataFrame(rows).sort("end_date")
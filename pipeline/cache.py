@@ -0,0 +1,145 @@
+import hashlib
+import os
+import re
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.ipc
+
+
+class QueryCache:
+    '''
+    On disk cache of query results, keyed by the normalized SQL text plus a fingerprint of the tables it reads.
+
+    Results are stored as Arrow IPC files (memory mapped on read).  The directory is kept under max_bytes by evicting
+    the least recently used files - a hit touches the file, so the modification time doubles as the LRU clock.
+
+    Usage:
+        Features.query_cache = QueryCache('../cache', data_fingerprint=dataset.fingerprint())
+    '''
+
+    def __init__(self, cache_dir: str, max_bytes: int = 5 * 1024 ** 3, data_fingerprint: str = None,
+                 hash_contents: bool = False):
+        '''
+        :param cache_dir: directory for the cached results
+        :param max_bytes: size bound for the directory
+        :param data_fingerprint: identifies the underlying data (e.g. CSVDataset.fingerprint()).  If not given, each
+        table referenced by a query is fingerprinted from its definition, schema and row count ... which only notices
+        rows being added or removed and schema changes, NOT an in-place UPDATE that keeps the row count.  Pass a
+        data_fingerprint, hash_contents=True or clear() the cache after modifying tables in place.
+        :param hash_contents: fingerprint referenced tables by a hash of every row.  Always exact, but costs a scan
+        of each table per lookup.
+        Temporary tables (e.g. snapshot or parameter tables) are always fingerprinted by content, whatever the above.
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.data_fingerprint = data_fingerprint
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def normalize_sql(query: str) -> str:
+        return " ".join(query.split())
+
+    @staticmethod
+    def table_fingerprint(duckdb_conn, table: str, hash_contents: bool = False) -> str:
+        definition = duckdb_conn.execute(
+            "SELECT COALESCE(MAX(sql), '') FROM duckdb_views() WHERE view_name = ?", [table]).fetchone()[0]
+        schema = duckdb_conn.execute(f"DESCRIBE {table}").fetchall()
+        if hash_contents:
+            # order independent, so the same rows in a different physical order still hit
+            contents = duckdb_conn.execute(f"SELECT COUNT(1), SUM(HASH(t)) FROM {table} t").fetchone()
+        else:
+            contents = duckdb_conn.execute(f"SELECT COUNT(1) FROM {table}").fetchone()[0]
+        return f"{table}:{definition}:{schema}:{contents}"
+
+    def fingerprint(self, duckdb_conn, query: str) -> str:
+        names = duckdb_conn.execute('''
+            SELECT table_name, temporary FROM duckdb_tables() WHERE NOT internal
+            UNION SELECT view_name, temporary FROM duckdb_views() WHERE NOT internal
+        ''').fetchall()
+        words = set(re.findall(r'\w+', query.lower()))
+        tables = sorted((name, temporary) for name, temporary in names if name.lower() in words)
+
+        # temporary tables live only in this session, so the data fingerprint can't cover them
+        temporary = [QueryCache.table_fingerprint(duckdb_conn, table, hash_contents=True)
+                     for table, is_temporary in tables if is_temporary]
+        if self.data_fingerprint is not None:
+            return "|".join([self.data_fingerprint] + temporary)
+
+        persistent = [QueryCache.table_fingerprint(duckdb_conn, table, self.hash_contents)
+                      for table, is_temporary in tables if not is_temporary]
+        return "|".join(persistent + temporary)
+
+    def key(self, duckdb_conn, query: str) -> str:
+        text = QueryCache.normalize_sql(query) + "\n" + self.fingerprint(duckdb_conn, query)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".arrow")
+
+    def get_or_run(self, duckdb_conn, query: str, run_query) -> pl.DataFrame:
+        '''
+        :param duckdb_conn:
+        :param query:
+        :param run_query: function(duckdb_conn, query) -> pl.DataFrame, called on a miss
+        :return:
+        '''
+        path = self.path(self.key(duckdb_conn, query))
+
+        if os.path.exists(path):
+            self.hits += 1
+            os.utime(path)
+            with pa.memory_map(path) as source:
+                return pl.from_arrow(pa.ipc.open_file(source).read_all())
+
+        self.misses += 1
+        result = run_query(duckdb_conn, query)
+
+        table = result.to_arrow()
+        tmp_path = path + ".tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+        self.evict()
+        return result
+
+    def entries(self) -> list:
+        # (mtime, size, path), oldest first
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if file.endswith(".arrow"):
+                stat = os.stat(os.path.join(self.cache_dir, file))
+                entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(self.cache_dir, file)))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
+
+    def stats(self) -> dict:
+        entries = self.entries()
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
@@ -0,0 +1,103 @@
+class DailyCube:
+    '''
+    A (customer_id, t_dat, sales_channel_id) rollup of transactions.  The H&M data has many items per customer per day,
+    so the time-slice features (which only care about which day and which channel) can be computed from this much
+    smaller table instead of row-level transactions.
+
+    item_count and price_sum replace COUNT(1) / SUM(price).  price_sum is a DECIMAL so that summing the rollup is exact
+    and independent of the order DuckDB happens to add rows in.  first_of_day marks one row per (customer_id, t_dat) so
+    that counting distinct days becomes a plain COUNT instead of a COUNT(DISTINCT ...).
+
+    Rows are written in t_dat order (appends only ever add later days), so a query over a date range skips the row
+    groups outside it.
+
+    Freshness: given a data fingerprint (e.g. CSVDataset.fingerprint()) the cube is rebuilt whenever the fingerprint
+    changes.  Without one, it falls back to the row count and max date of transactions - appending new days when the
+    old rows are untouched, otherwise rebuilding.  That fallback cannot see an in-place correction that keeps the row
+    count and last day, so pass a fingerprint when one is available.
+    '''
+
+    TABLE = "transactions_daily"
+    META_TABLE = "transactions_daily_meta"
+
+    ROLLUP_SQL = '''
+        SELECT
+            customer_id,
+            t_dat,
+            sales_channel_id,
+            COUNT(1) AS item_count,
+            SUM(CAST(price AS DECIMAL(18, 15))) AS price_sum,
+            sales_channel_id = MIN(sales_channel_id) OVER (PARTITION BY customer_id, t_dat) AS first_of_day
+        FROM transactions
+        WHERE {date_filter}
+        GROUP BY customer_id, t_dat, sales_channel_id
+        ORDER BY t_dat, customer_id
+    '''
+
+    @staticmethod
+    def exists(duckdb_conn) -> bool:
+        return duckdb_conn.execute(
+            "SELECT COUNT(1) FROM duckdb_tables() WHERE table_name = ?", [DailyCube.META_TABLE]).fetchone()[0] > 0
+
+    @staticmethod
+    def source_state(duckdb_conn) -> tuple:
+        return duckdb_conn.execute("SELECT COUNT(1), MAX(t_dat) FROM transactions").fetchone()
+
+    @staticmethod
+    def built_state(duckdb_conn) -> dict:
+        if not DailyCube.exists(duckdb_conn):
+            return {}
+        result = duckdb_conn.execute(f"SELECT * FROM {DailyCube.META_TABLE}")
+        columns = [column[0] for column in result.description]
+        return dict(zip(columns, result.fetchone()))
+
+    @staticmethod
+    def build(duckdb_conn, fingerprint: str = None):
+        print(f"Building {DailyCube.TABLE}")
+        # with a fingerprint there is no need to scan transactions for its row count
+        row_count, max_t_dat = DailyCube.source_state(duckdb_conn) if fingerprint is None else (None, None)
+
+        duckdb_conn.execute(f"CREATE OR REPLACE TABLE {DailyCube.TABLE} AS " + DailyCube.ROLLUP_SQL.format(date_filter="TRUE"))
+        DailyCube._write_meta(duckdb_conn, row_count, max_t_dat, fingerprint)
+
+    @staticmethod
+    def ensure(duckdb_conn, fingerprint: str = None):
+        '''
+        Builds the cube if it does not exist and brings it up to date with transactions if it does.
+        :param duckdb_conn: connection with a transactions table or view
+        :param fingerprint: identifies the source data, e.g. CSVDataset.fingerprint()
+        '''
+        built = DailyCube.built_state(duckdb_conn)
+
+        if fingerprint is not None:
+            if built.get("fingerprint") != fingerprint:
+                DailyCube.build(duckdb_conn, fingerprint)
+            return
+
+        if not built or built.get("row_count") is None:
+            DailyCube.build(duckdb_conn)
+            return
+
+        built_rows, built_max = built["row_count"], built["max_t_dat"]
+        row_count, max_t_dat = DailyCube.source_state(duckdb_conn)
+
+        if (row_count, max_t_dat) == (built_rows, built_max):
+            return
+
+        # new days only ... the rows the cube was built from must be unchanged for an append to be safe
+        old_rows = duckdb_conn.execute(
+            "SELECT COUNT(1) FROM transactions WHERE t_dat <= ?", [built_max]).fetchone()[0]
+
+        if max_t_dat > built_max and old_rows == built_rows:
+            print(f"Appending {row_count - built_rows} transactions after {built_max} to {DailyCube.TABLE}")
+            date_filter = "t_dat > DATE '{built_max}'".format(built_max=built_max)
+            duckdb_conn.execute(f"INSERT INTO {DailyCube.TABLE} " + DailyCube.ROLLUP_SQL.format(date_filter=date_filter))
+            DailyCube._write_meta(duckdb_conn, row_count, max_t_dat, None)
+        else:
+            DailyCube.build(duckdb_conn)
+
+    @staticmethod
+    def _write_meta(duckdb_conn, row_count, max_t_dat, fingerprint):
+        duckdb_conn.execute(
+            f"CREATE OR REPLACE TABLE {DailyCube.META_TABLE} (row_count BIGINT, max_t_dat DATE, fingerprint VARCHAR)")
+        duckdb_conn.execute(f"INSERT INTO {DailyCube.META_TABLE} VALUES (?, ?, ?)", [row_count, max_t_dat, fingerprint])
@@ -1,73 +1,229 @@
 import duckdb
+import multiprocessing
 import polars as pl
 import pyarrow
 import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from kaggle.api.kaggle_api_extended import KaggleApi
 
 from IPython.display import display, HTML
 from itables import init_notebook_mode
 
+from acquire import extract_to_parquet, mirror_copy, read_manifest, same_file, sha256_file, write_manifest
+from sql import sql_string
+import profiling
+
 class KaggleDataset():
+    '''
+    Gets the H&M competition files and turns them into sorted Parquet files, the tables of a CSVDataset.from_parquet,
+    without ever extracting a CSV:
 
-    def load(self):
-        # There are other ways to download the files.
-        # For this project I do not use the images (which take a long time)
-        # Get a cup of coffee or change to one file at a time
-        # Better than kaggle docs: https://stackoverflow.com/questions/55934733/documentation-for-kaggle-api-within-python
+        acquire   the zip archives, downloaded from Kaggle - or copied from a local mirror directory holding the same
+                  *.csv.zip files, which needs no Kaggle account or network - in parallel threads
+        extract   each archive streamed straight into Parquet (acquire.extract_to_parquet), n_jobs archives at a time
+
+    A manifest (MANIFEST in data_path) records the SHA-256, size and modification time of every archive and the
+    Parquet file made from it.  A repeat run checks sizes and times, finds nothing changed and does nothing; a changed
+    archive is hashed again and only re-extracted if its content did change.  When the mirror has a manifest of its
+    own, every archive is checked against its SHA-256 before it is used, and one that doesn't match is removed.
+
+    Usage:
+        dataset = KaggleDataset('../data', n_jobs=3).load()     # a CSVDataset over the Parquet files
+        dataset.duckdb_conn
+    '''
+
+    COMPETITION = 'h-and-m-personalized-fashion-recommendations'
+    FILES = ['articles.csv', 'customers.csv', 'transactions_train.csv']
+    MANIFEST = 'manifest.json'
 
-        # not positive this is needed ...
-        # os.environ['KAGGLE_CONFIG_DIR'] = '/Users/rogerteffen/.kaggle/'
-        # print(os.environ['KAGGLE_CONFIG_DIR'])
+    def __init__(self, data_path='../data', mirror_path: str = None, parquet_path: str = None, n_jobs=1,
+                 files: list = None):
+        '''
+        :param data_path: where the archives and the manifest go
+        :param mirror_path: directory to copy the archives from instead of downloading them
+        :param parquet_path: where the Parquet files go, default data_path/parquet
+        :param n_jobs: archives downloaded and extracted at the same time, 1 works through them in this process
+        :param files: CSV names within the competition, default FILES
+        '''
+        self.data_path = data_path
+        self.mirror_path = mirror_path
+        self.parquet_path = parquet_path or os.path.join(data_path, "parquet")
+        self.n_jobs = n_jobs
+        self.files = files or KaggleDataset.FILES
+        self.manifest_path = os.path.join(data_path, KaggleDataset.MANIFEST)
+        self.hashes = {}  # (zip_path, size, mtime_ns) -> SHA-256, so a run hashes each archive at most once
 
-        api = KaggleApi()
-        api.authenticate()
+    @staticmethod
+    def table_name(file: str) -> str:
+        # as CSVDataset.load names the tables
+        return file.replace(".csv", "").replace("_train", "")
 
-        data_set = 'h-and-m-personalized-fashion-recommendations'
+    def download(self, file: str) -> str:
+        zip_path = os.path.join(self.data_path, file + ".zip")
+        if self.mirror_path is not None:
+            name = file + ".zip"
+            expected = read_manifest(os.path.join(self.mirror_path, KaggleDataset.MANIFEST)).get(name)
+            sha256 = expected["sha256"] if expected is not None else None
+            # a copy is checked before it replaces the archive, so a bad one never reaches data_path
+            if mirror_copy(os.path.join(self.mirror_path, name), zip_path, sha256):
+                print(f"Copied {name} from {self.mirror_path}")
+                if sha256 is not None:
+                    stat = os.stat(zip_path)
+                    self.hashes[(zip_path, stat.st_size, stat.st_mtime_ns)] = sha256
+            elif (sha256 is not None
+                  and self.archive_sha256(zip_path, read_manifest(self.manifest_path).get(name)) != sha256):
+                # an archive already there but not (or differently) in our manifest, e.g. left by an earlier version
+                os.remove(zip_path)
+                raise ValueError(f"{zip_path} does not match the SHA-256 in the mirror's manifest")
+        else:
+            # the API compares against the archive already there and skips the download if it is current
+            api = KaggleApi()
+            api.authenticate()
+            api.competition_download_file(KaggleDataset.COMPETITION, file, path=self.data_path, quiet=True)
+        return zip_path
 
-        # Download all files for a competition
-        # Signature: competition_download_files(competition, path=None, force=False, quiet=True)
-        # api.competition_download_files('h-and-m-personalized-fashion-recommendations',
-        #                                path='../data')
+    @profiling.profiled("acquire")
+    def acquire(self) -> list:
+        '''
+        :return: paths of the zip archives, in the order of files
+        '''
+        os.makedirs(self.data_path, exist_ok=True)
+        # downloads and copies wait on the network or the disk, threads are enough
+        with ThreadPoolExecutor(max_workers=max(1, self.n_jobs)) as pool:
+            return list(pool.map(self.download, self.files))
 
-        api.competition_download_file('h-and-m-personalized-fashion-recommendations',
-                                      'articles.csv', path='../data')
-        api.competition_download_file('h-and-m-personalized-fashion-recommendations',
-                                      'customers.csv', path='../data')
-        api.competition_download_file('h-and-m-personalized-fashion-recommendations',
-                                      'transactions_train.csv', path='../data')
+    def archive_sha256(self, zip_path: str, entry: dict = None) -> str:
+        '''
+        :param entry: the archive's manifest entry, whose checksum holds while size and modification time do
+        '''
+        if same_file(zip_path, entry):
+            return entry["sha256"]
+        stat = os.stat(zip_path)
+        key = (zip_path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            self.hashes[key] = sha256_file(zip_path)
+        return self.hashes[key]
 
-        # Define the directory containing the .zip files
-        zip_dir = '../data'
-        destination_dir = '../data'
+    @profiling.profiled("extract")
+    def extract(self, zip_paths: list) -> list:
+        '''
+        Extracts the archives that are new or changed since the manifest was written.
+        :return: paths of the Parquet files, in the order of zip_paths
+        '''
+        os.makedirs(self.parquet_path, exist_ok=True)
+        manifest = read_manifest(self.manifest_path)
 
-        # Create the destination directory if it doesn't exist
-        os.makedirs(destination_dir, exist_ok=True)
+        pending = []
+        for zip_path in zip_paths:
+            name = os.path.basename(zip_path)
+            table = KaggleDataset.table_name(name[:-len(".zip")])
+            parquet_file = os.path.abspath(os.path.join(self.parquet_path, table + ".parquet"))
+            entry = manifest.get(name)
+            sha256 = self.archive_sha256(zip_path, entry)
 
-        # Iterate through all files in the directory
-        for file in os.listdir(zip_dir):
-            if file.endswith('.zip'):
-                # Construct full path to the zip file
-                zip_path = os.path.join(zip_dir, file)
+            if entry is not None and entry["sha256"] == sha256 and same_file(parquet_file, entry.get("parquet")):
+                if not same_file(zip_path, entry):
+                    # touched but not changed, e.g. copied again
+                    stat = os.stat(zip_path)
+                    manifest[name].update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                continue
+            pending.append((name, zip_path, parquet_file, table, sha256))
 
-                # Unzip the file
-                os.system(f"unzip -o {zip_path} -d {destination_dir}")
-                print(f"Unzipped: {file}")
+        def record(name, zip_path, parquet_file, table, sha256, rows):
+            zip_stat, parquet_stat = os.stat(zip_path), os.stat(parquet_file)
+            manifest[name] = {"sha256": sha256, "size": zip_stat.st_size, "mtime_ns": zip_stat.st_mtime_ns,
+                              "table": table, "rows": rows,
+                              "parquet": {"size": parquet_stat.st_size, "mtime_ns": parquet_stat.st_mtime_ns}}
+            # after every archive, so an interrupted run resumes with the ones still missing
+            write_manifest(self.manifest_path, manifest)
+
+        if self.n_jobs == 1 or len(pending) <= 1:
+            for name, zip_path, parquet_file, table, sha256 in pending:
+                print(f"Extracting {zip_path} to {parquet_file}")
+                rows = extract_to_parquet(zip_path, parquet_file, CSVDataset.SORT_KEYS.get(table),
+                                          CSVDataset.SCHEMA_OVERRIDES)
+                record(name, zip_path, parquet_file, table, sha256, rows)
+        else:
+            # spawn rather than fork, see scoring.BatchScorer.  The cores are split between the workers' DuckDBs
+            threads = max(1, (os.cpu_count() or 1) // self.n_jobs)
+            with ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = {pool.submit(extract_to_parquet, zip_path, parquet_file, CSVDataset.SORT_KEYS.get(table),
+                                       CSVDataset.SCHEMA_OVERRIDES, threads): (name, zip_path, parquet_file, table, sha256)
+                           for name, zip_path, parquet_file, table, sha256 in pending}
+                print(f"Extracting {len(futures)} archives to {self.parquet_path}")
+                for future in as_completed(futures):
+                    record(*futures[future], future.result())
+
+        write_manifest(self.manifest_path, manifest)
+        return [os.path.abspath(os.path.join(self.parquet_path, KaggleDataset.table_name(file) + ".parquet"))
+                for file in self.files]
+
+    def load(self) -> 'CSVDataset':
+        '''
+        Acquires and extracts what is missing or changed, then loads the tables.
+        :return: a CSVDataset over the extracted files, see CSVDataset.from_parquet
+        '''
+        zip_paths = self.acquire()
+        parquet_files = self.extract(zip_paths)
+        manifest = read_manifest(self.manifest_path)
+        tables = [KaggleDataset.table_name(file) for file in self.files]
+        # the archives' checksums are the data fingerprint, e.g. for cube.DailyCube and cache.QueryCache
+        return CSVDataset.from_parquet(dict(zip(tables, parquet_files)),
+                                       {table: manifest[os.path.basename(zip_path)]["sha256"]
+                                        for table, zip_path in zip(tables, zip_paths)})
 
 
 class CSVDataset():
 
-    def __init__(self, csv_path: str, csv_files: list):
+    # todo: more hardcoding - applied to whichever file has the column.  Every column of the Kaggle files is pinned, so
+    # the Parquet files convert_to_parquet and KaggleDataset (pyarrow, see acquire.extract_to_parquet) write have the
+    # same types; other columns are inferred
+    SCHEMA_OVERRIDES = {
+        # transactions_train.csv
+        "t_dat": "DATE", "customer_id": "VARCHAR", "article_id": "VARCHAR", "price": "DOUBLE",
+        "sales_channel_id": "BIGINT",
+        # customers.csv
+        "FN": "DOUBLE", "Active": "DOUBLE", "club_member_status": "VARCHAR", "fashion_news_frequency": "VARCHAR",
+        "age": "BIGINT", "postal_code": "VARCHAR",
+        # articles.csv
+        "product_code": "BIGINT", "prod_name": "VARCHAR", "product_type_no": "BIGINT", "product_type_name": "VARCHAR",
+        "product_group_name": "VARCHAR", "graphical_appearance_no": "BIGINT", "graphical_appearance_name": "VARCHAR",
+        "colour_group_code": "BIGINT", "colour_group_name": "VARCHAR", "perceived_colour_value_id": "BIGINT",
+        "perceived_colour_value_name": "VARCHAR", "perceived_colour_master_id": "BIGINT",
+        "perceived_colour_master_name": "VARCHAR", "department_no": "BIGINT", "department_name": "VARCHAR",
+        "index_code": "VARCHAR", "index_name": "VARCHAR", "index_group_no": "BIGINT", "index_group_name": "VARCHAR",
+        "section_no": "BIGINT", "section_name": "VARCHAR", "garment_group_no": "BIGINT", "garment_group_name": "VARCHAR",
+        "detail_desc": "VARCHAR",
+    }
+    # Parquet files are written in this order so window queries on t_dat can skip row groups
+    SORT_KEYS = {"transactions": ["t_dat", "customer_id"], "customers": ["customer_id"], "articles": ["article_id"]}
+
+    def __init__(self, csv_path: str, csv_files: list, parquet_path: str = None, database: str = None):
+        '''
+        :param csv_path: directory with the Kaggle CSV files
+        :param csv_files: file names, the table name is derived from the file name
+        :param parquet_path: if given, each CSV is converted once to typed, sorted Parquet in this directory and the
+        tables are views over the Parquet files.  Otherwise the CSVs are read into sorted in-memory tables on every load.
+        :param database: optional DuckDB database file to persist the views in (default is in-memory)
+        '''
         self.path = csv_path
         self.files = csv_files
-        self.duckdb_conn = duckdb.connect()
+        self.parquet_path = parquet_path
+        self.fingerprints = {}
+        self.duckdb_conn = duckdb.connect(database) if database else duckdb.connect()
 
+    @profiling.profiled("load")
     def load(self):
         for file in self.files:
             print(f"Loading {self.path + file}")
             table = file.replace(".csv", "")
             # todo: filename is a bit quirky - hardcoded cleanup
             table = table.replace("_train", "")
-            self.load_file_into_view(self.path + file, table)
+            if self.parquet_path is None:
+                profiling.stage(f"load_{table}", lambda: self.load_file_into_view(self.path + file, table))
+            else:
+                profiling.stage(f"load_{table}", lambda: self.load_file_as_parquet_view(self.path + file, table))
         return self.duckdb_conn
 
     def load_file_into_view(self, filename: str, viewname: str):
@@ -77,13 +233,104 @@ class CSVDataset():
         # todo: more hardcoding
         polars_df = pl.read_csv(file_path, schema_overrides={"t_dat": pl.Date, "article_id": pl.Utf8})
 
-        # Register the Polars DataFrame as a DuckDB table
-        # DuckDB can directly use Polars objects without conversion
+        # Copy the Polars DataFrame into a native DuckDB table, sorted like the Parquet files: a registered frame is
+        # scanned in full by every query, a sorted table has per row group min / max of t_dat to skip on
+        order_by = ", ".join(key for key in CSVDataset.SORT_KEYS.get(viewname, []) if key in polars_df.columns)
+        self.duckdb_conn.register(viewname + "_df", polars_df)
+        self.duckdb_conn.execute(f"CREATE OR REPLACE TABLE {viewname} AS SELECT * FROM {viewname}_df"
+                                 + (f" ORDER BY {order_by}" if order_by else ""))
+        self.duckdb_conn.unregister(viewname + "_df")
+
+    @staticmethod
+    def file_fingerprint(filename: str, sample_bytes=1 << 20) -> str:
+        '''
+        Cheap fingerprint of a (large) file: size, modification time and a hash of the first and last megabyte.
+        '''
+        stat = os.stat(filename)
+        digest = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        with open(filename, "rb") as f:
+            digest.update(f.read(sample_bytes))
+            if stat.st_size > sample_bytes:
+                f.seek(max(stat.st_size - sample_bytes, sample_bytes))
+                digest.update(f.read(sample_bytes))
+        return digest.hexdigest()
+
+    # see sql.sql_string
+    sql_string = staticmethod(sql_string)
+
+    def convert_to_parquet(self, filename: str, parquet_file: str, table: str):
+        print(f"Converting {filename} to {parquet_file}")
+        columns = [row[0] for row in self.duckdb_conn.execute(
+            "DESCRIBE SELECT * FROM read_csv(?, header = true)", [filename]).fetchall()]
+        types = {column: CSVDataset.SCHEMA_OVERRIDES[column] for column in columns if column in CSVDataset.SCHEMA_OVERRIDES}
+        order_by = ", ".join(key for key in CSVDataset.SORT_KEYS.get(table, []) if key in columns)
+
+        # DuckDB streams the CSV and spills the sort to disk, so the table is never held in Python memory
+        tmp_file = parquet_file + ".tmp"
+        self.duckdb_conn.execute('''
+            COPY (SELECT * FROM read_csv({filename}, header = true{types}) {order_by})
+            TO {tmp_file} (FORMAT PARQUET, COMPRESSION ZSTD)
+        '''.format(filename=CSVDataset.sql_string(filename), types=f", types = {types}" if types else "", tmp_file=CSVDataset.sql_string(tmp_file),
+                   order_by=f"ORDER BY {order_by}" if order_by else ""))
+        os.replace(tmp_file, parquet_file)
+
+    def load_file_as_parquet_view(self, filename: str, viewname: str):
+        os.makedirs(self.parquet_path, exist_ok=True)
+        parquet_file = os.path.abspath(os.path.join(self.parquet_path, viewname + ".parquet"))
+        fingerprint_file = parquet_file + ".fingerprint"
+
+        if os.path.exists(filename):
+            fingerprint = CSVDataset.file_fingerprint(filename)
+            converted = None
+            if os.path.exists(parquet_file) and os.path.exists(fingerprint_file):
+                with open(fingerprint_file) as f:
+                    converted = f.read().strip()
+
+            if converted != fingerprint:
+                self.convert_to_parquet(filename, parquet_file, viewname)
+                with open(fingerprint_file, "w") as f:
+                    f.write(fingerprint)
+        elif os.path.exists(parquet_file) and os.path.exists(fingerprint_file):
+            # the CSV may have been removed to save space once converted
+            print(f"{filename} not found, using {parquet_file}")
+            with open(fingerprint_file) as f:
+                fingerprint = f.read().strip()
+        else:
+            raise FileNotFoundError(filename)
+
+        self.fingerprints[viewname] = fingerprint
+        self.create_parquet_view(viewname, parquet_file)
+
+    def create_parquet_view(self, viewname: str, parquet_file: str):
+        self.duckdb_conn.execute(
+            f"CREATE OR REPLACE VIEW {viewname} AS SELECT * FROM read_parquet({CSVDataset.sql_string(parquet_file)})")
+
+    @classmethod
+    def from_parquet(cls, parquet_files: dict, fingerprints: dict = None, database: str = None) -> 'CSVDataset':
+        '''
+        A dataset over Parquet files with no CSV behind them, e.g. those KaggleDataset extracts.  The tables are
+        views, as in Parquet mode, and ready to query - there is nothing for load() to do.
+        :param parquet_files: table name -> Parquet file
+        :param fingerprints: table name -> fingerprint of the data in the file, see fingerprint()
+        :param database: optional DuckDB database file to persist the views in (default is in-memory)
+        '''
+        dataset = cls(None, [], database=database)
+        for table, parquet_file in parquet_files.items():
+            dataset.create_parquet_view(table, os.path.abspath(parquet_file))
+        dataset.fingerprints.update(fingerprints or {})
+        return dataset
 
-        self.duckdb_conn.register(viewname, polars_df)
+    def fingerprint(self) -> str:
+        '''
+        Combined fingerprint of the loaded source files (Parquet mode only) ... e.g. for cache.QueryCache.  None when
+        nothing was fingerprinted (in memory mode), so callers fall back to their own change detection.
+        '''
+        if not self.fingerprints:
+            return None
+        return "|".join(f"{table}:{fingerprint}" for table, fingerprint in sorted(self.fingerprints.items()))
 
     def run_query(self, query: str) -> pl.DataFrame:
-        arrow_table = self.duckdb_conn.execute(query).fetch_arrow_table()
+        arrow_table = profiling.query(self.duckdb_conn, query, lambda: self.duckdb_conn.execute(query).fetch_arrow_table())
 
         # Convert the Arrow Table to a Polars DataFrame
         return pl.from_arrow(arrow_table)
@@ -1,15 +1,125 @@
-import scipy
-from sklearn.metrics import precision_recall_curve, f1_score, roc_auc_score, classification_report
+from sklearn.metrics import classification_report
 import numpy as np
-import scikitplot as skplt
+import polars as pl
 from typing import Optional
 
 
 
+def ranking_metrics(ground_truth: np.ndarray, scores: np.ndarray, top_k=(100_000,), n_bins=10) -> dict:
+    '''
+    The ranking metrics of one or many score vectors from a single sort per vector ... no per row Python.
+    :param ground_truth: 0/1 labels, shape (n,)
+    :param scores: shape (n,) or (n_models, n), higher = more likely to buy
+    :param top_k: buyers in the top k ranked customers, for each k
+    :param n_bins: number of lift bins (10 = deciles, 100 = percentiles)
+    :return: dict of arrays with one entry per score vector: auc, best_f1, threshold, buyers_top_<k>, and
+    bin_buyers with shape (n_models, n_bins).  Ties in score are ranked in input order for the top-k and bin counts.
+    '''
+    y = np.asarray(ground_truth).astype(np.int64)
+    scores = np.atleast_2d(np.asarray(scores, dtype=np.float64))
+    n = y.shape[0]
+    positives = y.sum()
+    if scores.shape[1] != n:
+        raise ValueError(f"Expected {n} scores per vector, got {scores.shape[1]}")
+    if positives == 0 or positives == n:
+        raise ValueError("Both classes are needed to evaluate a ranking")
+
+    order = np.argsort(-scores, axis=1, kind="stable")
+    sorted_scores = np.take_along_axis(scores, order, axis=1)
+    # cumulative buyers with a leading 0: buyers in the top k = cumulative[:, k]
+    cumulative = np.zeros((scores.shape[0], n + 1), dtype=np.int64)
+    np.cumsum(y[order], axis=1, out=cumulative[:, 1:])
+
+    # every distinct score is a threshold "score >= s"; its confusion counts are read at the last row of the score
+    predicted = np.arange(1, n + 1)
+    true_positives = cumulative[:, 1:]
+    false_positives = predicted - true_positives
+    last_of_score = np.ones_like(sorted_scores, dtype=bool)
+    last_of_score[:, :-1] = sorted_scores[:, :-1] != sorted_scores[:, 1:]
+
+    # AUC: trapezoids between consecutive thresholds, same value as roc_auc_score.  previous[:, i] is the last
+    # threshold row before i (-1 for the origin)
+    seen = np.maximum.accumulate(np.where(last_of_score, predicted - 1, -1), axis=1)
+    previous = np.concatenate([np.full((scores.shape[0], 1), -1), seen[:, :-1]], axis=1)
+    padded_tp = np.concatenate([true_positives, np.zeros((scores.shape[0], 1), dtype=np.int64)], axis=1)
+    padded_fp = np.concatenate([false_positives, np.zeros((scores.shape[0], 1), dtype=np.int64)], axis=1)
+    previous_tp = np.take_along_axis(padded_tp, previous, axis=1)
+    previous_fp = np.take_along_axis(padded_fp, previous, axis=1)
+    area = np.where(last_of_score, (false_positives - previous_fp) * (true_positives + previous_tp), 0)
+    auc = area.sum(axis=1) / (2 * positives * (n - positives))
+
+    # F1 = 2 TP / (P + predicted positive).  Ties in F1 go to the lowest threshold, as with argmax over
+    # precision_recall_curve
+    f1 = np.where(last_of_score, 2 * true_positives / (positives + predicted), -1.0)
+    best = n - 1 - np.argmax(f1[:, ::-1], axis=1)
+    rows = np.arange(scores.shape[0])
+
+    edges = (np.arange(n_bins + 1) * n) // n_bins
+    metrics = {
+        "auc": auc,
+        "best_f1": f1[rows, best],
+        "threshold": sorted_scores[rows, best],
+        "bin_buyers": np.diff(cumulative[:, edges], axis=1),
+    }
+    for k in top_k:
+        metrics[f"buyers_top_{k}"] = cumulative[:, min(k, n)]
+    return metrics
+
+
+def lift_table(ground_truth: np.ndarray, scores: np.ndarray, n_bins=10) -> pl.DataFrame:
+    '''
+    Decile (or percentile etc) lift and cumulative gains, bin 1 being the highest scores.
+    '''
+    buyers = ranking_metrics(ground_truth, scores, top_k=(), n_bins=n_bins)["bin_buyers"][0]
+    return bin_lift_table(buyers, len(ground_truth))
+
+
+def bin_lift_table(buyers: np.ndarray, n: int) -> pl.DataFrame:
+    # buyers per bin as computed by ranking_metrics, for n customers
+    n_bins = len(buyers)
+    customers = np.diff((np.arange(n_bins + 1) * n) // n_bins)
+    base_rate = buyers.sum() / n
+    cumulative_buyers = np.cumsum(buyers)
+    cumulative_customers = np.cumsum(customers)
+    return pl.DataFrame({
+        "bin": np.arange(1, n_bins + 1),
+        "customers": customers,
+        "buyers": buyers,
+        "response_rate": buyers / customers,
+        "lift": buyers / customers / base_rate,
+        "cumulative_buyers": cumulative_buyers,
+        "cumulative_gain": cumulative_buyers / buyers.sum(),
+        "cumulative_lift": cumulative_buyers / cumulative_customers / base_rate,
+    })
+
+
+def evaluate_many(ground_truth: np.ndarray, scores: np.ndarray, names: Optional[list] = None, top_k=(100_000,),
+                  n_bins=10) -> pl.DataFrame:
+    '''
+    Evaluate many score vectors (models, backtest folds, ...) against the same labels in one call.
+    :param scores: shape (n_models, n)
+    :param names: one per score vector, defaults to 0..n_models-1
+    :return: one row per score vector ... auc, best_f1, threshold, top_bin_lift, buyers_top_<k>
+    '''
+    metrics = ranking_metrics(ground_truth, scores, top_k=top_k, n_bins=n_bins)
+    y = np.asarray(ground_truth)
+    n = y.shape[0]
+    top_bin = n // n_bins
+    bin_buyers = metrics.pop("bin_buyers")
+    if names is None:
+        names = list(range(len(metrics["auc"])))
+    return pl.DataFrame({
+        "model": names,
+        **metrics,
+        "top_bin_lift": bin_buyers[:, 0] / top_bin / (y.sum() / n),
+        "top_bin_gain": bin_buyers[:, 0] / y.sum(),
+    })
+
+
 class Evaluator(object):
 
     def __init__(self, ground_truth: np.ndarray, probabilities: np.ndarray, predictions: Optional[np.ndarray]=None,
-                 threshold: Optional[float]=None):
+                 threshold: Optional[float]=None, top_k: int = 100_000, n_bins: int = 10):
         '''
         This will print out the common evaluation metrics for binary classification.  This is not written (or at least tested)
         to support multi-class classification (todo: future enhancement perhaps).
@@ -17,41 +127,46 @@ class Evaluator(object):
         :param probabilities: array of probabilities ... supports both just positive class and both positive and negative class
         :param predictions: if provided, the predicted class
         :param threshold: if provided, the cut off used to make the predictions
+        :param top_k: report the number of buyers in the top_k ranked customers
+        :param n_bins: number of bins of the lift table (10 = deciles)
         '''
-        self.ground_truth = ground_truth
-        self.predictions = predictions
+        self.ground_truth = np.asarray(ground_truth)
+        probabilities = np.asarray(probabilities)
 
-        if type(probabilities[0]) == np.ndarray:
+        if probabilities.ndim == 2:
             self.positive_class_probabilities = probabilities[:,1]
             self.negative_class_probabilities = probabilities[:,0]
             self.probabilities = probabilities
         else:
-            # todo: revist this ... but first check the class of output
             self.positive_class_probabilities = probabilities
             self.negative_class_probabilities = 1 - probabilities
             self.probabilities = np.stack((self.negative_class_probabilities, self.positive_class_probabilities), axis=1)
 
+        # one sort gives AUC, the best F1 threshold, top-k buyers and the lift bins
+        self.top_k = top_k
+        self.n_bins = n_bins
+        metrics = ranking_metrics(self.ground_truth, self.positive_class_probabilities, top_k=(top_k,), n_bins=n_bins)
+        self.auc = metrics["auc"][0]
+        self.buyers_in_top_k = int(metrics[f"buyers_top_{top_k}"][0])
+        self.lift_table = bin_lift_table(metrics["bin_buyers"][0], len(self.ground_truth))
 
         if threshold is not None:
             self.optimal_threshold = threshold
         else: # compute the optimal threshold if not given
-            precision, recall, thresholds = precision_recall_curve(self.ground_truth, self.positive_class_probabilities)
-            f1_scores = 2 * (precision * recall) / (precision + recall + 1e-10)
-            self.optimal_threshold = round(thresholds[np.argmax(f1_scores)],2)
+            self.optimal_threshold = round(metrics["threshold"][0],2)
             print(f"Computing optimal Threshold: {self.optimal_threshold}")
 
         if predictions is not None:
-            self.predictions = predictions
+            self.predictions = np.asarray(predictions)
         else:
-            print("Computing predictions...")
-            self.predictions = [1 if prob >= self.optimal_threshold else 0 for prob in self.positive_class_probabilities]
-
-        self.auc = roc_auc_score(self.ground_truth, self.positive_class_probabilities)
-        self.f1_score = round(f1_score(self.ground_truth, self.predictions,labels=None, pos_label=1,
-                                 average='binary', sample_weight=None, zero_division='warn'),2)
+            self.predictions = (self.positive_class_probabilities >= self.optimal_threshold).astype(np.int64)
 
+        true_positives = np.sum((self.predictions == 1) & (self.ground_truth == 1))
+        denominator = np.sum(self.predictions == 1) + np.sum(self.ground_truth == 1)
+        self.f1_score = round(2 * true_positives / denominator if denominator else 0.0, 2)
 
     def get_confusion_matrix(self, title='Confusion matrix'):
+        import scikitplot as skplt
 
         return skplt.metrics.plot_confusion_matrix(self.ground_truth, self.predictions, normalize=False,
                                                    title = title)
@@ -65,17 +180,21 @@ class Evaluator(object):
         return classification_report(self.ground_truth, self.predictions)
 
     def plot_roc(self, title='ROC'):
-        # print(type(self.probabilities))
-        # print(self.probabilities)
+        import scikitplot as skplt
+
         skplt.metrics.plot_roc(self.ground_truth, self.probabilities, title=title)
 
     def display_results(self, dataset_title='Test Dataset'):
 
+        top_bin = self.lift_table.row(0, named=True)
         print(f"AUC: {self.auc:.3f}")
         print(f"Optimal Threshold: {self.optimal_threshold}")
         print(f"Maximum F1 Score: {self.f1_score}")
+        print(f"Buyers in top {self.top_k:,}: {self.buyers_in_top_k:,}")
+        print(f"Buyers in top {100 // self.n_bins}%: {top_bin['cumulative_gain']:.0%} (lift {top_bin['lift']:.1f})")
 
         print(self.get_classification_report())
+        print(self.lift_table)
         self.plot_confusion_matrix()
         self.plot_roc()
 
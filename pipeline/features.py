@@ -1,9 +1,16 @@
 from datetime import date, timedelta
 
+import re
+
 import polars as pl
 import duckdb
 from functools import reduce
 
+from articles import ArticleDimension
+from cube import DailyCube
+from frames import compact_frame
+import profiling
+
 class QueryConstants:
     def __init__(self, end_date, response_duration=0, additional_offest=0, feature_duration=365):
         self.end_date = end_date
@@ -27,7 +34,31 @@ class Features:
         GROUP BY t.customer_id
     '''
 
-    def __init__(self, query_constants: QueryConstants):
+    # row level query with the article dimension joined, for the product features - its rows as of feature_end, so
+    # no price from after the feature window is used
+    ARTICLE_FEATURE_QUERY = BASE_FEATURE_QUERY.replace(
+        "INNER JOIN customers c",
+        "LEFT JOIN " + ArticleDimension.TABLE + " a ON a.article_id = t.article_id AND a.as_of = DATE '{feature_end}'"
+        "\n        INNER JOIN customers c")
+
+    # (index_group_no, name) of the H&M index groups
+    INDEX_GROUPS = [(1, "ladieswear"), (2, "divided"), (3, "menswear"), (4, "children"), (26, "sport")]
+
+    # (name, months of the year)
+    SEASONS = [("winter", (12, 1, 2)), ("spring", (3, 4, 5)), ("summer", (6, 7, 8)), ("autumn", (9, 10, 11))]
+
+    # a purchase at least this far below the article's median price counts as discounted
+    DISCOUNT_THRESHOLD = 0.1
+
+    # (offset_name, offset_length) of the windows in get_time_sliced_overlap, all ending at feature_end
+    OVERLAP_WINDOWS = [("week", 7), ("two_week", 14), ("month", 28), ("two_month", 2*28), ("quarter", 28*3),
+                       ("half", 28*6), ("year", 28*13)]
+
+    # same query against the (customer_id, t_dat, sales_channel_id) rollup - see cube.DailyCube
+    DAILY_FEATURE_QUERY = BASE_FEATURE_QUERY.replace("FROM transactions t", "FROM " + DailyCube.TABLE + " t")
+
+    def __init__(self, query_constants: QueryConstants, use_daily_cube=False, data_fingerprint=None,
+                 product_features=False, season_features=False, revenue_half_life=None):
         self.end_date = query_constants.end_date
         self.feature_duration = query_constants.feature_duration
         self.response_duration = query_constants.response_duration
@@ -38,15 +69,69 @@ class Features:
         self.response_start = self.feature_end # yes both the same ... must be careful!
         self.feature_start = self.feature_end - timedelta(days=self.feature_duration)
 
+        # compute the features from the daily rollup instead of row level transactions.  data_fingerprint (e.g.
+        # CSVDataset.fingerprint()) is what the rollup is checked against for staleness
+        self.use_daily_cube = use_daily_cube
+        self.data_fingerprint = data_fingerprint
+        self.cube_checked_conn = None
+
+        # optional feature groups, see product_feature_sql and season_feature_sql.  The product features need the
+        # article of each row, which the daily rollup has summed away
+        if product_features and use_daily_cube:
+            raise ValueError("product_features need row level transactions, not the daily cube")
+        self.product_features = product_features
+        self.season_features = season_features
+        self.articles_checked_conn = None
+
+        # days after which a response window purchase counts half towards the decayed_revenue regression target,
+        # None for the binary label only
+        self.revenue_half_life = revenue_half_life
+
+    def ensure_daily_cube(self, duckdb_session):
+        # freshness is checked once per connection, not once per feature group
+        if self.cube_checked_conn is not duckdb_session:
+            profiling.stage("daily_cube", lambda: DailyCube.ensure(duckdb_session, self.data_fingerprint))
+            self.cube_checked_conn = duckdb_session
+
+    def ensure_article_dimension(self, duckdb_session):
+        if self.articles_checked_conn is not duckdb_session:
+            profiling.stage("article_dimension", lambda: ArticleDimension.ensure(duckdb_session, self.feature_end,
+                                                                                 self.data_fingerprint))
+            self.articles_checked_conn = duckdb_session
+
+    def feature_query(self, duckdb_session) -> str:
+        '''
+        The query template the feature groups are dropped into.  In daily cube mode this also builds or refreshes the
+        cube, so the first call on a new dataset pays for the rollup once - the same goes for the article dimension
+        with product features.
+        '''
+        if self.use_daily_cube:
+            self.ensure_daily_cube(duckdb_session)
+            return Features.DAILY_FEATURE_QUERY
+        if self.product_features:
+            self.ensure_article_dimension(duckdb_session)
+            return Features.ARTICLE_FEATURE_QUERY
+        return Features.BASE_FEATURE_QUERY
+
+    # optional cache.QueryCache in front of every feature query, e.g. Features.query_cache = QueryCache('../cache')
+    query_cache = None
+
     @staticmethod
     def run_query(duckdb_conn, query: str) -> pl.DataFrame:
+        if Features.query_cache is not None:
+            return profiling.query(duckdb_conn, query,
+                                   lambda: Features.query_cache.get_or_run(duckdb_conn, query, Features.execute_query))
+        return profiling.query(duckdb_conn, query, lambda: Features.execute_query(duckdb_conn, query))
+
+    @staticmethod
+    def execute_query(duckdb_conn, query: str) -> pl.DataFrame:
         arrow_table = duckdb_conn.execute(query).fetch_arrow_table()
         # Convert the Arrow Table to a Polars DataFrame
         return pl.from_arrow(arrow_table)
 
     @staticmethod
     def time_slice_feature_sql(offset_length: int, offset_name: str, end_interval, feature_end='{feature_end}',
-                               start_interval=1, sales_channel_id=0):
+                               start_interval=1, sales_channel_id=0, daily=False):
         '''
         This is a helper utility to general bocks of SQL.   This can be run manually or incorporated into the full query creation.
         :param offset_length: Number of days
@@ -54,6 +139,8 @@ class Features:
         :param end_interval: How many time slices needed + start_interval - 1
         :param feature_end: Likely keep the default value as this is parameterized for use for time shifting
         :param start_interval: Default is 1 ... can change if you want, for example, only the second half of a year
+        :param sales_channel_id: 1 or 2 to restrict to a channel, anything else for all channels
+        :param daily: generate SQL for the daily rollup (cube.DailyCube) rather than row level transactions
         :return:
         '''
 
@@ -76,6 +163,29 @@ class Features:
                         as revenue_channel_{channel}_{offset_name}_{i}
             """
 
+        if daily:
+            # one row per customer, day and channel: items and price are pre-summed and a day is counted once
+            # through first_of_day (or once per channel row when filtering on a channel).  price_sum is a DECIMAL,
+            # summed exactly and only converted to DOUBLE at the end
+            block = """
+                ,SUM(CASE WHEN t.t_dat > DATE '{feature_end}' - INTERVAL ({offset_length}*{i}) DAY AND t.t_dat <= DATE '{feature_end}' - INTERVAL ({offset_length}*({i} - 1)) DAY THEN t.item_count ELSE 0 END)
+                    as t_count_{offset_name}_{i}
+                ,COUNT(CASE WHEN t.first_of_day AND t.t_dat > DATE '{feature_end}' - INTERVAL ({offset_length}*{i}) DAY AND t.t_dat <= DATE '{feature_end}' - INTERVAL ({offset_length}*({i} - 1)) DAY THEN 1 ELSE NULL END)
+                    as ti_count_{offset_name}_{i}
+                ,CAST(590*SUM(CASE WHEN t.t_dat > DATE '{feature_end}' - INTERVAL ({offset_length}*{i}) DAY AND t.t_dat <= DATE '{feature_end}' - INTERVAL ({offset_length}*({i} - 1)) DAY THEN t.price_sum ELSE 0 END) AS DOUBLE)
+                    as revenue_{offset_name}_{i}
+            """
+
+            if sales_channel_id in (1,2):
+                block = """
+                    ,SUM(CASE WHEN t.sales_channel_id = {channel} AND t.t_dat > DATE '{feature_end}' - INTERVAL ({offset_length}*{i}) DAY AND t.t_dat <= DATE '{feature_end}' - INTERVAL ({offset_length}*({i} - 1)) DAY THEN t.item_count ELSE 0 END)
+                        as t_count_channel_{channel}_{offset_name}_{i}
+                    ,COUNT(CASE WHEN t.sales_channel_id = {channel} AND t.t_dat > DATE '{feature_end}' - INTERVAL ({offset_length}*{i}) DAY AND t.t_dat <= DATE '{feature_end}' - INTERVAL ({offset_length}*({i} - 1)) DAY THEN 1 ELSE NULL END)
+                        as ti_count_channel_{channel}_{offset_name}_{i}
+                    ,CAST(590*SUM(CASE WHEN t.sales_channel_id = {channel} AND t.t_dat > DATE '{feature_end}' - INTERVAL ({offset_length}*{i}) DAY AND t.t_dat <= DATE '{feature_end}' - INTERVAL ({offset_length}*({i} - 1)) DAY THEN t.price_sum ELSE 0 END) AS DOUBLE)
+                        as revenue_channel_{channel}_{offset_name}_{i}
+                """
+
         result = []
         for i in range(start_interval, end_interval + 1):
             if sales_channel_id in (1,2):
@@ -85,8 +195,18 @@ class Features:
 
         return "\n".join(result)
 
-    def get_base_features(self, duckdb_session) -> [str, pl.DataFrame]:
-        base_sql = '''
+    def base_feature_sql(self) -> str:
+        if self.use_daily_cube:
+            return '''
+            ,ROUND(CAST(590*SUM(t.price_sum) AS DOUBLE)) as total_revenue
+            ,CAST(SUM(t.item_count) AS BIGINT) as total_items
+            ,COUNT(CASE WHEN t.first_of_day THEN 1 ELSE NULL END) as total_transactions
+            ,DATE '{feature_end}'  - MAX(t.t_dat) as days_since_last
+            ,DATE '{feature_end}' - MIN(t.t_dat) as days_since_first
+            ,MAX(t.t_dat) - MIN(t.t_dat) as days_tenure
+        '''.format(feature_end=self.feature_end)
+
+        return '''
             ,ROUND(590*SUM(price)) as total_revenue
             ,COUNT(1) as total_items
             ,COUNT(DISTINCT t_dat) as total_transactions
@@ -95,14 +215,19 @@ class Features:
             ,MAX(t.t_dat) - MIN(t.t_dat) as days_tenure
         '''.format(feature_end=self.feature_end)
 
-        complete_sql = Features.BASE_FEATURE_QUERY.format(feature_sql=base_sql, feature_start=self.feature_start,
+    @profiling.profiled("base_features")
+    def get_base_features(self, duckdb_session) -> [str, pl.DataFrame]:
+        complete_sql = self.feature_query(duckdb_session).format(feature_sql=self.base_feature_sql(), feature_start=self.feature_start,
                                                           feature_end=self.feature_end)
 
-        # print(complete_sql)
-
         return complete_sql, Features.run_query(duckdb_session, complete_sql)
 
+    @profiling.profiled("label")
     def get_response_label(self, duckdb_session) -> [str, pl.DataFrame]:
+        '''
+        The label on its own, over the whole of transactions.  get_all_features_and_response computes it in the same
+        pass as the features instead (see labelled_feature_query) - this is the reference it is tested against.
+        '''
         response_query = """
                 SELECT
                     t.customer_id,
@@ -111,83 +236,145 @@ class Features:
                             WHEN t.t_dat > DATE '{response_start}'  AND t.t_dat <= DATE '{response_end}'  THEN 1
                             ELSE 0
                         END
-                    ) AS label
+                    ) AS label{targets}
                 FROM transactions t
                 INNER JOIN customers c ON c.customer_id = t.customer_id
                 GROUP BY t.customer_id
         """
 
-        response_query = response_query.format(response_start=self.response_start, response_end=self.response_end)
-        return response_query, Features.run_query(duckdb_session, response_query)
-
+        targets = ""
+        if self.revenue_half_life is not None:
+            targets = """
+                    ,SUM(CASE WHEN t.t_dat > DATE '{response_start}' AND t.t_dat <= DATE '{response_end}' THEN {decayed} ELSE 0 END)
+                        AS decayed_revenue""".format(response_start=self.response_start, response_end=self.response_end,
+                                                     decayed=self.decayed_revenue_sql(daily=False))
 
-    def get_time_sliced_overlap(self, duckdb_session, sales_channel_id=0) -> [str, pl.DataFrame]:
-        week_sql = Features.time_slice_feature_sql(offset_length=7, offset_name="week", end_interval=1,
-                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id)
-        two_week_sql = Features.time_slice_feature_sql(offset_length=14, offset_name="two_week", end_interval=1,
-                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id)
-        month_sql = Features.time_slice_feature_sql(offset_length=28, offset_name="month", end_interval=1,
-                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id)
-        two_month_sql = Features.time_slice_feature_sql(offset_length=2*28, offset_name="two_month", end_interval=1,
-                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id)
-
-        quarter_sql = Features.time_slice_feature_sql(offset_length=28*3, offset_name="quarter", end_interval=1,
-                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id)
+        response_query = response_query.format(response_start=self.response_start, response_end=self.response_end,
+                                               targets=targets)
+        return response_query, Features.run_query(duckdb_session, response_query)
 
-        half_year = Features.time_slice_feature_sql(offset_length=28*6, offset_name="half", end_interval=1,
-                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id)
+    def decayed_revenue_sql(self, daily: bool) -> str:
+        # revenue of a response window row, halved every revenue_half_life days after the first day of the window
+        revenue = "590*CAST(t.price_sum AS DOUBLE)" if daily else "590*t.price"
+        return "{revenue}*POW(0.5, (t.t_dat - DATE '{response_start}' - 1)/{half_life})".format(
+            revenue=revenue, response_start=self.response_start, half_life=float(self.revenue_half_life))
+
+    LABELLED_FEATURE_QUERY = '''
+        WITH scanned AS MATERIALIZED (
+            SELECT {columns} FROM {source} t
+            WHERE t.t_dat > DATE '{{feature_start}}' AND t.t_dat <= DATE '{response_end}'
+        ), features AS (
+            {feature_query}
+        ), labels AS (
+            SELECT t.customer_id, 1 AS label{targets}
+            FROM scanned t
+            WHERE t.t_dat > DATE '{{feature_end}}'
+            GROUP BY t.customer_id
+        )
+        SELECT f.*, COALESCE(l.label, 0) AS label{target_columns}
+        FROM features f
+        LEFT JOIN labels l ON l.customer_id = f.customer_id
+    '''
 
-        full_year = Features.time_slice_feature_sql(offset_length=28*13, offset_name="year", end_interval=1,
-                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id)
+    # the columns of transactions / the daily cube the feature groups and the label read - all that the scan buffers
+    SCANNED_COLUMNS = ["customer_id", "t_dat", "sales_channel_id", "price"]
+    DAILY_SCANNED_COLUMNS = ["customer_id", "t_dat", "sales_channel_id", "item_count", "price_sum", "first_of_day"]
 
-        inner_sql = "\n".join([week_sql, two_week_sql, month_sql, two_month_sql, quarter_sql, half_year,full_year])
+    def labelled_feature_query(self, base_query: str) -> str:
+        '''
+        base_query extended with the label (and decayed_revenue) in the same pass: transactions are read once for the
+        feature and response windows together - only those dates, so a table sorted by t_dat skips the rest - the
+        features aggregate the feature window rows and the labels the response window rows of that one scan.  Only the
+        columns the feature groups read (SCANNED_COLUMNS) are buffered between the two.
+
+        Same rows and values as joining get_all_features to get_response_label: features exist for customers with a
+        purchase in the feature window, and those without a response window purchase get label 0.
+        :param base_query: the template of the mode, e.g. BASE_FEATURE_QUERY
+        '''
+        source = DailyCube.TABLE if self.use_daily_cube else "transactions"
+        columns = Features.DAILY_SCANNED_COLUMNS if self.use_daily_cube else Features.SCANNED_COLUMNS
+        if self.product_features:
+            columns = columns + ["article_id"]
+        targets = target_columns = ""
+        if self.revenue_half_life is not None:
+            targets = ", SUM({}) AS decayed_revenue".format(self.decayed_revenue_sql(self.use_daily_cube))
+            target_columns = ", COALESCE(l.decayed_revenue, 0) AS decayed_revenue"
+        return Features.LABELLED_FEATURE_QUERY.format(
+            source=source, columns=", ".join("t." + column for column in columns), response_end=self.response_end, targets=targets, target_columns=target_columns,
+            feature_query=base_query.replace("FROM " + source + " t", "FROM scanned t"))
+
+
+    def time_sliced_overlap_sql(self, sales_channel_id=0) -> str:
+        return "\n".join(Features.time_slice_feature_sql(offset_length=offset_length, offset_name=offset_name, end_interval=1,
+                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id, daily=self.use_daily_cube)
+                for offset_name, offset_length in Features.OVERLAP_WINDOWS)
+
+    @profiling.profiled("time_sliced_overlap")
+    def get_time_sliced_overlap(self, duckdb_session, sales_channel_id=0) -> [str, pl.DataFrame]:
+        inner_sql = self.time_sliced_overlap_sql(sales_channel_id)
 
-        complete_sql = Features.BASE_FEATURE_QUERY.format(feature_sql=inner_sql, feature_start=self.feature_start, feature_end=self.feature_end)
+        complete_sql = self.feature_query(duckdb_session).format(feature_sql=inner_sql, feature_start=self.feature_start, feature_end=self.feature_end)
 
         return complete_sql, Features.run_query(duckdb_session, complete_sql)
 
 
-    def get_time_sliced_no_overlap(self, duckdb_session, sales_channel_id=0) -> [str, pl.DataFrame]:
+    def time_sliced_no_overlap_sql(self, sales_channel_id=0) -> str:
         week_sql = Features.time_slice_feature_sql(offset_length=7, offset_name="week", end_interval=2,
-                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id)
+                feature_end=self.feature_end, start_interval=1, sales_channel_id=sales_channel_id, daily=self.use_daily_cube)
         two_week_sql = Features.time_slice_feature_sql(offset_length=14, offset_name="two_week", end_interval=2,
-                feature_end=self.feature_end, start_interval=2, sales_channel_id=sales_channel_id)
+                feature_end=self.feature_end, start_interval=2, sales_channel_id=sales_channel_id, daily=self.use_daily_cube)
         month_sql = Features.time_slice_feature_sql(offset_length=28, offset_name="month", end_interval=3,
-                feature_end=self.feature_end, start_interval=2, sales_channel_id=sales_channel_id)
+                feature_end=self.feature_end, start_interval=2, sales_channel_id=sales_channel_id, daily=self.use_daily_cube)
 
         quarter_sql = Features.time_slice_feature_sql(offset_length=28*3, offset_name="quarter", end_interval=2,
-                feature_end=self.feature_end, start_interval=2, sales_channel_id=sales_channel_id)
+                feature_end=self.feature_end, start_interval=2, sales_channel_id=sales_channel_id, daily=self.use_daily_cube)
 
         half_year = Features.time_slice_feature_sql(offset_length=28*6, offset_name="half", end_interval=2,
-                feature_end=self.feature_end, start_interval=2, sales_channel_id=sales_channel_id)
+                feature_end=self.feature_end, start_interval=2, sales_channel_id=sales_channel_id, daily=self.use_daily_cube)
 
         earliest_month = Features.time_slice_feature_sql(offset_length=28, offset_name="month", end_interval=13,
-                feature_end=self.feature_end, start_interval=13, sales_channel_id=sales_channel_id)
+                feature_end=self.feature_end, start_interval=13, sales_channel_id=sales_channel_id, daily=self.use_daily_cube)
+
+        return "\n".join([week_sql, two_week_sql, month_sql, quarter_sql, half_year,earliest_month])
 
-        inner_sql = "\n".join([week_sql, two_week_sql, month_sql, quarter_sql, half_year,earliest_month])
+    @profiling.profiled("time_sliced_no_overlap")
+    def get_time_sliced_no_overlap(self, duckdb_session, sales_channel_id=0) -> [str, pl.DataFrame]:
+        inner_sql = self.time_sliced_no_overlap_sql(sales_channel_id)
 
-        complete_sql = Features.BASE_FEATURE_QUERY.format(feature_sql=inner_sql, feature_start=self.feature_start, feature_end=self.feature_end)
+        complete_sql = self.feature_query(duckdb_session).format(feature_sql=inner_sql, feature_start=self.feature_start, feature_end=self.feature_end)
 
         return complete_sql, Features.run_query(duckdb_session, complete_sql)
 
+    def time_sliced_months_sql(self) -> str:
+        return Features.time_slice_feature_sql(offset_length=28, offset_name="month", end_interval=13,
+                feature_end=self.feature_end, start_interval=1, daily=self.use_daily_cube)
+
+    @profiling.profiled("time_sliced_months")
     def get_time_sliced_months(self, duckdb_session) -> [str, pl.DataFrame]:
-        months =  Features.time_slice_feature_sql(offset_length=28, offset_name="month", end_interval=13,
-                feature_end=self.feature_end, start_interval=1)
+        months = self.time_sliced_months_sql()
 
-        complete_sql = Features.BASE_FEATURE_QUERY.format(feature_sql=months, feature_start=self.feature_start, feature_end=self.feature_end)
+        complete_sql = self.feature_query(duckdb_session).format(feature_sql=months, feature_start=self.feature_start, feature_end=self.feature_end)
 
         return complete_sql, Features.run_query(duckdb_session, complete_sql)
 
-    def get_customer_features(self, duckdb_session) -> [str, pl.DataFrame]:
+    def customer_feature_sql(self) -> str:
         '''
         These features are, for the most part, useless.  I round the percent by channel as otherwise a tree algorithm
         can figure out a rough number of transaction items which is contained in the RFM features.
+        '''
 
-        :param duckdb_session:
-        :return:
+        if self.use_daily_cube:
+            return '''
+            ,ROUND(ROUND(CAST(590*SUM(t.price_sum) AS DOUBLE))/COUNT(CASE WHEN t.first_of_day THEN 1 ELSE NULL END)) as aov
+            ,MAX(CASE WHEN COALESCE(c.active,0) = 1 THEN 1 ELSE 0 END) AS customer_active
+            ,MAX(COALESCE(c.fashion_news_frequency, 'Empty')) AS customer_fashion_news_frequency
+            ,MAX(CASE WHEN COALESCE(c.FN,0) = 1 THEN 1 ELSE 0 END) AS customer_fn
+            ,ROUND(COUNT(CASE WHEN t.sales_channel_id = 1 THEN 1 ELSE NULL END)/COUNT(CASE WHEN t.first_of_day THEN 1 ELSE NULL END),0) AS primary_sales_channel_01
+            ,ROUND(COUNT(CASE WHEN t.sales_channel_id = 2 THEN 1 ELSE NULL END)/COUNT(CASE WHEN t.first_of_day THEN 1 ELSE NULL END),0) AS primary_sales_channel_02
+            ,MAX(COALESCE(c.age,-1)) as age
         '''
 
-        customer_sql = '''
+        return '''
             ,ROUND(ROUND(590*SUM(price))/COUNT(DISTINCT t.t_dat)) as aov
             ,MAX(CASE WHEN COALESCE(c.active,0) = 1 THEN 1 ELSE 0 END) AS customer_active
             ,MAX(COALESCE(c.fashion_news_frequency, 'Empty')) AS customer_fashion_news_frequency
@@ -197,22 +384,85 @@ class Features:
             ,MAX(COALESCE(c.age,-1)) as age
         '''
 
-        complete_sql = Features.BASE_FEATURE_QUERY.format(feature_sql=customer_sql, feature_start=self.feature_start,
+    @profiling.profiled("customer_features")
+    def get_customer_features(self, duckdb_session) -> [str, pl.DataFrame]:
+        '''
+        See customer_feature_sql.
+
+        :param duckdb_session:
+        :return:
+        '''
+
+        complete_sql = self.feature_query(duckdb_session).format(feature_sql=self.customer_feature_sql(), feature_start=self.feature_start,
                                                           feature_end=self.feature_end)
 
         return complete_sql, Features.run_query(duckdb_session, complete_sql)
 
-    def get_all_features_and_response(self, duckdb_connection) -> pl.DataFrame:
-
-        f = self.get_all_features(duckdb_connection)
-        s, r = self.get_response_label(duckdb_connection)
+    @profiling.profiled("features_and_response")
+    def get_all_features_and_response(self, duckdb_connection, compact=False, single_pass=True) -> pl.DataFrame:
+        '''
+        :param compact: narrow the dtypes, see get_all_features
+        :param single_pass: features and label in one query over the feature and response windows (see
+        labelled_feature_query).  False joins get_all_features to the separate get_response_label query, a
+        second full scan of transactions.
+        :return: the features, label and - with a revenue_half_life - decayed_revenue
+        '''
+        if single_pass:
+            # builds the daily cube / article dimension the plan reads from
+            self.feature_query(duckdb_connection)
+            plan = self.get_feature_plan()
+            plan.base_query = self.labelled_feature_query(plan.base_query)
+            q, result = profiling.stage("feature_plan", lambda: plan.run(duckdb_connection))
+        else:
+            f = self.get_all_features(duckdb_connection)
+            s, r = self.get_response_label(duckdb_connection)
+            result = profiling.stage("join", lambda: f.join(r, on="customer_id", how="inner"))
+        return profiling.stage("compact", lambda: compact_frame(result)) if compact else result
 
-        return f.join(r, on="customer_id", how="inner")
 
 
 
+    def get_feature_plan(self, base_query=None) -> 'FeaturePlan':
+        '''
+        The feature groups used by get_all_features, compiled into a single aggregation.
+        :param base_query: defaults to the query for the current mode (row level or daily cube)
+        :return: a FeaturePlan ... call compile() to see the SQL or run() to execute it
+        '''
+        if base_query is None:
+            if self.use_daily_cube:
+                base_query = Features.DAILY_FEATURE_QUERY
+            elif self.product_features:
+                base_query = Features.ARTICLE_FEATURE_QUERY
+            else:
+                base_query = Features.BASE_FEATURE_QUERY
+
+        plan = FeaturePlan(base_query, feature_start=self.feature_start, feature_end=self.feature_end)
+        plan.add(self.time_sliced_overlap_sql(sales_channel_id=1))
+        plan.add(self.time_sliced_overlap_sql(sales_channel_id=2))
+        plan.add(self.customer_feature_sql())
+        plan.add(self.base_feature_sql())
+        if self.season_features:
+            plan.add(self.season_feature_sql())
+        if self.product_features:
+            plan.add(self.product_feature_sql())
+        return plan
+
+    @profiling.profiled("features")
+    def get_all_features(self, duckdb_connection, single_pass=True, compact=False) -> pl.DataFrame:
+        '''
+        :param duckdb_connection:
+        :param single_pass: True runs every feature group in one scan of transactions (see FeaturePlan).  False is the
+        original approach - one query per group and the results joined in Polars.  Same columns either way.
+        :param compact: narrowest integer types, float32 and a Categorical customer_id (see frames.compact_frame) -
+        a fraction of the memory, but the values are no longer bit for bit those of the query
+        :return:
+        '''
+        if single_pass:
+            # builds the daily cube / article dimension the plan reads from
+            self.feature_query(duckdb_connection)
+            q, result = profiling.stage("feature_plan", lambda: self.get_feature_plan().run(duckdb_connection))
+            return profiling.stage("compact", lambda: compact_frame(result)) if compact else result
 
-    def get_all_features(self, duckdb_connection) -> pl.DataFrame:
         # Sample DataFrames
         q, df1 = self.get_time_sliced_overlap(duckdb_connection, 1)
         q, df2 = self.get_time_sliced_overlap(duckdb_connection, 2)
@@ -223,15 +473,120 @@ class Features:
 
         # List of DataFrames to join
         dfs = [df1, df2, df4, df5]
+        if self.season_features:
+            dfs.append(self.get_season_features(duckdb_connection)[1])
+        if self.product_features:
+            dfs.append(self.get_product_features(duckdb_connection)[1])
 
         # Joining multiple DataFrames on the same column
-        result = reduce(lambda left, right: left.join(right, on="customer_id", how="inner"), dfs)
+        result = profiling.stage("join", lambda: reduce(lambda left, right: left.join(right, on="customer_id", how="inner"), dfs))
 
-        return result
+        return profiling.stage("compact", lambda: compact_frame(result)) if compact else result
 
-    def get_season_features(self) -> pl.DataFrame:
-        pass
+    def response_season(self) -> str:
+        # season of the middle of the response window
+        middle = self.feature_end + timedelta(days=max(self.response_duration, 1) / 2)
+        return next(name for name, months in Features.SEASONS if middle.month in months)
 
-    def get_product_features(self) -> pl.DataFrame:
-        pass
+    def season_feature_sql(self) -> str:
+        '''
+        Share of the customer's items bought in each season of the year - a histogram over the month of purchase,
+        filled in the same aggregation as everything else - and the affinity for the season the response window
+        falls in: its share relative to an even spread, so 1 is indifferent and 4 buys in that season only.
+        '''
+        items = "t.item_count" if self.use_daily_cube else "1"
+        share = "SUM(CASE WHEN MONTH(t.t_dat) IN ({months}) THEN {items} ELSE 0 END)/SUM({items})"
+        result = []
+        for name, months in Features.SEASONS:
+            result.append("            ,{share} AS season_share_{name}".format(
+                share=share.format(months=", ".join(map(str, months)), items=items), name=name))
 
+        months = dict(Features.SEASONS)[self.response_season()]
+        result.append("            ,4*{share} AS season_affinity".format(
+            share=share.format(months=", ".join(map(str, months)), items=items)))
+        return "\n".join(result)
+
+    @profiling.profiled("season_features")
+    def get_season_features(self, duckdb_session) -> [str, pl.DataFrame]:
+        complete_sql = self.feature_query(duckdb_session).format(feature_sql=self.season_feature_sql(),
+                                                                 feature_start=self.feature_start,
+                                                                 feature_end=self.feature_end)
+
+        return complete_sql, Features.run_query(duckdb_session, complete_sql)
+
+    def product_feature_sql(self) -> str:
+        '''
+        Category mix and price sensitivity from the article dimension (articles.ArticleDimension), joined as "a":
+        share of items per index group, breadth of product types and groups, the average price band, the share of
+        items in the dearest band and how far below the article's median price the customer tends to buy.
+        '''
+        result = ["            ,SUM(CASE WHEN a.index_group_no = {no} THEN 1 ELSE 0 END)/COUNT(1) AS index_group_share_{name}"
+                  .format(no=no, name=name) for no, name in Features.INDEX_GROUPS]
+        result.append('''
+            ,COUNT(DISTINCT a.product_type_no) AS product_type_count
+            ,COUNT(DISTINCT a.product_group_code) AS product_group_count
+            ,AVG(a.price_band) AS avg_price_band
+            ,SUM(CASE WHEN a.price_band = {top_band} THEN 1 ELSE 0 END)/COUNT(1) AS premium_share
+            ,AVG(t.price/a.median_price - 1) AS avg_price_vs_median
+            ,SUM(CASE WHEN t.price <= (1 - {threshold})*a.median_price THEN 1 ELSE 0 END)/COUNT(1) AS discount_share
+        '''.format(top_band=ArticleDimension.PRICE_BANDS, threshold=Features.DISCOUNT_THRESHOLD))
+        return "\n".join(result)
+
+    @profiling.profiled("product_features")
+    def get_product_features(self, duckdb_session) -> [str, pl.DataFrame]:
+        complete_sql = self.feature_query(duckdb_session).format(feature_sql=self.product_feature_sql(),
+                                                                 feature_start=self.feature_start,
+                                                                 feature_end=self.feature_end)
+
+        return complete_sql, Features.run_query(duckdb_session, complete_sql)
+
+
+
+class FeaturePlan:
+    '''
+    Gathers the SQL fragments of several feature groups (the "feature_sql" blocks that each get_* method drops into
+    BASE_FEATURE_QUERY) and compiles them into one query.  Every group shares the same FROM, JOIN, date predicate and
+    GROUP BY, so the groups collapse into a single scan + hash aggregation instead of one per group followed by joins.
+
+    A column that shows up in more than one group (e.g. month_1 from both the overlap and the month slices) is only
+    computed once.  The same alias with a different expression is an error rather than a silent overwrite.
+    '''
+
+    COLUMN_START = re.compile(r'(?:^|\n)\s*,')
+    COLUMN_ALIAS = re.compile(r'\s+as\s+(\w+)\s*$', re.IGNORECASE)
+
+    def __init__(self, base_query: str, **query_params):
+        '''
+        :param base_query: template with a {feature_sql} placeholder, e.g. Features.BASE_FEATURE_QUERY
+        :param query_params: the remaining placeholders of the template (feature_start, feature_end)
+        '''
+        self.base_query = base_query
+        self.query_params = query_params
+        self.columns = {}  # alias -> expression, in the order added
+
+    @staticmethod
+    def split_columns(feature_sql: str) -> list:
+        # each column in a fragment starts on a new line with a leading comma
+        return [column.strip() for column in FeaturePlan.COLUMN_START.split(feature_sql) if column.strip()]
+
+    def add(self, feature_sql: str) -> 'FeaturePlan':
+        for expression in FeaturePlan.split_columns(feature_sql):
+            match = FeaturePlan.COLUMN_ALIAS.search(expression)
+            if match is None:
+                raise ValueError(f"Feature column has no alias: {expression}")
+            alias = match.group(1)
+
+            existing = self.columns.get(alias)
+            if existing is None:
+                self.columns[alias] = expression
+            elif " ".join(existing.split()) != " ".join(expression.split()):
+                raise ValueError(f"Feature column {alias} is defined twice with different expressions")
+        return self
+
+    def compile(self) -> str:
+        feature_sql = "\n".join("            ," + expression for expression in self.columns.values())
+        return self.base_query.format(feature_sql=feature_sql, **self.query_params)
+
+    def run(self, duckdb_session) -> [str, pl.DataFrame]:
+        complete_sql = self.compile()
+        return complete_sql, Features.run_query(duckdb_session, complete_sql)
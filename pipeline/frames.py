@@ -0,0 +1,73 @@
+import numpy as np
+import polars as pl
+
+INTEGER_TYPES = [pl.Int8, pl.Int16, pl.Int32, pl.Int64]
+
+
+def narrowest_integer(minimum: int, maximum: int) -> pl.DataType:
+    for dtype in INTEGER_TYPES:
+        info = np.iinfo(str(dtype).lower())
+        if info.min <= minimum and maximum <= info.max:
+            return dtype
+    return pl.Int64
+
+
+def compact_frame(df: pl.DataFrame, pk_col="customer_id", float_dtype=pl.Float32, categorical_key=True) -> pl.DataFrame:
+    '''
+    The same frame in the narrowest types that hold its values: integer columns (counts come back from DuckDB as
+    BIGINT, or HUGEINT for sums) shrink to the smallest integer type their range fits, float columns become float_dtype and text
+    columns - the 32 character customer_id included - become dictionary encoded Categoricals.
+
+    A snapshot of ~100 count / revenue columns typically shrinks 3-4x.  float32 revenue keeps ~7 significant digits,
+    plenty for a feature but not for comparing against the float64 query results exactly.
+    :param df: e.g. Features.get_all_features
+    :param pk_col: key column, made Categorical unless categorical_key is False (see surrogate_keys for an integer key)
+    :param float_dtype: pl.Float32, or pl.Float64 to leave floats alone
+    :param categorical_key: dictionary encode the key column too
+    '''
+    casts = []
+    for name, dtype in df.schema.items():
+        # SUM of an integer column is a HUGEINT, which arrives as a DECIMAL(38, 0)
+        if dtype.is_integer() or (isinstance(dtype, pl.Decimal) and dtype.scale == 0):
+            minimum, maximum = df[name].min(), df[name].max()
+            if minimum is not None:
+                casts.append(pl.col(name).cast(narrowest_integer(minimum, maximum)))
+        elif dtype.is_float() or isinstance(dtype, pl.Decimal):
+            casts.append(pl.col(name).cast(float_dtype))
+        elif dtype == pl.Utf8 and (name != pk_col or categorical_key):
+            casts.append(pl.col(name).cast(pl.Categorical))
+    return df.with_columns(casts)
+
+
+def surrogate_keys(df: pl.DataFrame, pk_col="customer_id", key_col="customer_key") -> tuple:
+    '''
+    Replaces the text key with an Int32 surrogate.
+    :return: (frame with key_col instead of pk_col, keys frame mapping key_col -> pk_col)
+    '''
+    keys = df.select(pk_col).unique(maintain_order=True).with_row_index(key_col).with_columns(
+        pl.col(key_col).cast(pl.Int32))
+    frame = df.join(keys, on=pk_col, how="left", maintain_order="left")
+    return frame.select([key_col] + [name for name in df.columns if name != pk_col]), keys
+
+
+def to_float32_matrix(df: pl.DataFrame, columns: list = None, order="F", out: np.ndarray = None) -> np.ndarray:
+    '''
+    A float32 feature matrix written straight from the frame's Arrow buffers.
+
+    Numeric columns without nulls are read through a zero-copy view of their buffer, so the only copy is the (casting)
+    write into the matrix - no float64 intermediate the size of the whole matrix as with df.to_numpy().astype(...).
+    Categorical columns contribute their codes, DECIMAL columns go through float64, nulls become NaN.
+    :param columns: defaults to every column
+    :param order: "F" (column major, one contiguous write per column) or "C" for row major consumers such as PyTorch
+    :param out: float32 array of shape (rows, columns) to write into instead, e.g. a np.lib.format.open_memmap
+    '''
+    columns = columns if columns is not None else df.columns
+    matrix = out if out is not None else np.empty((df.height, len(columns)), dtype=np.float32, order=order)
+    for j, name in enumerate(columns):
+        series = df[name]
+        if series.dtype == pl.Categorical:
+            series = series.to_physical()
+        elif isinstance(series.dtype, pl.Decimal):
+            series = series.cast(pl.Float64)
+        matrix[:, j] = series.to_numpy()
+    return matrix
@@ -0,0 +1,211 @@
+from datetime import date, timedelta
+
+import numpy as np
+import polars as pl
+
+from cube import DailyCube
+from features import Features, QueryConstants
+from snapshots import SnapshotFeatures
+
+
+class IncrementalFeatures:
+    '''
+    Daily refresh of the features without recomputing the year behind them.
+
+    Per customer the running state holds, for every window (Features.OVERLAP_WINDOWS plus the whole feature window),
+    the items, distinct days and price per channel, and the first / last purchase day.  Moving feature_end forward a
+    day adds that day's (customer, channel) rollup rows to every window and subtracts the day that falls out of each
+    window, so a refresh reads and touches one day of data per window instead of 365.
+
+    When the oldest day leaves the feature window the customers who first bought on it need their next purchase day.
+    Each stored day keeps that as a link, set when the customer buys again, so no search is needed.
+
+    The values equal Features(constants, use_daily_cube=True).get_all_features for the same end date exactly (prices
+    are carried as DECIMAL units, see SnapshotFeatures) - and so the row level query up to float summation order.
+
+    Usage:
+        incremental = IncrementalFeatures(QueryConstants(end_date=date(2020, 9, 21)))
+        incremental.initialize(dataset.duckdb_conn)
+        ... new transactions for 2020-09-22 arrive ...
+        incremental.refresh(dataset.duckdb_conn)
+        features_df = incremental.get_all_features()
+    '''
+
+    EPOCH = date(2000, 1, 1)
+    MEASURES = ("days", "items_1", "items_2", "days_1", "days_2", "price_1", "price_2")
+
+    DAY_QUERY = '''
+        SELECT
+            customer_id,
+            CAST(t_dat - DATE '{epoch}' AS INTEGER) AS day,
+            sales_channel_id,
+            item_count,
+            CAST(price_sum * {price_scale} AS BIGINT) AS price_units,
+            first_of_day
+        FROM ({rollup}) d
+        WHERE customer_id IN (SELECT customer_id FROM customers)
+        ORDER BY day, customer_id, sales_channel_id
+    '''
+
+    def __init__(self, query_constants: QueryConstants):
+        self.features = Features(query_constants, use_daily_cube=True)
+        self.feature_duration = query_constants.feature_duration
+        # (name, length) of every window, the whole feature window last.  A window longer than the feature window is
+        # cut at feature_start, as the feature query's date filter cuts it - its days leave with the feature window's
+        self.windows = ([(name, min(length, self.feature_duration)) for name, length in Features.OVERLAP_WINDOWS]
+                        + [("total", self.feature_duration)])
+        self.feature_end_day = None
+        self.customer_ids = pl.DataFrame(schema={"customer_id": pl.Utf8, "customer_index": pl.Int64})
+        self.state = {name: {measure: np.empty(0, dtype=np.int64) for measure in IncrementalFeatures.MEASURES}
+                      for name, _ in self.windows}
+        self.first_day = np.empty(0, dtype=np.int64)
+        self.last_day = np.empty(0, dtype=np.int64)
+        self.days = {}
+        self.attributes = None
+        self.schema = None
+
+    @staticmethod
+    def day_number(d: date) -> int:
+        return (d - IncrementalFeatures.EPOCH).days
+
+    @property
+    def feature_end(self) -> date:
+        return IncrementalFeatures.EPOCH + timedelta(days=self.feature_end_day)
+
+    def read_days(self, duckdb_conn, after: date, through: date) -> pl.DataFrame:
+        date_filter = "t_dat > DATE '{after}' AND t_dat <= DATE '{through}'".format(after=after, through=through)
+        return Features.run_query(duckdb_conn, IncrementalFeatures.DAY_QUERY.format(
+            epoch=IncrementalFeatures.EPOCH, price_scale=SnapshotFeatures.PRICE_SCALE,
+            rollup=DailyCube.ROLLUP_SQL.format(date_filter=date_filter)))
+
+    def initialize(self, duckdb_conn):
+        '''
+        Builds the state for the constants' feature window: one read of the year, replayed a day at a time.
+        '''
+        # the cube query's schema, over an empty rollup so that the cube table itself is not needed
+        empty_rollup = "FROM (" + DailyCube.ROLLUP_SQL.format(date_filter="FALSE") + ") t"
+        self.schema = SnapshotFeatures.feature_schema(
+            duckdb_conn, self.features, Features.BASE_FEATURE_QUERY.replace("FROM transactions t", empty_rollup))
+        self.attributes = Features.run_query(duckdb_conn, SnapshotFeatures.CUSTOMER_QUERY)
+        start_day = IncrementalFeatures.day_number(self.features.feature_start)
+        end_day = IncrementalFeatures.day_number(self.features.feature_end)
+
+        self.feature_end_day = start_day
+        rows = self.read_days(duckdb_conn, self.features.feature_start, self.features.feature_end)
+        # customers are indexed for the whole read at once rather than day by day
+        rows = rows.with_columns(pl.Series("customer_index", self.customer_index(rows["customer_id"])))
+        by_day = {key[0]: frame for key, frame in rows.partition_by("day", as_dict=True).items()}
+        empty = rows.clear()
+        for day in range(start_day + 1, end_day + 1):
+            self.advance(by_day.get(day, empty))
+
+    def refresh(self, duckdb_conn, end_date: date = None):
+        '''
+        Moves the feature window forward to end_date (default: one day), reading only the new days.
+        :param end_date: new end date, in the sense of QueryConstants.end_date
+        '''
+        offset = self.features.end_date - self.features.feature_end
+        target = (end_date - offset) if end_date is not None else self.feature_end + timedelta(days=1)
+        if target < self.feature_end:
+            raise ValueError(f"Can't refresh backwards from {self.feature_end} to {target}")
+
+        rows = self.read_days(duckdb_conn, self.feature_end, target)
+        if rows.height and not rows.join(self.customer_ids, on="customer_id", how="anti").is_empty():
+            # customers that were not in the state yet - pick up their attributes
+            self.attributes = Features.run_query(duckdb_conn, SnapshotFeatures.CUSTOMER_QUERY)
+        rows = rows.with_columns(pl.Series("customer_index", self.customer_index(rows["customer_id"])))
+        by_day = {key[0]: frame for key, frame in rows.partition_by("day", as_dict=True).items()}
+        empty = rows.clear()
+        while self.feature_end < target:
+            self.advance(by_day.get(self.feature_end_day + 1, empty))
+
+        self.features = Features(QueryConstants(target + offset, self.features.response_duration,
+                                                self.features.additional_offset, self.feature_duration),
+                                 use_daily_cube=True)
+
+    def customer_index(self, customer_ids: pl.Series) -> np.ndarray:
+        # state row of each customer, new customers are appended
+        known = (customer_ids.to_frame("customer_id")
+                 .join(self.customer_ids, on="customer_id", how="left", maintain_order="left"))
+        missing = known.filter(pl.col("customer_index").is_null()).select("customer_id").unique(maintain_order=True)
+        if missing.height:
+            n = self.customer_ids.height
+            self.customer_ids = pl.concat([self.customer_ids, missing.with_columns(
+                pl.int_range(n, n + missing.height, dtype=pl.Int64).alias("customer_index"))])
+            grow = np.zeros(missing.height, dtype=np.int64)
+            for name, _ in self.windows:
+                for measure in IncrementalFeatures.MEASURES:
+                    self.state[name][measure] = np.concatenate([self.state[name][measure], grow])
+            self.first_day = np.concatenate([self.first_day, grow - 1])
+            self.last_day = np.concatenate([self.last_day, grow - 1])
+            return self.customer_index(customer_ids)
+        return known["customer_index"].to_numpy()
+
+    def advance(self, rows: pl.DataFrame):
+        '''
+        Moves feature_end one day forward.
+        :param rows: the new day's rollup rows (DAY_QUERY) with their customer_index, possibly none
+        '''
+        day = self.feature_end_day + 1
+        index = rows["customer_index"].to_numpy()
+        channel = rows["sales_channel_id"].to_numpy()
+        items = rows["item_count"].to_numpy().astype(np.int64)
+        price = rows["price_units"].to_numpy().astype(np.int64)
+        first_of_day = rows["first_of_day"].to_numpy().astype(bool)
+
+        # link the new day from each returning customer's previous day in the window
+        buyers = index[first_of_day]
+        previous = self.last_day[buyers]
+        for previous_day in np.unique(previous[previous > day - 1 - self.feature_duration]):
+            stored = self.days[previous_day]
+            returning = buyers[previous == previous_day]
+            stored["next_day"][np.searchsorted(stored["buyers"], returning)] = day
+
+        new_day = {"index": index, "channel": channel, "items": items, "price": price, "first_of_day": first_of_day,
+                   "buyers": np.sort(buyers), "next_day": np.full(len(buyers), -1, dtype=np.int64)}
+        for name, length in self.windows:
+            self.apply(self.state[name], new_day, 1)
+            leaving = self.days.get(day - length)
+            if leaving is not None:
+                self.apply(self.state[name], leaving, -1)
+
+        # first / last purchase day within the feature window
+        self.first_day[buyers[self.last_day[buyers] < 0]] = day
+        self.last_day[buyers] = day
+        leaving = self.days.pop(day - self.feature_duration, None)
+        if leaving is not None:
+            self.first_day[leaving["buyers"]] = leaving["next_day"]
+            gone = leaving["buyers"][leaving["next_day"] < 0]
+            self.last_day[gone] = -1
+
+        self.days[day] = new_day
+        self.feature_end_day = day
+
+    @staticmethod
+    def apply(state: dict, day: dict, sign: int):
+        index, channel = day["index"], day["channel"]
+        np.add.at(state["days"], index, sign * day["first_of_day"])
+        for c in (1, 2):
+            in_channel = channel == c
+            np.add.at(state[f"items_{c}"], index, sign * day["items"] * in_channel)
+            np.add.at(state[f"days_{c}"], index, sign * in_channel)
+            np.add.at(state[f"price_{c}"], index, sign * day["price"] * in_channel)
+
+    def get_all_features(self) -> pl.DataFrame:
+        '''
+        :return: same columns as Features.get_all_features for the current end date
+        '''
+        total = self.state["total"]
+        active = np.flatnonzero(total["days"] > 0)
+
+        windows = {}
+        for name, _ in Features.OVERLAP_WINDOWS:
+            for c in (1, 2):
+                windows[(name, c)] = tuple(self.state[name][f"{measure}_{c}"][active]
+                                           for measure in ("items", "days", "price"))
+        columns = SnapshotFeatures.feature_columns(windows, {measure: values[active] for measure, values in total.items()},
+                                                   self.first_day[active], self.last_day[active], self.feature_end_day)
+
+        customers = (self.customer_ids.sort("customer_index")[active]
+                     .join(self.attributes, on="customer_id", how="left", maintain_order="left"))
+        return SnapshotFeatures.select_schema(customers.hstack(pl.DataFrame(columns)), self.schema, ["customer_id"], [])
@@ -0,0 +1,423 @@
+import json
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.compose import ColumnTransformer
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer, OneHotEncoder, StandardScaler
+
+
+def log1p_signed(x):
+    # sign(x) * ln(1 + |x|) ... module level so that fitted pipelines pickle (e.g. to scoring workers)
+    return np.sign(x) * np.log1p(np.abs(x))
+
+
+class Winsorizer(BaseEstimator, TransformerMixin):
+    def __init__(self, lower_percentile=0.01, upper_percentile=99.99):
+        '''
+        Clips each column to percentiles computed during fit.
+        :param lower_percentile: the lower percentile for winsorization (e.g., 5 for 5th percentile)
+        :param upper_percentile: the upper percentile for winsorization (e.g., 95 for 95th percentile)
+        '''
+        self.lower_percentile = lower_percentile
+        self.upper_percentile = upper_percentile
+        self.bounds_ = None  # To store computed bounds during fitting
+
+    def fit(self, X, y=None):
+        X = np.asarray(X)
+        if X.ndim != 2:
+            raise ValueError(f"Expected 2D input, got {X.ndim}D input with shape {X.shape}")
+
+        self.bounds_ = {}
+        for col in range(X.shape[1]):
+            self.bounds_[col] = {
+                "lower": np.percentile(X[:, col], self.lower_percentile),
+                "upper": np.percentile(X[:, col], self.upper_percentile),
+            }
+        return self
+
+    def transform(self, X):
+        if self.bounds_ is None:
+            raise ValueError("Winsorizer has not been fitted yet.")
+
+        X = np.asarray(X)
+        if X.ndim != 2:
+            raise ValueError(f"Expected 2D input, got {X.ndim}D input with shape {X.shape}")
+
+        lower = np.array([bounds["lower"] for bounds in self.bounds_.values()])
+        upper = np.array([bounds["upper"] for bounds in self.bounds_.values()])
+        return np.clip(X, lower, upper)
+
+
+def is_text(dtype) -> bool:
+    # text and dictionary encoded text, e.g. the Categorical columns of frames.compact_frame
+    return isinstance(dtype, (pl.Utf8, pl.Categorical, pl.Enum))
+
+
+def detect_columns(schema, pk_col: str, label_col: str, cat_cols=None) -> tuple:
+    '''
+    Splits the feature columns of a frame (or its schema) into numerical and categorical columns.
+    :param cat_cols: categorical columns, auto-detected (text, Categorical and Enum columns) if None
+    :return: (feature_columns, num_cols, cat_cols)
+    '''
+    schema = dict(schema)
+    feature_columns = [col for col in schema if col not in [pk_col, label_col]]
+
+    if cat_cols is None:
+        cat_cols = [col for col in feature_columns if is_text(schema[col])]
+        print(f"Automatically detected categorical columns: {cat_cols}\n")
+    elif any(col for col in cat_cols if col not in feature_columns):
+        invalid_cats = [col for col in cat_cols if col not in feature_columns]
+        print(f"Warning: The following provided categorical columns are not valid and will be ignored: {invalid_cats}")
+        cat_cols = [col for col in cat_cols if col in feature_columns]
+
+    extra_text_cols = [col for col in feature_columns if is_text(schema[col]) and col not in cat_cols]
+    if extra_text_cols:
+        print(f"Warning: The following text columns are not in the provided categorical column list and will be ignored: {extra_text_cols}")
+
+    num_cols = [col for col in feature_columns if col not in cat_cols and col not in extra_text_cols]
+    return feature_columns, num_cols, cat_cols
+
+
+class DataPreprocessor(BaseEstimator, TransformerMixin):
+    '''
+    In memory preprocessing (from ptb_04): numerical columns are winsorized, signed log1p transformed and
+    standardized, categorical columns one-hot encoded.  See StreamingPreprocessor for the out of core equivalent.
+    '''
+
+    def __init__(self, pk_col="customer_id", label_col="label", cat_cols=None, split=False, test_size=0.1, random_state=42, stratify=True, use_ln_transform=True):
+        self.pk_col = pk_col
+        self.label_col = label_col
+        self.cat_cols = cat_cols  # List of categorical columns (if provided)
+        self.split = split
+        self.test_size = test_size
+        self.random_state = random_state
+        self.stratify = stratify
+        self.use_ln_transform = use_ln_transform
+        self.feature_columns = None
+        self.num_cols = None
+        self.pipeline = None  # Will be initialized in `set_feature_columns()`
+
+    def set_feature_columns(self, aligned_df):
+        self.feature_columns, self.num_cols, self.cat_cols = detect_columns(
+            aligned_df.schema, self.pk_col, self.label_col, self.cat_cols)
+
+        num_pipeline_steps = [("winsorizer", Winsorizer(lower_percentile=0.001, upper_percentile=99.999))]
+        if self.use_ln_transform:
+            num_pipeline_steps.append(("ln_transform", FunctionTransformer(log1p_signed, validate=True)))
+        num_pipeline_steps.append(("scaler", StandardScaler()))
+
+        cat_pipeline = Pipeline([
+            ("encoder", OneHotEncoder(handle_unknown="ignore", sparse_output=False))
+        ])
+
+        self.pipeline = ColumnTransformer([
+            ("num", Pipeline(num_pipeline_steps), self.num_cols),
+            ("cat", cat_pipeline, self.cat_cols)
+        ])
+
+    def _split_data(self, X, y):
+        stratify_labels = y if self.stratify else None
+        return train_test_split(
+            X, y, test_size=self.test_size, random_state=self.random_state, stratify=stratify_labels
+        )
+
+    def fit(self, X: pl.DataFrame, y=None):
+        if self.pipeline is None:
+            self.set_feature_columns(X)
+        y_np = X[self.label_col].to_numpy() if y is None else y
+        X_df = X.select(self.feature_columns)
+
+        if self.split:
+            X_train, X_test, y_train, y_test = self._split_data(X_df, y_np)
+            self.pipeline.fit(X_train, y_train)
+        else:
+            self.pipeline.fit(X_df, y_np)
+
+        return self
+
+    def transform(self, X: pl.DataFrame):
+        X_df = X.select(self.feature_columns)
+        return self.pipeline.transform(X_df)
+
+    def fit_transform(self, X: pl.DataFrame, y=None):
+        '''
+        :return: X_train, X_test, y_train, y_test ... X_test and y_test are None unless split
+        '''
+        if self.pipeline is None:
+            self.set_feature_columns(X)
+        y_np = X[self.label_col].to_numpy() if y is None else y
+        X_df = X.select(self.feature_columns)
+
+        if self.split:
+            X_train, X_test, y_train, y_test = self._split_data(X_df, y_np)
+            X_train_transformed = self.pipeline.fit_transform(X_train, y_train)
+            X_test_transformed = self.pipeline.transform(X_test)
+            return X_train_transformed, X_test_transformed, y_train, y_test
+        else:
+            X_transformed = self.pipeline.fit_transform(X_df, y_np)
+            return X_transformed, None, y_np, None
+
+    def get_feature_names(self) -> list:
+        cat_feature_names = self.pipeline.named_transformers_["cat"].get_feature_names_out(self.cat_cols)
+        return list(self.num_cols) + list(cat_feature_names)
+
+
+class QuantileSketch:
+    '''
+    Approximate quantiles of many columns, fed batch by batch.
+
+    The body of the distribution is a KLL style compactor stack: level h holds items of weight 2^h, and a full level
+    is sorted and every other item (random offset) promoted to the next level.  All columns see the same number of
+    values, so the levels are (items, columns) arrays and each compaction is one vectorized sort.  The rank error of
+    the body is a small multiple of n / k.
+
+    The extreme tails are kept exactly: the `tail` smallest and largest values of each column.  Winsorizing at
+    0.001% / 99.999% only ever looks at those, so up to tail / 0.00001 rows (100M for the default) the bounds
+    equal np.percentile on the full column.
+    '''
+
+    def __init__(self, n_columns: int, k=2048, tail=1024, seed=0):
+        self.n_columns = n_columns
+        self.k = k
+        self.tail = tail
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        self.levels = [np.empty((0, n_columns))]
+        self.smallest = np.empty((0, n_columns))
+        self.largest = np.empty((0, n_columns))
+
+    def update(self, X: np.ndarray):
+        X = np.asarray(X, dtype=np.float64).reshape(-1, self.n_columns)
+        self.count += X.shape[0]
+
+        self.smallest = np.concatenate([self.smallest, X])
+        if self.smallest.shape[0] > self.tail:
+            self.smallest = np.partition(self.smallest, self.tail - 1, axis=0)[:self.tail]
+        self.largest = np.concatenate([self.largest, X])
+        if self.largest.shape[0] > self.tail:
+            self.largest = np.partition(self.largest, -self.tail, axis=0)[-self.tail:]
+
+        self.levels[0] = np.concatenate([self.levels[0], X])
+        self.compact()
+
+    def compact(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if items.shape[0] > self.k:
+                items = np.sort(items, axis=0)
+                # an odd item out stays behind so that the promoted items keep exactly half the weight
+                keep = items.shape[0] % 2
+                promoted = items[keep:][self.rng.integers(2)::2]
+                self.levels[level] = items[:keep]
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty((0, self.n_columns)))
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def order_statistic(self, rank: int) -> np.ndarray:
+        # value of the rank-th smallest (0 based) item of each column
+        if rank < self.smallest.shape[0]:
+            return np.sort(self.smallest, axis=0)[rank]
+        from_top = self.count - 1 - rank
+        if from_top < self.largest.shape[0]:
+            return np.sort(self.largest, axis=0)[::-1][from_top]
+
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(items.shape[0], 2 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(values, axis=0)
+        cumulative = np.cumsum(weights[order], axis=0)
+        # first item whose cumulative weight (which sums to count) passes the rank, per column
+        index = np.argmax(cumulative > rank, axis=0)
+        return np.take_along_axis(values, order, axis=0)[index, np.arange(self.n_columns)]
+
+    def percentile(self, q: float) -> np.ndarray:
+        '''
+        Same interpolation as np.percentile (linear between the closest ranks).
+        :param q: percentile in [0, 100]
+        '''
+        position = q / 100 * (self.count - 1)
+        below = int(np.floor(position))
+        above = min(below + 1, self.count - 1)
+        low, high = self.order_statistic(below), self.order_statistic(above)
+        return low + (high - low) * (position - below)
+
+
+class RunningMoments:
+    '''
+    Column means and variances merged batch by batch (Chan et al.), numerically stable unlike sum / sum of squares.
+    '''
+
+    def __init__(self, n_columns: int):
+        self.count = 0
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns)
+
+    def update(self, X: np.ndarray):
+        n = X.shape[0]
+        if n == 0:
+            return
+        batch_mean = X.mean(axis=0)
+        batch_m2 = ((X - batch_mean) ** 2).sum(axis=0)
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + batch_m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    @property
+    def variance(self) -> np.ndarray:
+        # population variance, as StandardScaler
+        return self.m2 / self.count
+
+
+class StreamingPreprocessor:
+    '''
+    Out of core version of DataPreprocessor: fitted from batches (e.g. DuckDB record batches of a year of stacked
+    snapshots) without holding the feature matrix in memory, saved as JSON and applied batch by batch at scoring.
+
+    Two passes over the batches: the first feeds a QuantileSketch (winsorization bounds) and collects the category
+    levels, the second the running mean / variance of the winsorized, log transformed values for the scaler.
+
+    Usage:
+        preprocessor = StreamingPreprocessor()
+        preprocessor.fit_batches(lambda: conn.execute(feature_sql).fetch_record_batch(100_000))
+        preprocessor.save('../models/preprocessor.json')
+        BatchScorer(StreamingPreprocessor.load('../models/preprocessor.json'), model).score_query(...)
+    '''
+
+    def __init__(self, pk_col="customer_id", label_col="label", cat_cols=None, lower_percentile=0.001,
+                 upper_percentile=99.999, use_ln_transform=True, sketch_size=2048, tail=1024, seed=0):
+        '''
+        :param pk_col:
+        :param label_col:
+        :param cat_cols: categorical columns, auto-detected (text columns) if None
+        :param lower_percentile: winsorization bounds, as Winsorizer
+        :param upper_percentile:
+        :param use_ln_transform: apply log1p_signed after winsorizing
+        :param sketch_size: items per level of the quantile sketch, see QuantileSketch
+        :param tail: exact tail values kept per column, see QuantileSketch
+        :param seed: for the sketch compaction
+        '''
+        self.pk_col = pk_col
+        self.label_col = label_col
+        self.cat_cols = cat_cols
+        self.lower_percentile = lower_percentile
+        self.upper_percentile = upper_percentile
+        self.use_ln_transform = use_ln_transform
+        self.sketch_size = sketch_size
+        self.tail = tail
+        self.seed = seed
+
+        self.feature_columns = None
+        self.num_cols = None
+        self.lower = None
+        self.upper = None
+        self.mean = None
+        self.scale = None
+        self.categories = None
+
+    def set_feature_columns(self, aligned_df):
+        self.feature_columns, self.num_cols, self.cat_cols = detect_columns(
+            aligned_df.schema, self.pk_col, self.label_col, self.cat_cols)
+
+    @staticmethod
+    def as_frame(batch) -> pl.DataFrame:
+        if isinstance(batch, (pa.RecordBatch, pa.Table)):
+            return pl.from_arrow(batch)
+        return batch
+
+    def numeric(self, df: pl.DataFrame) -> np.ndarray:
+        return df.select(self.num_cols).to_numpy().astype(np.float64)
+
+    def fit_batches(self, batches):
+        '''
+        :param batches: callable returning a fresh iterable of pl.DataFrame / Arrow record batches, called twice
+        '''
+        sketch = None
+        levels = None
+        for batch in batches():
+            df = StreamingPreprocessor.as_frame(batch)
+            if self.feature_columns is None:
+                self.set_feature_columns(df)
+            if sketch is None:
+                sketch = QuantileSketch(len(self.num_cols), self.sketch_size, self.tail, self.seed)
+                levels = {col: set() for col in self.cat_cols}
+            sketch.update(self.numeric(df))
+            for col in self.cat_cols:
+                levels[col].update(df[col].unique().to_list())
+
+        if sketch is None or sketch.count == 0:
+            raise ValueError("No rows to fit on")
+        self.lower = sketch.percentile(self.lower_percentile)
+        self.upper = sketch.percentile(self.upper_percentile)
+        # as OneHotEncoder: sorted levels, missing values as their own last level
+        self.categories = {col: sorted(level for level in levels[col] if level is not None)
+                                + ([None] if None in levels[col] else []) for col in self.cat_cols}
+
+        moments = RunningMoments(len(self.num_cols))
+        for batch in batches():
+            moments.update(self.winsorize(self.numeric(StreamingPreprocessor.as_frame(batch))))
+        self.mean = moments.mean
+        scale = np.sqrt(moments.variance)
+        self.scale = np.where(scale == 0, 1.0, scale)
+        return self
+
+    def fit(self, X: pl.DataFrame, y=None, batch_size=100_000):
+        # in memory frame, fitted the same way as streamed batches
+        return self.fit_batches(lambda: X.iter_slices(batch_size))
+
+    def winsorize(self, X: np.ndarray) -> np.ndarray:
+        X = np.clip(X, self.lower, self.upper)
+        return log1p_signed(X) if self.use_ln_transform else X
+
+    def transform(self, X) -> np.ndarray:
+        if self.mean is None:
+            raise ValueError("StreamingPreprocessor has not been fitted yet.")
+        df = StreamingPreprocessor.as_frame(X)
+        parts = [(self.winsorize(self.numeric(df)) - self.mean) / self.scale]
+        for col in self.cat_cols:
+            values = df[col].to_numpy()
+            parts.append(np.stack([values == level if level is not None else df[col].is_null().to_numpy()
+                                   for level in self.categories[col]], axis=1).astype(np.float64))
+        return np.hstack(parts)
+
+    def transform_batches(self, batches):
+        for batch in batches:
+            yield self.transform(batch)
+
+    def get_feature_names(self) -> list:
+        return list(self.num_cols) + [f"{col}_{level}" for col in self.cat_cols for level in self.categories[col]]
+
+    def save(self, path: str):
+        state = {
+            "params": {"pk_col": self.pk_col, "label_col": self.label_col, "cat_cols": self.cat_cols,
+                       "lower_percentile": self.lower_percentile, "upper_percentile": self.upper_percentile,
+                       "use_ln_transform": self.use_ln_transform, "sketch_size": self.sketch_size,
+                       "tail": self.tail, "seed": self.seed},
+            "feature_columns": self.feature_columns,
+            "num_cols": self.num_cols,
+            "lower": self.lower.tolist(),
+            "upper": self.upper.tolist(),
+            "mean": self.mean.tolist(),
+            "scale": self.scale.tolist(),
+            "categories": self.categories,
+        }
+        with open(path, "w") as f:
+            json.dump(state, f)
+
+    @staticmethod
+    def load(path: str) -> 'StreamingPreprocessor':
+        with open(path) as f:
+            state = json.load(f)
+        preprocessor = StreamingPreprocessor(**state["params"])
+        preprocessor.feature_columns = state["feature_columns"]
+        preprocessor.num_cols = state["num_cols"]
+        for name in ("lower", "upper", "mean", "scale"):
+            setattr(preprocessor, name, np.array(state[name]))
+        preprocessor.categories = state["categories"]
+        return preprocessor
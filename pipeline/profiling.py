@@ -0,0 +1,195 @@
+import functools
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+import polars as pl
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+# the profiler stage() and query() report to, set by RunProfiler.__enter__
+_active = None
+
+
+def active() -> 'RunProfiler':
+    return _active
+
+
+def memory_mb() -> tuple:
+    '''
+    :return: (current resident set, process peak resident set) in MB, None where the platform can't tell
+    '''
+    current = peak = None
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if os.uname().sysname == "Darwin" else 2**10)
+    return current, peak
+
+
+def result_size(result) -> tuple:
+    # (rows, bytes) of a stage or query result, for the frames and arrays the pipeline passes around
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], str):
+        result = result[1]  # the (sql, frame) pairs of the Features.get_* methods
+    if isinstance(result, pl.DataFrame):
+        return result.height, result.estimated_size()
+    if hasattr(result, "num_rows") and hasattr(result, "nbytes"):  # Arrow tables
+        return result.num_rows, result.nbytes
+    if hasattr(result, "shape") and hasattr(result, "nbytes"):
+        return result.shape[0], result.nbytes
+    return None, None
+
+
+class RunProfiler:
+    '''
+    Wall time, rows, bytes and memory of every pipeline stage and every feature query, appended to a JSON lines run
+    log as they finish - one record per stage or query, nested stages carrying their parent's name.  Optionally DuckDB
+    writes its per-operator profile (EXPLAIN ANALYZE as JSON) of each query next to the log; rows scanned, DuckDB's
+    peak buffer memory and CPU time are then copied into the query's record.
+
+    Stages are marked in the pipeline code with profiling.stage / profiling.profiled and queries go through
+    Features.run_query and CSVDataset.run_query, all of which do nothing unless a profiler is active.
+
+    Usage:
+        with RunProfiler('../runs/run_log.jsonl', profile_dir='../runs/profiles') as profiler:
+            df = Features(constants).get_all_features_and_response(dataset.duckdb_conn)
+        profiler.summary()
+    '''
+
+    def __init__(self, log_path: str = None, profile_dir: str = None, log_sql=False, run_id: str = None):
+        '''
+        :param log_path: JSON lines file the records are appended to, None to keep them in memory only
+        :param profile_dir: directory for DuckDB's per-query JSON profiles, None for no DuckDB profiling
+        :param log_sql: include the SQL text in query records
+        :param run_id: tags every record of the run, defaults to a random id
+        '''
+        self.log_path = log_path
+        self.profile_dir = profile_dir
+        self.log_sql = log_sql
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.records = []
+        self.stack = []
+        self.query_count = 0
+        self.previous = None
+        for directory in (os.path.dirname(log_path) if log_path else None, profile_dir):
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self) -> 'RunProfiler':
+        global _active
+        self.previous, _active = _active, self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self.previous
+
+    def write(self, record: dict):
+        record = {"run_id": self.run_id, **record}
+        self.records.append(record)
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    def measure(self, kind: str, name: str, fn, extra=None):
+        parent = "/".join(self.stack) or None
+        self.stack.append(name)
+        started_at = datetime.now()
+        started = time.perf_counter()
+        try:
+            result = fn()
+        finally:
+            seconds = time.perf_counter() - started
+            self.stack.pop()
+        rows, size = result_size(result)
+        rss, peak_rss = memory_mb()
+        self.write({"kind": kind, "name": name, "parent": parent, "started": started_at.isoformat(),
+                    "seconds": seconds, "rows": rows, "bytes": size, "rss_mb": rss, "peak_rss_mb": peak_rss,
+                    **(extra() if extra else {})})
+        return result
+
+    def stage(self, name: str, fn):
+        return self.measure("stage", name, fn)
+
+    def query(self, duckdb_conn, sql: str, fn):
+        '''
+        Runs fn (which executes sql on duckdb_conn, or answers it from a cache) as a query record.
+        '''
+        self.query_count += 1
+        query_index = self.query_count
+        profile_path = None
+        if self.profile_dir:
+            profile_path = os.path.abspath(os.path.join(self.profile_dir, f"{self.run_id}_{query_index:04d}.json"))
+            duckdb_conn.execute("PRAGMA enable_profiling = 'json'")
+            duckdb_conn.execute("PRAGMA profiling_output = '{}'".format(profile_path.replace("'", "''")))
+
+        def details() -> dict:
+            record = {"query_index": query_index}
+            if self.log_sql:
+                record["sql"] = sql
+            # DuckDB profiles whatever ran last - a cache hit leaves the cache's own lookups there, or nothing
+            if profile_path and os.path.exists(profile_path):
+                with open(profile_path) as f:
+                    profile = json.load(f)
+                if profile.get("query_name", "").strip() != sql.strip():
+                    os.remove(profile_path)
+                    return record
+                record.update({"profile": profile_path, "rows_scanned": profile.get("cumulative_rows_scanned"),
+                               "duckdb_peak_buffer_bytes": profile.get("system_peak_buffer_memory"),
+                               "duckdb_cpu_seconds": profile.get("cpu_time")})
+            return record
+
+        try:
+            return self.measure("query", "query", fn, details)
+        finally:
+            if profile_path:
+                duckdb_conn.execute("PRAGMA disable_profiling")
+
+    def summary(self) -> pl.DataFrame:
+        '''
+        :return: one row per stage / query name: calls, total and max seconds, rows, bytes and the highest peak RSS
+        '''
+        if not self.records:
+            return pl.DataFrame()
+        return (pl.DataFrame(self.records, infer_schema_length=None)
+                .group_by("kind", "name", "parent", maintain_order=True)
+                .agg(pl.len().alias("calls"), pl.col("seconds").sum().alias("total_seconds"),
+                     pl.col("seconds").max().alias("max_seconds"), pl.col("rows").sum(), pl.col("bytes").sum(),
+                     pl.col("peak_rss_mb").max())
+                .sort("total_seconds", descending=True))
+
+    @staticmethod
+    def read_log(log_path: str) -> pl.DataFrame:
+        return pl.read_ndjson(log_path, infer_schema_length=None)
+
+
+def stage(name: str, fn):
+    '''
+    fn() as a stage of the active profiler, or just fn() without one.
+    '''
+    return _active.stage(name, fn) if _active is not None else fn()
+
+
+def query(duckdb_conn, sql: str, fn):
+    return _active.query(duckdb_conn, sql, fn) if _active is not None else fn()
+
+
+def profiled(name: str):
+    '''
+    Decorator form of stage, e.g. @profiled("label") on Features.get_response_label.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            return stage(name, lambda: method(*args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,118 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import duckdb
+import polars as pl
+import polars.selectors as cs
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import profiling
+from sql import sql_string
+
+
+# fitted preprocessor + model of a pool worker, set once by _init_worker rather than pickled with every batch
+_worker_scorer = None
+
+
+def _init_worker(scorer):
+    global _worker_scorer
+    _worker_scorer = scorer
+
+
+def _score_in_worker(batch: pa.RecordBatch) -> pa.RecordBatch:
+    return _worker_scorer.score_batch(batch)
+
+
+class BatchScorer:
+    '''
+    Scores the population in fixed size batches of customers and streams (customer_id, score) to Parquet, so peak
+    memory depends on batch_size rather than on the number of customers.  Batches come straight from DuckDB as Arrow
+    record batches and can be scored across a process pool.  A final pass adds the rank (1 = highest score).
+    '''
+
+    def __init__(self, preprocessor, model, batch_size=100_000, pk_col="customer_id", n_jobs=1):
+        '''
+        :param preprocessor: fitted object with transform(pl.DataFrame) -> matrix (e.g. DataPreprocessor) or None to
+        pass the numeric columns to the model as they are (as backtest.numeric_matrix)
+        :param model: fitted classifier with predict_proba
+        :param batch_size: customers per batch
+        :param pk_col: customer key column, carried through to the output
+        :param n_jobs: number of worker processes, 1 scores in this process
+        '''
+        self.preprocessor = preprocessor
+        self.model = model
+        self.batch_size = batch_size
+        self.pk_col = pk_col
+        self.n_jobs = n_jobs
+
+    def score_batch(self, batch: pa.RecordBatch) -> pa.RecordBatch:
+        df = pl.from_arrow(batch)
+        if self.preprocessor is not None:
+            X = self.preprocessor.transform(df)
+        else:
+            X = df.select(cs.numeric().exclude(self.pk_col)).to_numpy()
+
+        scores = self.model.predict_proba(X)[:, 1]
+        return pa.record_batch([batch.column(self.pk_col), pa.array(scores, type=pa.float64())],
+                               names=[self.pk_col, "score"])
+
+    def scored_batches(self, reader: pa.RecordBatchReader):
+        if self.n_jobs == 1:
+            for batch in reader:
+                yield self.score_batch(batch)
+            return
+
+        # keep a couple of batches per worker in flight and yield them back in order.  spawn rather than fork: the
+        # DuckDB result stream and the Polars thread pool in this process do not survive a fork
+        with ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(self,)) as pool:
+            pending = deque()
+            for batch in reader:
+                pending.append(pool.submit(_score_in_worker, batch))
+                if len(pending) >= 2 * self.n_jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    @profiling.profiled("score")
+    def score_query(self, duckdb_conn, feature_sql: str, output_path: str) -> str:
+        '''
+        :param duckdb_conn:
+        :param feature_sql: query returning the key column and the model features, e.g.
+        Features(constants).get_feature_plan().compile()
+        :param output_path: Parquet file with customer_id, score, rank
+        :return: output_path
+        '''
+        reader = duckdb_conn.execute(feature_sql).fetch_record_batch(self.batch_size)
+
+        unranked_path = output_path + ".unranked"
+        schema = pa.schema([reader.schema.field(self.pk_col), pa.field("score", pa.float64())])
+        rows = 0
+        with pq.ParquetWriter(unranked_path, schema) as writer:
+            for scored in self.scored_batches(reader):
+                writer.write_batch(scored)
+                rows += scored.num_rows
+        print(f"Scored {rows} customers")
+
+        profiling.stage("rank", lambda: BatchScorer.rank(unranked_path, output_path, self.pk_col))
+        os.remove(unranked_path)
+        return output_path
+
+    @staticmethod
+    def rank(scores_path: str, output_path: str, pk_col="customer_id"):
+        # DuckDB sorts out of core, so ranking does not pull the scores back into Python.  A connection of its own
+        # rather than the module level default one, which the caller may be using
+        conn = duckdb.connect()
+        try:
+            conn.execute('''
+                COPY (
+                    SELECT {pk_col}, score, ROW_NUMBER() OVER (ORDER BY score DESC, {pk_col}) AS rank
+                    FROM read_parquet({scores_path})
+                    ORDER BY rank
+                ) TO {output_path} (FORMAT PARQUET)
+            '''.format(pk_col=pk_col, scores_path=sql_string(scores_path), output_path=sql_string(output_path)))
+        finally:
+            conn.close()
@@ -0,0 +1,223 @@
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import polars as pl
+from sklearn.base import clone
+
+from evaluate import ranking_metrics
+from frames import to_float32_matrix
+from training import top_decile_lift
+
+
+class FeatureMatrix:
+    '''
+    A feature matrix computed once and stored as .npy files, so every experiment (and every worker process) memory
+    maps the same pages instead of rebuilding aligned_df and converting it to NumPy again.
+
+    X is stored as C-contiguous float32 - the dtype sklearn's tree models train on - so fitting does not make a
+    converted copy either.
+
+    The rows are written shuffled once: a stratified validation block first, then the training rows in random order.
+    Any sample of the training rows is then a contiguous slice (training_rows), which stays a view of the mapped file
+    - fancy indexing would give every worker a private copy of the rows it fits on.  rows.npy maps each row back to
+    its position in the frame.
+
+    Usage:
+        df = Features(constants).get_all_features_and_response(dataset.duckdb_conn)
+        matrix = FeatureMatrix.from_frame(df, '../data/matrix', preprocessor)
+        matrix = FeatureMatrix.load('../data/matrix')    # later, in another notebook or process
+    '''
+
+    def __init__(self, directory: str, X: np.ndarray, y: np.ndarray, feature_names: list, validation_rows: int):
+        self.directory = directory
+        self.X = X
+        self.y = y
+        self.feature_names = feature_names
+        self.validation_rows = validation_rows
+
+    def validation(self) -> tuple:
+        return self.X[:self.validation_rows], self.y[:self.validation_rows]
+
+    def training_rows(self, n_rows: int) -> tuple:
+        # a random sample of n_rows training rows, as the training block is in random order
+        end = self.validation_rows + n_rows
+        return self.X[self.validation_rows:end], self.y[self.validation_rows:end]
+
+    @property
+    def n_training_rows(self) -> int:
+        return len(self.y) - self.validation_rows
+
+    @staticmethod
+    def row_order(y: np.ndarray, validation_fraction: float, seed: int) -> tuple:
+        '''
+        :return: (row positions, validation blocks' length) - a stratified validation sample first, the remaining rows
+        shuffled after it
+        '''
+        rng = np.random.default_rng(seed)
+        validation = np.zeros(len(y), dtype=bool)
+        for label in (0, 1):
+            rows = np.flatnonzero(y == label)
+            validation[rng.choice(rows, int(round(len(rows) * validation_fraction)), replace=False)] = True
+        validation_index = np.flatnonzero(validation)
+        return np.concatenate([validation_index, rng.permutation(np.flatnonzero(~validation))]), len(validation_index)
+
+    @staticmethod
+    def from_frame(df: pl.DataFrame, directory: str, preprocessor=None, pk_col="customer_id",
+                   label_col="label", validation_fraction=0.2, seed=0) -> 'FeatureMatrix':
+        '''
+        :param df: features and label, e.g. Features.get_all_features_and_response
+        :param directory: where the matrix is written
+        :param preprocessor: fitted or unfitted preprocessor (fit(df) / transform(df)), None for the numeric columns
+        :param validation_fraction: held-out rows, stratified, written first (see row_order)
+        :param seed: validation sample and shuffle of the training rows
+        '''
+        os.makedirs(directory, exist_ok=True)
+        order, validation_rows = FeatureMatrix.row_order(df[label_col].to_numpy(), validation_fraction, seed)
+        df = df[order]
+        path = os.path.join(directory, "X.npy")
+        if preprocessor is not None:
+            if getattr(preprocessor, "feature_columns", None) is None:
+                preprocessor.fit(df)
+            X = preprocessor.transform(df)
+            feature_names = preprocessor.get_feature_names()
+            matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=X.shape)
+            matrix[:] = X
+        else:
+            # straight from the frame's buffers into the file, without a float64 copy of the frame in between
+            feature_names = df.drop(pk_col, label_col).select(pl.selectors.numeric()).columns
+            matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(df.height, len(feature_names)))
+            to_float32_matrix(df, feature_names, out=matrix)
+        matrix.flush()
+        np.save(os.path.join(directory, "y.npy"), df[label_col].to_numpy().astype(np.int8))
+        np.save(os.path.join(directory, "rows.npy"), order)
+        with open(os.path.join(directory, "columns.json"), "w") as f:
+            json.dump(list(feature_names), f)
+        with open(os.path.join(directory, "split.json"), "w") as f:
+            json.dump({"validation_rows": validation_rows, "validation_fraction": validation_fraction, "seed": seed}, f)
+        return FeatureMatrix.load(directory)
+
+    @staticmethod
+    def load(directory: str) -> 'FeatureMatrix':
+        with open(os.path.join(directory, "columns.json")) as f:
+            feature_names = json.load(f)
+        with open(os.path.join(directory, "split.json")) as f:
+            validation_rows = json.load(f)["validation_rows"]
+        return FeatureMatrix(directory, np.load(os.path.join(directory, "X.npy"), mmap_mode="r"),
+                             np.load(os.path.join(directory, "y.npy"), mmap_mode="r"), feature_names, validation_rows)
+
+
+# matrix of a pool worker, memory mapped once by _init_worker
+_worker_matrix = None
+
+
+def _init_worker(directory):
+    global _worker_matrix
+    _worker_matrix = FeatureMatrix.load(directory)
+
+
+def _evaluate_in_worker(estimator, params, n_rows) -> dict:
+    return evaluate_candidate(_worker_matrix, estimator, params, n_rows)
+
+
+def evaluate_candidate(matrix: FeatureMatrix, estimator, params, n_rows) -> dict:
+    '''
+    Fits clone(estimator) with params on the first n_rows training rows and scores the validation rows - both
+    slices of the memory mapped matrix, not copies.
+    '''
+    X_train, y_train = matrix.training_rows(n_rows)
+    model = clone(estimator).set_params(**params)
+    started = time.perf_counter()
+    model.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - started
+
+    X_validation, y_validation = matrix.validation()
+    y_validation = np.asarray(y_validation)
+    scores = model.predict_proba(X_validation)[:, 1]
+    return {
+        "top_decile_lift": top_decile_lift(y_validation, scores),
+        "auc": float(ranking_metrics(y_validation, scores, top_k=())["auc"][0]),
+        "fit_seconds": fit_seconds,
+    }
+
+
+class SuccessiveHalvingSearch:
+    '''
+    Successive halving over candidate parameter sets: every candidate is fitted on a small sample of the training
+    rows, the best 1/eta (by top-decile lift on the validation rows) go on to eta times as many rows, and so on
+    until one is left or all rows are used.  Bad configurations are dropped after their cheapest fit.
+
+    Candidates of a rung run in a spawn process pool.  Workers memory map the FeatureMatrix files and fit on slices
+    of them, so the matrix sits in the page cache once however many workers there are.  Each rung's rows are the
+    first n of the matrix's shuffled training block: the same for every candidate of the rung, and each rung's rows
+    include the previous rung's.
+
+    Usage:
+        search = SuccessiveHalvingSearch(matrix, RandomForestClassifier(n_jobs=1), candidates, n_jobs=os.cpu_count())
+        results = search.run()
+        search.best_params
+    '''
+
+    def __init__(self, matrix: FeatureMatrix, estimator, candidates: list, min_rows=10_000, eta=3, n_jobs=1):
+        '''
+        :param matrix: see FeatureMatrix
+        :param estimator: unfitted sklearn classifier, cloned with each candidate's params
+        :param candidates: list of param dicts for estimator.set_params
+        :param min_rows: training rows of the first rung
+        :param eta: keep 1/eta of the candidates per rung, multiply the rows by eta
+        :param n_jobs: worker processes, 1 runs in this process
+        '''
+        self.matrix = matrix
+        self.estimator = estimator
+        self.candidates = candidates
+        self.min_rows = min_rows
+        self.eta = eta
+        self.n_jobs = n_jobs
+        self.best_params = None
+
+    def rungs(self) -> list:
+        # (candidates kept, training rows) per rung
+        rungs = []
+        remaining, rows = len(self.candidates), self.min_rows
+        while True:
+            rungs.append((remaining, min(rows, self.matrix.n_training_rows)))
+            if remaining == 1 or rows >= self.matrix.n_training_rows:
+                return rungs
+            remaining, rows = max(1, math.ceil(remaining / self.eta)), rows * self.eta
+
+    def run(self) -> pl.DataFrame:
+        '''
+        :return: one row per (rung, candidate) evaluated, with the params as a JSON string
+        '''
+        results = []
+        alive = list(range(len(self.candidates)))
+
+        pool = None
+        if self.n_jobs > 1:
+            pool = ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_worker, initargs=(self.matrix.directory,))
+        try:
+            for rung, (keep, n_rows) in enumerate(self.rungs()):
+                alive = alive[:keep]
+                if pool is None:
+                    scores = [evaluate_candidate(self.matrix, self.estimator, self.candidates[i], n_rows) for i in alive]
+                else:
+                    futures = [pool.submit(_evaluate_in_worker, self.estimator, self.candidates[i], n_rows)
+                               for i in alive]
+                    scores = [future.result() for future in futures]
+
+                for i, score in zip(alive, scores):
+                    results.append({"rung": rung, "candidate": i, "params": json.dumps(self.candidates[i]),
+                                    "rows": n_rows, **score})
+                # best first, ties to the earlier candidate
+                alive = [i for _, i in sorted(zip([-s["top_decile_lift"] for s in scores], alive))]
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        self.best_params = self.candidates[alive[0]]
+        return pl.DataFrame(results)
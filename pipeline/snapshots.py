@@ -0,0 +1,241 @@
+from datetime import date, timedelta
+
+import numpy as np
+import polars as pl
+
+from cube import DailyCube
+from features import Features, QueryConstants
+from frames import compact_frame
+
+
+class SnapshotFeatures:
+    '''
+    Features + labels for many end dates at once ("temporal shifting" / stacked training snapshots), with the same
+    columns as Features(..., use_daily_cube=True).get_all_features_and_response plus a snapshot_date column.
+
+    Rather than re-aggregating the year of transactions behind every snapshot, the daily rollup (cube.DailyCube) is
+    read once, sorted by (customer, day), and turned into running totals per measure.  Any window sum is then the
+    difference of two running totals:
+
+        items in (a, b]  =  C(b) - C(a)      where C(x) is the running total at the customer's last day <= x
+
+    and C(x) is a binary search (np.searchsorted) into the sorted rows.  Each snapshot costs a handful of searches
+    per customer instead of a pass over the rows in its window, so 52 weekly snapshots cost one read of the rollup
+    plus work proportional to the output.
+
+    Prices are carried as integers (DECIMAL price_sum * 10^15) so the running totals are exact, like the cube's
+    DECIMAL sums.
+    '''
+
+    PRICE_SCALE = 10 ** 15
+    # customer key in the high bits, day number in the low bits of one sortable int64
+    DAY_BITS = 20
+
+    ROLLUP_QUERY = '''
+        SELECT
+            d.customer_id,
+            CAST(d.t_dat - DATE '{epoch}' AS INTEGER) AS day,
+            d.sales_channel_id,
+            d.item_count,
+            CAST(d.price_sum * {price_scale} AS BIGINT) AS price_units,
+            d.first_of_day
+        FROM {source} d
+        WHERE d.t_dat > DATE '{first_date}' AND d.t_dat <= DATE '{last_date}'
+            AND d.customer_id IN (SELECT customer_id FROM customers)
+        ORDER BY d.customer_id, d.t_dat, d.sales_channel_id
+    '''
+
+    # the customer attributes of Features.customer_feature_sql, once per customer
+    CUSTOMER_QUERY = '''
+        SELECT
+            c.customer_id
+            ,MAX(CASE WHEN COALESCE(c.active,0) = 1 THEN 1 ELSE 0 END) AS customer_active
+            ,MAX(COALESCE(c.fashion_news_frequency, 'Empty')) AS customer_fashion_news_frequency
+            ,MAX(CASE WHEN COALESCE(c.FN,0) = 1 THEN 1 ELSE 0 END) AS customer_fn
+            ,MAX(COALESCE(c.age,-1)) as age
+        FROM customers c
+        GROUP BY c.customer_id
+    '''
+
+    def __init__(self, end_dates: list, response_duration=0, additional_offset=0, feature_duration=365,
+                 data_fingerprint=None):
+        '''
+        :param end_dates: one snapshot per end date, same meaning as QueryConstants.end_date
+        :param response_duration: see QueryConstants
+        :param additional_offset: see QueryConstants
+        :param feature_duration: see QueryConstants
+        :param data_fingerprint: passed to the daily rollup, see cube.DailyCube
+        '''
+        if not end_dates:
+            raise ValueError("At least one end date is required")
+
+        self.snapshots = [Features(QueryConstants(end_date, response_duration, additional_offset, feature_duration),
+                                   use_daily_cube=True, data_fingerprint=data_fingerprint)
+                          for end_date in sorted(set(end_dates))]
+
+    @staticmethod
+    def from_stride(last_end_date, stride_days: int, count: int, **kwargs) -> 'SnapshotFeatures':
+        '''
+        :param last_end_date: the most recent end date
+        :param stride_days: days between snapshots, e.g. 7 for weekly
+        :param count: number of snapshots, going back in time from last_end_date
+        :param kwargs: passed on to the constructor
+        '''
+        end_dates = [last_end_date - timedelta(days=stride_days * i) for i in range(count)]
+        return SnapshotFeatures(end_dates, **kwargs)
+
+    @staticmethod
+    def revenue(price_units: np.ndarray) -> np.ndarray:
+        '''
+        590 * price exactly as DuckDB computes CAST(590 * <DECIMAL sum> AS DOUBLE): a plain division by the scale when
+        the integer is exactly representable as a double, otherwise integer part plus fractional part / scale.  The
+        rare sums too large for int64 go through Python integers.
+        '''
+        scale = SnapshotFeatures.PRICE_SCALE
+        price_units = price_units.astype(np.int64)
+        fits = np.abs(price_units) < np.iinfo(np.int64).max // 590
+        units = 590 * np.where(fits, price_units, 0)
+        result = np.where(np.abs(units) < 2 ** 53,
+                          units.astype(np.float64) / scale,
+                          (units // scale).astype(np.float64) + (units % scale).astype(np.float64) / scale)
+        if not fits.all():
+            result[~fits] = [float(590 * int(u) // scale) + float(590 * int(u) % scale) / scale
+                             for u in price_units[~fits]]
+        return result
+
+    @staticmethod
+    def sql_round(x: np.ndarray) -> np.ndarray:
+        # DuckDB's ROUND is half away from zero, np.round is half to even
+        return np.sign(x) * np.floor(np.abs(x) + 0.5)
+
+    @staticmethod
+    def feature_columns(windows: dict, totals: dict, first_day: np.ndarray, last_day: np.ndarray,
+                        feature_end_day: int) -> dict:
+        '''
+        The feature columns of the single pass cube query (Features.get_feature_plan) from window sums.
+        :param windows: (offset_name, channel) -> (items, days, price_units) over each of Features.OVERLAP_WINDOWS
+        :param totals: sums over the whole feature window ... days, days_1, days_2, items_1, items_2, price_1, price_2
+        :param first_day: first and last purchase day in the feature window, as day numbers
+        :param last_day:
+        :param feature_end_day: feature_end as a day number
+        :return: column name -> array, customer attributes excluded
+        '''
+        columns = {}
+        for offset_name, _ in Features.OVERLAP_WINDOWS:
+            for c in (1, 2):
+                items, days, price = windows[(offset_name, c)]
+                columns[f"t_count_channel_{c}_{offset_name}_1"] = items
+                columns[f"ti_count_channel_{c}_{offset_name}_1"] = days
+                columns[f"revenue_channel_{c}_{offset_name}_1"] = SnapshotFeatures.revenue(price)
+
+        total_days = totals["days"]
+        total_revenue = SnapshotFeatures.sql_round(SnapshotFeatures.revenue(totals["price_1"] + totals["price_2"]))
+        columns["aov"] = SnapshotFeatures.sql_round(total_revenue / total_days)
+        columns["primary_sales_channel_01"] = SnapshotFeatures.sql_round(totals["days_1"] / total_days)
+        columns["primary_sales_channel_02"] = SnapshotFeatures.sql_round(totals["days_2"] / total_days)
+        columns["total_revenue"] = total_revenue
+        columns["total_items"] = totals["items_1"] + totals["items_2"]
+        columns["total_transactions"] = total_days
+        columns["days_since_last"] = feature_end_day - last_day
+        columns["days_since_first"] = feature_end_day - first_day
+        columns["days_tenure"] = last_day - first_day
+        return columns
+
+    @staticmethod
+    def feature_schema(duckdb_connection, features: Features, base_query=None) -> dict:
+        # the exact column names and dtypes of the single pass cube query
+        return Features.execute_query(duckdb_connection, "SELECT * FROM ({sql}) LIMIT 0".format(
+            sql=features.get_feature_plan(base_query).compile())).schema
+
+    def read_rollup(self, duckdb_connection) -> pl.DataFrame:
+        anchor = self.snapshots[0]
+        anchor.ensure_daily_cube(duckdb_connection)
+        self.epoch = min(f.feature_start for f in self.snapshots)
+        query = SnapshotFeatures.ROLLUP_QUERY.format(source=DailyCube.TABLE, epoch=self.epoch, price_scale=SnapshotFeatures.PRICE_SCALE,
+                                                     first_date=self.epoch,
+                                                     last_date=max(f.response_end for f in self.snapshots))
+        return Features.run_query(duckdb_connection, query)
+
+    def get_all_features_and_response(self, duckdb_connection, compact=False) -> pl.DataFrame:
+        '''
+        :param compact: narrow the dtypes of each snapshot as it is built (see frames.compact_frame), so the wide
+        float64 / int64 version of the whole stack never exists
+        :return: one row per (customer_id, snapshot_date), snapshot_date being the end date of the snapshot
+        '''
+        rows = self.read_rollup(duckdb_connection)
+        # rows are sorted by customer_id, so a new customer starts wherever the id changes
+        rows = rows.with_columns(
+            ((pl.col("customer_id") != pl.col("customer_id").shift()).fill_null(True).cum_sum() - 1).alias("customer_index"))
+        day = rows["day"].to_numpy()
+        customer_index = rows["customer_index"].to_numpy().astype(np.int64)
+        keys = (customer_index << SnapshotFeatures.DAY_BITS) | day
+        channel = rows["sales_channel_id"].to_numpy()
+        items = rows["item_count"].to_numpy().astype(np.int64)
+        price = rows["price_units"].to_numpy().astype(np.int64)
+
+        # running totals with a leading 0, so C(x) = running[searchsorted(keys, x, 'right')].  Totals run across all
+        # customers and the price total overflows int64 on the full data - harmless, numpy wraps around and the
+        # difference of two totals is still exact as long as the window sum itself fits in int64
+        def running(values):
+            return np.concatenate([[0], np.cumsum(values)])
+
+        totals = {"days": running(rows["first_of_day"].to_numpy().astype(np.int64))}
+        for c in (1, 2):
+            in_channel = (channel == c).astype(np.int64)
+            totals[f"items_{c}"] = running(items * in_channel)
+            totals[f"days_{c}"] = running(in_channel)
+            totals[f"price_{c}"] = running(price * in_channel)
+
+        # one row per customer_index with the customer attributes, gathered per snapshot
+        attributes = Features.run_query(duckdb_connection, SnapshotFeatures.CUSTOMER_QUERY)
+        customer_frame = (rows.select("customer_index", "customer_id").unique("customer_index").sort("customer_index")
+                          .join(attributes, on="customer_id", how="left", maintain_order="left").drop("customer_index"))
+        customers = np.arange(customer_frame.height, dtype=np.int64)
+
+        schema = SnapshotFeatures.feature_schema(duckdb_connection, self.snapshots[0])
+
+        frames = []
+        for snapshot in self.snapshots:
+            def position(as_of: date, subset: np.ndarray) -> np.ndarray:
+                target = (subset << SnapshotFeatures.DAY_BITS) | (as_of - self.epoch).days
+                return np.searchsorted(keys, target, side="right")
+
+            end = position(snapshot.feature_end, customers)
+            start = position(snapshot.feature_start, customers)
+            active = np.flatnonzero(end > start)
+            end, start = end[active], start[active]
+
+            def window(measure: str, begin: np.ndarray) -> np.ndarray:
+                return totals[measure][end] - totals[measure][begin]
+
+            windows = {}
+            for offset_name, offset_length in Features.OVERLAP_WINDOWS:
+                begin = position(snapshot.feature_end - timedelta(days=offset_length), active)
+                for c in (1, 2):
+                    windows[(offset_name, c)] = (window(f"items_{c}", begin), window(f"days_{c}", begin),
+                                                 window(f"price_{c}", begin))
+
+            columns = SnapshotFeatures.feature_columns(
+                windows, {measure: window(measure, start) for measure in totals},
+                day[start], day[end - 1], (snapshot.feature_end - self.epoch).days)
+
+            # bought anything in (response_start, response_end] ... response_start is feature_end
+            columns["label"] = (position(snapshot.response_end, active) > end).astype(np.int32)
+
+            frame = customer_frame[active].with_columns(pl.lit(snapshot.end_date).alias("snapshot_date"))
+            frame = SnapshotFeatures.select_schema(frame.hstack(pl.DataFrame(columns)), schema,
+                                                   ["customer_id", "snapshot_date"], ["label"])
+            frames.append(compact_frame(frame) if compact else frame)
+
+        # snapshots compacted separately may have picked different integer widths
+        return pl.concat(frames, how="vertical_relaxed" if compact else "vertical")
+
+    @staticmethod
+    def select_schema(df: pl.DataFrame, schema: dict, leading: list, trailing: list) -> pl.DataFrame:
+        return df.select(
+            [pl.col(name) for name in leading]
+            + [pl.col(name).cast(dtype) for name, dtype in schema.items() if name != "customer_id"]
+            + [pl.col(name) for name in trailing])
+
+    def get_all_features(self, duckdb_connection, compact=False) -> pl.DataFrame:
+        return self.get_all_features_and_response(duckdb_connection, compact).drop("label")
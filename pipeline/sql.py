@@ -0,0 +1,6 @@
+def sql_string(value) -> str:
+    '''
+    Quote a value (usually a path) as a SQL string literal ... COPY ... TO, CREATE VIEW and read_parquet in a COPY
+    don't accept bound parameters
+    '''
+    return "'" + str(value).replace("'", "''") + "'"
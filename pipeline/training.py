@@ -0,0 +1,144 @@
+import numpy as np
+import polars as pl
+
+from evaluate import ranking_metrics
+
+
+def negative_downsample(df: pl.DataFrame, negative_rate: float, label_col="label", strata=None, seed=0,
+                        weight_col="sample_weight") -> pl.DataFrame:
+    '''
+    Keeps every buyer and a fraction of the non-buyers, exactly negative_rate of them within each stratum (e.g.
+    snapshot_date for stacked snapshots), and adds a weight column: 1 for buyers, non-buyers in the stratum / kept
+    non-buyers in the stratum for non-buyers.  Training with the weights (or correcting with prior_correction) keeps
+    the scores on the scale of the full population.
+    :param df: features and label
+    :param negative_rate: fraction of non-buyers to keep, e.g. 0.1
+    :param label_col:
+    :param strata: columns to sample within, e.g. ["snapshot_date"]
+    :param seed:
+    :param weight_col: name of the added weight column
+    :return: the sample, in the original row order
+    '''
+    if not 0 < negative_rate <= 1:
+        raise ValueError(f"negative_rate must be in (0, 1], got {negative_rate}")
+
+    group = list(strata or []) + [label_col]
+    rng = np.random.default_rng(seed)
+    sampled = (df
+               .with_columns(pl.Series("_random", rng.random(df.height)))
+               .with_columns(pl.col("_random").rank("ordinal").over(group).alias("_rank"),
+                             pl.len().over(group).alias("_group_size"))
+               .with_columns(pl.max_horizontal((pl.col("_group_size") * negative_rate).round(), 1).alias("_keep")))
+
+    return (sampled
+            .filter((pl.col(label_col) == 1) | (pl.col("_rank") <= pl.col("_keep")))
+            .with_columns(pl.when(pl.col(label_col) == 1).then(1.0)
+                          .otherwise(pl.col("_group_size") / pl.col("_keep")).alias(weight_col))
+            .drop("_random", "_rank", "_group_size", "_keep"))
+
+
+def prior_correction(probabilities: np.ndarray, negative_rate: float) -> np.ndarray:
+    '''
+    Maps probabilities of a model trained on unweighted, negative downsampled data back to the population:
+    the sample's odds are the population's odds / negative_rate, so p = p_s * r / (p_s * r + 1 - p_s).
+    Monotone, so the ranking (and lift) is unchanged - only matters where the probability itself is used.
+    '''
+    probabilities = np.asarray(probabilities)
+    return probabilities * negative_rate / (probabilities * negative_rate + 1 - probabilities)
+
+
+def top_decile_lift(ground_truth: np.ndarray, scores: np.ndarray) -> float:
+    metrics = ranking_metrics(ground_truth, scores, top_k=(), n_bins=10)
+    n = len(ground_truth)
+    return metrics["bin_buyers"][0, 0] / (n // 10) / (np.sum(ground_truth) / n)
+
+
+class DownsampledModel:
+    '''
+    A model fitted on negative downsampled data, with predict_proba on the population scale.  Drop-in for the model
+    of scoring.BatchScorer and backtest.run_fold.
+    '''
+
+    def __init__(self, model, negative_rate: float, reweighted=True):
+        '''
+        :param model: classifier with fit(X, y, sample_weight=) and predict_proba
+        :param negative_rate: fraction of non-buyers kept, see negative_downsample
+        :param reweighted: fitted with the sample weights - otherwise predict_proba applies prior_correction
+        '''
+        self.model = model
+        self.negative_rate = negative_rate
+        self.reweighted = reweighted
+
+    def fit(self, X, y, sample_weight=None):
+        self.model.fit(X, y, sample_weight=sample_weight if self.reweighted else None)
+        return self
+
+    def predict_proba(self, X) -> np.ndarray:
+        probabilities = self.model.predict_proba(X)
+        if self.reweighted:
+            return probabilities
+        positive = prior_correction(probabilities[:, 1], self.negative_rate)
+        return np.column_stack([1 - positive, positive])
+
+
+class WarmStartTrainer:
+    '''
+    Grows an ensemble (any estimator with warm_start and n_estimators, e.g. RandomForestClassifier or
+    GradientBoostingClassifier) a step of estimators at a time and stops when the top-decile lift on a held-out fold
+    has not improved for `patience` steps.
+
+    Each step can be fitted on a different chunk, e.g. one downsampled snapshot of a stack: for a random forest the new
+    trees learn from the new snapshot while the earlier trees are kept, so no single fit sees the whole stack.
+    Boosting continues on whatever it is given, so pass it a single chunk.
+
+    Usage:
+        trainer = WarmStartTrainer(RandomForestClassifier(max_depth=8, n_jobs=-1), step=20)
+        trainer.fit(chunks, X_validation, y_validation)
+        trainer.model.predict_proba(...)
+    '''
+
+    def __init__(self, model, step=10, max_estimators=500, patience=3):
+        '''
+        :param model: unfitted ensemble, warm_start is switched on
+        :param step: estimators added per step
+        :param max_estimators: upper bound on the ensemble size
+        :param patience: steps without improvement before stopping
+        '''
+        self.model = model
+        self.step = step
+        self.max_estimators = max_estimators
+        self.patience = patience
+        self.history = []
+        self.best_n_estimators = None
+
+    def fit(self, chunks, X_validation, y_validation):
+        '''
+        :param chunks: list of (X, y) or (X, y, sample_weight), used in turn, one per step
+        :param X_validation: held-out fold for early stopping
+        :param y_validation:
+        :return: self, with history = [(n_estimators, top decile lift)] and the forest trimmed to the best size
+        '''
+        self.model.set_params(warm_start=True, n_estimators=0)
+        self.history = []
+        best_lift = -np.inf
+        since_best = 0
+        n_estimators = 0
+
+        while n_estimators < self.max_estimators and since_best < self.patience:
+            X, y, *weight = chunks[len(self.history) % len(chunks)]
+            n_estimators = min(n_estimators + self.step, self.max_estimators)
+            self.model.set_params(n_estimators=n_estimators)
+            self.model.fit(X, y, sample_weight=weight[0] if weight else None)
+
+            lift = top_decile_lift(y_validation, self.model.predict_proba(X_validation)[:, 1])
+            self.history.append((n_estimators, lift))
+            if lift > best_lift:
+                best_lift, self.best_n_estimators, since_best = lift, n_estimators, 0
+            else:
+                since_best += 1
+
+        # forests can drop the trees added after the best step
+        if isinstance(getattr(self.model, "estimators_", None), list):
+            self.model.estimators_ = self.model.estimators_[:self.best_n_estimators]
+            self.model.set_params(n_estimators=self.best_n_estimators)
+        return self
@@ -0,0 +1,56 @@
+import sys
+import os
+from datetime import date
+
+import duckdb
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../pipeline')))
+
+# A small, deterministic stand-in for the H&M tables: 500 customers, ~20k transactions over two years, 320 articles.
+# Only the columns the pipeline touches are generated.
+SYNTHETIC_TABLES_SQL = '''
+    SELECT setseed(0.42);
+
+    CREATE TABLE customers AS
+    SELECT
+        md5(CAST(i AS VARCHAR)) AS customer_id,
+        CASE WHEN i % 3 = 0 THEN 1.0 ELSE NULL END AS FN,
+        CASE WHEN i % 4 = 0 THEN 1.0 ELSE NULL END AS active,
+        CASE WHEN i % 5 = 0 THEN 'Regularly' WHEN i % 7 = 0 THEN NULL ELSE 'NONE' END AS fashion_news_frequency,
+        CASE WHEN i % 11 = 0 THEN NULL ELSE 18 + i % 50 END AS age
+    FROM range(500) r(i);
+
+    CREATE TABLE transactions AS
+    SELECT
+        DATE '2018-09-20' + CAST(FLOOR(random() * 734) AS INTEGER) AS t_dat,
+        md5(CAST(CAST(FLOOR(POW(random(), 2) * 520) AS INTEGER) AS VARCHAR)) AS customer_id,
+        LPAD(CAST(100000 + CAST(FLOOR(random() * 300) AS INTEGER) AS VARCHAR), 10, '0') AS article_id,
+        ROUND(random() * 0.1, 6) AS price,
+        CASE WHEN random() < 0.7 THEN 2 ELSE 1 END AS sales_channel_id
+    FROM range(20000);
+
+    -- articles 300-319 are never sold
+    CREATE TABLE articles AS
+    SELECT
+        LPAD(CAST(100000 + i AS VARCHAR), 10, '0') AS article_id,
+        1000 + i % 40 AS product_type_no,
+        ['Garment Upper body', 'Garment Lower body', 'Shoes', 'Accessories'][1 + i % 4] AS product_group_name,
+        [1, 2, 3, 4, 26][1 + i % 5] AS index_group_no,
+        1001 + i % 20 AS garment_group_no
+    FROM range(320) r(i);
+'''
+
+
+@pytest.fixture
+def synthetic_db():
+    # customer ids 500-519 only exist in transactions, which exercises the customers join
+    conn = duckdb.connect()
+    conn.execute(SYNTHETIC_TABLES_SQL)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def end_date():
+    return date(2020, 9, 22)
@@ -0,0 +1,59 @@
+from datetime import timedelta
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+from backtest import WalkForwardBacktest, training_constants
+from features import Features, QueryConstants
+
+
+class NumericColumns:
+    # stand-in for the preprocessor
+    columns = ["total_revenue", "total_items", "total_transactions", "days_since_last"]
+
+    def fit(self, df):
+        return self
+
+    def transform(self, df):
+        return df.select(self.columns).to_numpy().astype(float)
+
+
+def logistic_factory():
+    return NumericColumns(), LogisticRegression(max_iter=1000)
+
+
+def test_training_window_ends_where_backtest_features_end(end_date):
+    backtest = Features(QueryConstants(end_date, response_duration=28))
+    training = Features(training_constants(QueryConstants(end_date, response_duration=28)))
+    assert training.response_end == backtest.feature_end
+    assert training.feature_end == backtest.feature_end - timedelta(days=28)
+
+
+def test_walk_forward_backtest(synthetic_db, end_date, tmp_path):
+    database_path = str(tmp_path / "ptb.duckdb")
+    synthetic_db.execute(f"ATTACH '{database_path}' AS backtest_db")
+    for table in ("transactions", "customers"):
+        synthetic_db.execute(f"CREATE TABLE backtest_db.{table} AS SELECT * FROM {table}")
+    synthetic_db.execute("DETACH backtest_db")
+
+    results = {}
+    for n_jobs in (1, 2):
+        backtest = WalkForwardBacktest.from_stride(database_path, end_date, 28, 3, logistic_factory, n_jobs=n_jobs,
+                                                   top_k=50)
+        results[n_jobs] = backtest.run()
+
+    metrics = results[1]
+    assert metrics["end_date"].to_list() == [end_date - timedelta(days=28 * i) for i in (2, 1, 0)]
+    assert metrics["auc"].is_between(0, 1).all()
+    timings = ["feature_seconds", "fit_seconds", "fold_seconds"]
+    assert results[2].drop(timings).equals(metrics.drop(timings))
+
+    # the last fold matches doing it by hand
+    train = Features(training_constants(QueryConstants(end_date, 28))).get_all_features_and_response(synthetic_db)
+    test = Features(QueryConstants(end_date, 28)).get_all_features_and_response(synthetic_db)
+    preprocessor, model = logistic_factory()
+    model.fit(preprocessor.transform(train), train["label"].to_numpy())
+    scores = model.predict_proba(preprocessor.transform(test))[:, 1]
+    last = metrics.row(-1, named=True)
+    assert last["backtest_customers"] == test.height
+    assert last["buyers_in_top_k"] == test["label"].to_numpy()[np.argsort(-scores, kind="stable")][:50].sum()
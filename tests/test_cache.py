@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from cache import QueryCache
+from features import Features, QueryConstants
+
+
+def test_cache_hit_returns_same_frame(synthetic_db, end_date, tmp_path):
+    cache = QueryCache(str(tmp_path))
+    features = Features(QueryConstants(end_date=end_date, response_duration=28))
+    sql = features.get_feature_plan().compile()
+
+    first = cache.get_or_run(synthetic_db, sql, Features.execute_query)
+    # whitespace differences normalize to the same key
+    second = cache.get_or_run(synthetic_db, "  " + sql.replace("\n", "\n\n"), Features.execute_query)
+
+    assert second.equals(first)
+    assert second.schema == first.schema
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_key_changes_with_data(synthetic_db, tmp_path):
+    cache = QueryCache(str(tmp_path))
+    sql = "SELECT COUNT(1) AS n FROM transactions"
+
+    assert cache.get_or_run(synthetic_db, sql, Features.execute_query)["n"][0] == 20000
+    synthetic_db.execute("DELETE FROM transactions WHERE t_dat < DATE '2019-01-01'")
+    assert cache.get_or_run(synthetic_db, sql, Features.execute_query)["n"][0] < 20000
+    assert cache.stats()["misses"] == 2
+
+
+def test_cache_evicts_least_recently_used(synthetic_db, tmp_path):
+    cache = QueryCache(str(tmp_path))
+    queries = [f"SELECT * FROM transactions WHERE sales_channel_id = {channel}" for channel in (1, 2)]
+    for query in queries:
+        cache.get_or_run(synthetic_db, query, Features.execute_query)
+    first_path = cache.path(cache.key(synthetic_db, queries[0]))
+    os.utime(first_path, ns=(0, 0))
+
+    cache.max_bytes = cache.stats()["bytes"] - 1
+    cache.evict()
+
+    assert not os.path.exists(first_path)
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_key_covers_temporary_tables(synthetic_db, tmp_path):
+    cache = QueryCache(str(tmp_path), data_fingerprint="fixed")
+    sql = "SELECT COUNT(1) AS n FROM transactions t INNER JOIN snapshot_dates s ON t.t_dat <= s.end_date"
+
+    synthetic_db.execute("CREATE TEMP TABLE snapshot_dates AS SELECT DATE '2019-09-22' AS end_date")
+    first = cache.get_or_run(synthetic_db, sql, Features.execute_query)["n"][0]
+    synthetic_db.execute("UPDATE snapshot_dates SET end_date = DATE '2020-09-22'")
+    second = cache.get_or_run(synthetic_db, sql, Features.execute_query)["n"][0]
+
+    assert second == 20000
+    assert first < second
+    assert cache.stats()["misses"] == 2
+
+
+def test_cache_hash_contents_sees_in_place_updates(synthetic_db, tmp_path):
+    sql = "SELECT SUM(price) AS revenue FROM transactions"
+    # the default fingerprint only sees the row count ... documented, hash_contents covers it
+    cache = QueryCache(str(tmp_path), hash_contents=True)
+
+    before = cache.get_or_run(synthetic_db, sql, Features.execute_query)["revenue"][0]
+    synthetic_db.execute("UPDATE transactions SET price = price * 2")
+    after = cache.get_or_run(synthetic_db, sql, Features.execute_query)["revenue"][0]
+
+    assert after == pytest.approx(2 * before)
+    assert cache.stats()["misses"] == 2
@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import zipfile
+
+import pytest
+
+pytest.importorskip("kaggle")
+
+from dataset import CSVDataset, KaggleDataset
+
+
+@pytest.fixture
+def csv_dir(synthetic_db, tmp_path):
+    for table, file in (("transactions", "transactions_train.csv"), ("customers", "customers.csv")):
+        synthetic_db.execute(f"COPY {table} TO '{tmp_path / file}' (HEADER)")
+    return str(tmp_path) + "/"
+
+
+def test_parquet_mode_matches_csv_mode(csv_dir, tmp_path):
+    files = ["transactions_train.csv", "customers.csv"]
+    in_memory = CSVDataset(csv_dir, files)
+    in_memory.load()
+    parquet = CSVDataset(csv_dir, files, parquet_path=str(tmp_path / "parquet"))
+    parquet.load()
+    assert in_memory.fingerprint() is None
+    assert parquet.fingerprint()
+
+    for table in ("transactions", "customers"):
+        expected = in_memory.run_query(f"SELECT * FROM {table} ORDER BY ALL")
+        actual = parquet.run_query(f"SELECT * FROM {table} ORDER BY ALL")
+        assert actual.schema == expected.schema
+        assert actual.equals(expected)
+
+
+def test_parquet_conversion_happens_once(csv_dir, tmp_path):
+    parquet_path = str(tmp_path / "parquet")
+    CSVDataset(csv_dir, ["transactions_train.csv"], parquet_path=parquet_path).load()
+    parquet_file = os.path.join(parquet_path, "transactions.parquet")
+    converted_at = os.stat(parquet_file).st_mtime_ns
+
+    dataset = CSVDataset(csv_dir, ["transactions_train.csv"], parquet_path=parquet_path)
+    dataset.load()
+    assert os.stat(parquet_file).st_mtime_ns == converted_at
+    assert dataset.run_query("SELECT COUNT(1) AS n FROM transactions")["n"][0] == 20000
+
+    # a changed source is converted again
+    with open(csv_dir + "transactions_train.csv", "a") as f:
+        f.write("2020-09-23,abc,0000000001,0.01,2\n")
+    dataset = CSVDataset(csv_dir, ["transactions_train.csv"], parquet_path=parquet_path)
+    dataset.load()
+    assert dataset.run_query("SELECT COUNT(1) AS n FROM transactions")["n"][0] == 20001
+
+
+def test_parquet_mode_handles_quotes_in_paths(synthetic_db, tmp_path):
+    csv_dir = tmp_path / "o'brien"
+    csv_dir.mkdir()
+    synthetic_db.execute(f"COPY customers TO {CSVDataset.sql_string(csv_dir / 'customers.csv')} (HEADER)")
+    dataset = CSVDataset(str(csv_dir) + "/", ["customers.csv"], parquet_path=str(tmp_path / "it's parquet"))
+    dataset.load()
+    assert dataset.run_query("SELECT COUNT(1) AS n FROM customers")["n"][0] == 500
+
+
+@pytest.fixture
+def mirror_dir(csv_dir, tmp_path):
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    for file in ("transactions_train.csv", "customers.csv"):
+        with zipfile.ZipFile(mirror / (file + ".zip"), "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.write(csv_dir + file, file)
+    return str(mirror)
+
+
+def test_kaggle_dataset_from_a_mirror_matches_the_csv(csv_dir, mirror_dir, tmp_path, capsys):
+    files = ["transactions_train.csv", "customers.csv"]
+    data_path = str(tmp_path / "data")
+    dataset = KaggleDataset(data_path, mirror_path=mirror_dir, n_jobs=2, files=files).load()
+    assert not [name for name in os.listdir(data_path) if name.endswith(".csv")]
+    assert "not found" not in capsys.readouterr().out
+
+    expected = CSVDataset(csv_dir, files, parquet_path=str(tmp_path / "parquet"))
+    expected.load()
+    for table in ("transactions", "customers"):
+        query = f"SELECT * FROM {table} ORDER BY ALL"
+        assert dataset.run_query(query).equals(expected.run_query(query))
+        describe = f"DESCRIBE {table}"
+        assert dataset.duckdb_conn.execute(describe).fetchall() == expected.duckdb_conn.execute(describe).fetchall()
+    # written in SORT_KEYS order, like CSVDataset's own conversion
+    t_dat = dataset.run_query("SELECT t_dat FROM read_parquet('{}')".format(
+        os.path.join(data_path, "parquet", "transactions.parquet")))["t_dat"]
+    assert t_dat.is_sorted()
+
+    with open(os.path.join(data_path, KaggleDataset.MANIFEST)) as f:
+        manifest = json.load(f)
+    assert manifest["transactions_train.csv.zip"]["rows"] == 20000
+    assert dataset.fingerprint() == "customers:{}|transactions:{}".format(
+        manifest["customers.csv.zip"]["sha256"], manifest["transactions_train.csv.zip"]["sha256"])
+
+
+def test_kaggle_dataset_repeat_runs_do_nothing(csv_dir, mirror_dir, tmp_path, capsys):
+    data_path = str(tmp_path / "data")
+    files = ["transactions_train.csv", "customers.csv"]
+    KaggleDataset(data_path, mirror_path=mirror_dir, files=files).load()
+    parquet_file = os.path.join(data_path, "parquet", "transactions.parquet")
+    extracted_at = os.stat(parquet_file).st_mtime_ns
+    capsys.readouterr()
+
+    KaggleDataset(data_path, mirror_path=mirror_dir, files=files).load()
+    assert "Copied" not in capsys.readouterr().out
+    assert os.stat(parquet_file).st_mtime_ns == extracted_at
+
+    # a changed archive in the mirror is copied and extracted again, the unchanged one is left alone
+    with open(csv_dir + "transactions_train.csv", "a") as f:
+        f.write("2020-09-23,abc,0000000001,0.01,2\n")
+    with zipfile.ZipFile(os.path.join(mirror_dir, "transactions_train.csv.zip"), "w") as archive:
+        archive.write(csv_dir + "transactions_train.csv", "transactions_train.csv")
+    customers_at = os.stat(os.path.join(data_path, "parquet", "customers.parquet")).st_mtime_ns
+    dataset = KaggleDataset(data_path, mirror_path=mirror_dir, files=files).load()
+    assert dataset.run_query("SELECT COUNT(1) AS n FROM transactions")["n"][0] == 20001
+    assert os.stat(os.path.join(data_path, "parquet", "customers.parquet")).st_mtime_ns == customers_at
+
+
+def test_kaggle_dataset_checks_the_mirror_manifest(mirror_dir, tmp_path):
+    with open(os.path.join(mirror_dir, KaggleDataset.MANIFEST), "w") as f:
+        json.dump({"customers.csv.zip": {"sha256": "0" * 64}}, f)
+    data_path = str(tmp_path / "data")
+    # the second run must not find and use the archive the first one rejected
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            KaggleDataset(data_path, mirror_path=mirror_dir, files=["customers.csv"]).load()
+        assert os.listdir(data_path) == []
+
+    # nor an archive put there by hand, which our own manifest knows nothing of
+    shutil.copy2(os.path.join(mirror_dir, "customers.csv.zip"), os.path.join(data_path, "customers.csv.zip"))
+    with pytest.raises(ValueError):
+        KaggleDataset(data_path, mirror_path=mirror_dir, files=["customers.csv"]).load()
+    assert os.listdir(data_path) == []
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from sklearn.metrics import f1_score, precision_recall_curve, roc_auc_score
+
+from evaluate import Evaluator, evaluate_many, lift_table
+
+
+@pytest.fixture
+def labelled_scores():
+    rng = np.random.default_rng(7)
+    y = (rng.random(5000) < 0.1).astype(int)
+    # rounded so there are plenty of tied scores
+    scores = np.round(np.clip(0.1 + 0.3 * y + rng.normal(0, 0.2, 5000), 0, 1), 2)
+    return y, scores
+
+
+def test_evaluator_matches_sklearn(labelled_scores):
+    y, scores = labelled_scores
+    e = Evaluator(y, scores, top_k=500)
+
+    precision, recall, thresholds = precision_recall_curve(y, scores)
+    f1 = 2 * (precision * recall) / (precision + recall + 1e-10)
+    assert e.auc == pytest.approx(roc_auc_score(y, scores), abs=1e-12)
+    assert e.optimal_threshold == round(thresholds[np.argmax(f1)], 2)
+    assert e.f1_score == round(f1_score(y, e.predictions), 2)
+    assert e.buyers_in_top_k == y[np.argsort(-scores, kind="stable")][:500].sum()
+
+    # two column probabilities give the same result
+    both = Evaluator(y, np.stack((1 - scores, scores), axis=1), top_k=500)
+    assert both.auc == e.auc
+    assert both.optimal_threshold == e.optimal_threshold
+
+
+def test_lift_table(labelled_scores):
+    y, scores = labelled_scores
+    table = lift_table(y, scores, n_bins=10)
+
+    assert table["customers"].sum() == len(y)
+    assert table["buyers"].sum() == y.sum()
+    assert table["cumulative_gain"][-1] == pytest.approx(1.0)
+    assert table["cumulative_lift"][-1] == pytest.approx(1.0)
+    top_decile = y[np.argsort(-scores, kind="stable")][:500]
+    assert table["lift"][0] == pytest.approx(top_decile.mean() / y.mean())
+
+
+def test_evaluate_many_matches_evaluator(labelled_scores):
+    y, scores = labelled_scores
+    rng = np.random.default_rng(11)
+    matrix = np.stack([scores, rng.random(len(y)), scores + rng.normal(0, 0.3, len(y))])
+
+    results = evaluate_many(y, matrix, names=["a", "random", "noisy"], top_k=(500, 1000))
+    assert results["model"].to_list() == ["a", "random", "noisy"]
+    for row, vector in zip(results.iter_rows(named=True), matrix):
+        e = Evaluator(y, vector, top_k=1000)
+        assert row["auc"] == pytest.approx(e.auc, abs=1e-12)
+        assert round(row["threshold"], 2) == e.optimal_threshold
+        assert row["buyers_top_1000"] == e.buyers_in_top_k
+        assert row["top_bin_lift"] == pytest.approx(e.lift_table["lift"][0])
@@ -1,6 +1,9 @@
 import sys
 import os
 
+import polars as pl
+import pytest
+
 # Add the src directory to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../pipeline')))
 
@@ -38,3 +41,214 @@ def test_time_slice_feature_sql():
 
     # Assert
     assert actual_output.strip() == expected_output.strip(), "Test failed: Outputs do not match."
+
+
+def test_single_pass_matches_separate_queries(synthetic_db, end_date):
+    from features import QueryConstants
+
+    features = Features(QueryConstants(end_date=end_date, response_duration=28, additional_offest=28))
+
+    separate = features.get_all_features(synthetic_db, single_pass=False).sort("customer_id")
+    single = features.get_all_features(synthetic_db).sort("customer_id")
+
+    assert single.columns == separate.columns
+    assert single.schema == separate.schema
+    assert single.equals(separate)
+
+
+def test_feature_plan_deduplicates_columns():
+    from features import FeaturePlan
+
+    plan = FeaturePlan(Features.BASE_FEATURE_QUERY, feature_start="2024-01-01", feature_end="2025-01-01")
+    plan.add(Features.time_slice_feature_sql(28, "month", 2, "2025-01-01"))
+    plan.add(Features.time_slice_feature_sql(28, "month", 3, "2025-01-01", start_interval=2))
+
+    assert list(plan.columns) == [f"{prefix}_month_{i}" for i in (1, 2, 3) for prefix in ("t_count", "ti_count", "revenue")]
+
+    with pytest.raises(ValueError):
+        plan.add(",COUNT(1) as t_count_month_1")
+
+
+def assert_frames_match(expected, actual):
+    # counts and the ROUNDed revenue columns (total_revenue, aov, ...) must match exactly.  Unrounded revenue is
+    # summed exactly on the cube but as DOUBLE in row order on transactions, so it only agrees to float rounding
+    assert actual.columns == expected.columns
+    assert actual.schema == expected.schema
+    expected, actual = expected.sort("customer_id"), actual.sort("customer_id")
+    for column in expected.columns:
+        if column.startswith("revenue"):
+            assert (expected[column] - actual[column]).abs().max() < 1e-6, column
+        else:
+            assert expected[column].equals(actual[column]), column
+
+
+def test_daily_cube_matches_transactions(synthetic_db, end_date):
+    from features import QueryConstants
+
+    constants = QueryConstants(end_date=end_date, response_duration=28, additional_offest=28)
+    features = Features(constants)
+    cube_features = Features(constants, use_daily_cube=True)
+
+    for channel in (0, 1, 2):
+        assert_frames_match(features.get_time_sliced_overlap(synthetic_db, channel)[1],
+                            cube_features.get_time_sliced_overlap(synthetic_db, channel)[1])
+        assert_frames_match(features.get_time_sliced_no_overlap(synthetic_db, channel)[1],
+                            cube_features.get_time_sliced_no_overlap(synthetic_db, channel)[1])
+    assert_frames_match(features.get_time_sliced_months(synthetic_db)[1],
+                        cube_features.get_time_sliced_months(synthetic_db)[1])
+    assert_frames_match(features.get_all_features(synthetic_db), cube_features.get_all_features(synthetic_db))
+
+
+def test_daily_cube_appends_new_days(synthetic_db):
+    from cube import DailyCube
+
+    synthetic_db.execute("CREATE TABLE later AS SELECT * FROM transactions WHERE t_dat > DATE '2020-09-01'")
+    synthetic_db.execute("DELETE FROM transactions WHERE t_dat > DATE '2020-09-01'")
+    DailyCube.ensure(synthetic_db)
+
+    synthetic_db.execute("INSERT INTO transactions SELECT * FROM later")
+    DailyCube.ensure(synthetic_db)
+    appended = synthetic_db.execute(f"SELECT * FROM {DailyCube.TABLE} ORDER BY ALL").fetchall()
+
+    DailyCube.build(synthetic_db)
+    rebuilt = synthetic_db.execute(f"SELECT * FROM {DailyCube.TABLE} ORDER BY ALL").fetchall()
+
+    assert appended == rebuilt
+
+
+def test_daily_cube_rebuilds_when_fingerprint_changes(synthetic_db):
+    from cube import DailyCube
+
+    DailyCube.ensure(synthetic_db, fingerprint="v1")
+    # a correction that keeps the row count and the last day
+    synthetic_db.execute("UPDATE transactions SET price = price * 2")
+    DailyCube.ensure(synthetic_db, fingerprint="v1")
+    stale = synthetic_db.execute(f"SELECT SUM(price_sum) FROM {DailyCube.TABLE}").fetchone()[0]
+
+    DailyCube.ensure(synthetic_db, fingerprint="v2")
+    fresh = synthetic_db.execute(f"SELECT SUM(price_sum) FROM {DailyCube.TABLE}").fetchone()[0]
+
+    assert fresh == 2 * stale
+
+
+def test_snapshots_match_one_query_per_end_date(synthetic_db, end_date):
+    import polars as pl
+    from features import QueryConstants
+    from snapshots import SnapshotFeatures
+
+    snapshots = SnapshotFeatures.from_stride(end_date, stride_days=30, count=3, response_duration=28,
+                                             additional_offset=28)
+    stacked = snapshots.get_all_features_and_response(synthetic_db)
+    assert stacked.columns[:2] == ["customer_id", "snapshot_date"]
+
+    for snapshot in snapshots.snapshots:
+        constants = QueryConstants(snapshot.end_date, 28, 28)
+        actual = stacked.filter(pl.col("snapshot_date") == snapshot.end_date).drop("snapshot_date")
+
+        # identical to the daily cube path, revenue included, and to the row level path (see assert_frames_match)
+        expected = Features(constants, use_daily_cube=True).get_all_features_and_response(synthetic_db)
+        assert actual.sort("customer_id").equals(expected.sort("customer_id"))
+        assert_frames_match(Features(constants).get_all_features_and_response(synthetic_db), actual)
+
+
+def test_product_and_season_features(synthetic_db, end_date):
+    import polars as pl
+    from articles import ArticleDimension
+    from features import QueryConstants
+
+    constants = QueryConstants(end_date=end_date, response_duration=28, additional_offest=28)
+    features = Features(constants, product_features=True, season_features=True)
+
+    single = features.get_all_features(synthetic_db).sort("customer_id")
+    separate = features.get_all_features(synthetic_db, single_pass=False).sort("customer_id")
+    assert single.equals(separate)
+    assert single.drop(pl.selectors.starts_with("season_", "index_group_", "product_", "avg_price_", "premium_",
+                                                 "discount_")).equals(
+        Features(constants).get_all_features(synthetic_db).sort("customer_id"))
+
+    # every item falls in one season and one index group
+    seasons = single.select(pl.sum_horizontal(pl.selectors.starts_with("season_share_")))
+    assert (seasons.to_series() - 1).abs().max() < 1e-9
+    groups = single.select(pl.sum_horizontal(pl.selectors.starts_with("index_group_share_")))
+    assert (groups.to_series() - 1).abs().max() < 1e-9
+    assert (single["season_affinity"] == 4 * single[f"season_share_{features.response_season()}"]).all()
+
+    # price sensitivity against the dimension, recomputed in Polars
+    rows = (pl.from_arrow(synthetic_db.execute(f'''
+                SELECT t.customer_id, t.price, a.median_price, a.price_band
+                FROM transactions t JOIN {ArticleDimension.TABLE} a USING (article_id)
+                WHERE a.as_of = DATE '{features.feature_end}' AND t.t_dat > DATE '{features.feature_start}' AND t.t_dat <= DATE '{features.feature_end}'
+                  AND t.customer_id IN (SELECT customer_id FROM customers)''').fetch_arrow_table())
+            .group_by("customer_id")
+            .agg((pl.col("price") <= 0.9 * pl.col("median_price")).mean().alias("discount_share"),
+                 pl.col("price_band").cast(pl.Float64).mean().alias("avg_price_band"))
+            .sort("customer_id"))
+    assert rows["customer_id"].equals(single["customer_id"])
+    assert (rows["discount_share"] - single["discount_share"]).abs().max() < 1e-9
+    assert (rows["avg_price_band"] - single["avg_price_band"]).abs().max() < 1e-9
+
+
+def test_article_dimension(synthetic_db, end_date):
+    from articles import ArticleDimension
+    from features import QueryConstants
+
+    ArticleDimension.ensure(synthetic_db, end_date)
+    bands = synthetic_db.execute(f'''
+        SELECT article_id >= '0000100300' AS unsold, MIN(price_band), MAX(price_band), COUNT(median_price)
+        FROM {ArticleDimension.TABLE} GROUP BY ALL ORDER BY ALL''').fetchall()
+    assert bands == [(False, 1, ArticleDimension.PRICE_BANDS, 300), (True, None, None, 0)]
+
+    # prices after the cut-off don't reach its features: the response window's are in a later cut-off only
+    constants = QueryConstants(end_date=end_date, response_duration=28)
+    features = Features(constants, product_features=True)
+    before = features.get_product_features(synthetic_db)[1]
+    synthetic_db.execute(f"""
+        INSERT INTO transactions SELECT DATE '{features.feature_end}' + 1, md5('1'), article_id, 10.0, 2
+        FROM articles, range(1000)""")
+    assert Features(constants, product_features=True).get_product_features(synthetic_db)[1].equals(before)
+    ArticleDimension.ensure(synthetic_db, end_date)
+    later = synthetic_db.execute(f"SELECT MIN(median_price) FROM {ArticleDimension.TABLE} WHERE as_of = ?",
+                                 [end_date]).fetchone()[0]
+    assert later == 10.0
+
+    # season features come from the cube just the same, product features need the rows
+    constants = QueryConstants(end_date=end_date, response_duration=28)
+    season = Features(constants, season_features=True).get_season_features(synthetic_db)[1].sort("customer_id")
+    cube_season = Features(constants, use_daily_cube=True, season_features=True).get_season_features(synthetic_db)[1]
+    assert_frames_match(season, cube_season)
+    with pytest.raises(ValueError):
+        Features(constants, use_daily_cube=True, product_features=True)
+
+
+def test_label_in_the_feature_pass_matches_the_join(synthetic_db, end_date):
+    from features import QueryConstants
+
+    constants = QueryConstants(end_date=end_date, response_duration=28, additional_offest=28)
+    for features in (Features(constants, revenue_half_life=7), Features(constants, use_daily_cube=True),
+                     Features(constants, product_features=True, season_features=True)):
+        joined = features.get_all_features_and_response(synthetic_db, single_pass=False)
+        single = features.get_all_features_and_response(synthetic_db)
+        assert single["label"].sum() > 0
+        assert_frames_match(joined.rename({"decayed_revenue": "revenue_decayed"}, strict=False),
+                            single.rename({"decayed_revenue": "revenue_decayed"}, strict=False))
+
+
+def test_decayed_revenue(synthetic_db, end_date):
+    from features import QueryConstants
+
+    features = Features(QueryConstants(end_date=end_date, response_duration=28), revenue_half_life=7)
+    df = features.get_all_features_and_response(synthetic_db)
+    assert (df.filter(df["label"] == 0)["decayed_revenue"] == 0).all()
+    assert (df.filter(df["label"] == 1)["decayed_revenue"] > 0).all()
+
+    # a purchase on the first response day counts in full, one half_life later half
+    start = features.response_start
+    synthetic_db.execute(f"DELETE FROM transactions WHERE t_dat > DATE '{start}'")
+    synthetic_db.execute(f"""
+        INSERT INTO transactions VALUES
+            (DATE '{start}' + 1, md5('0'), '0000100000', 0.01, 2),
+            (DATE '{start}' + 8, md5('0'), '0000100000', 0.01, 2);
+    """)
+    df = features.get_all_features_and_response(synthetic_db).filter(pl.col("label") == 1)
+    assert df.height == 1
+    assert abs(df["decayed_revenue"][0] - 590*0.01*1.5) < 1e-9
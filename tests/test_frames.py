@@ -0,0 +1,73 @@
+import numpy as np
+import polars as pl
+
+from features import Features, QueryConstants
+from preprocessing import DataPreprocessor, StreamingPreprocessor
+from frames import surrogate_keys, to_float32_matrix
+from snapshots import SnapshotFeatures
+
+
+def test_compact_frame_keeps_values_in_a_fraction_of_the_memory(synthetic_db, end_date):
+    features = Features(QueryConstants(end_date, response_duration=28))
+    full = features.get_all_features_and_response(synthetic_db)
+    compact = features.get_all_features_and_response(synthetic_db, compact=True)
+
+    assert compact.columns == full.columns
+    assert compact.estimated_size() * 3 < full.estimated_size()
+    assert compact["customer_id"].dtype == pl.Categorical
+    assert all(dtype in (pl.Int8, pl.Int16, pl.Int32) for dtype in compact.select(pl.selectors.integer()).dtypes)
+
+    for name, dtype in full.schema.items():
+        if dtype.is_integer() or isinstance(dtype, pl.Decimal):
+            assert compact[name].cast(dtype).equals(full[name])
+        elif dtype.is_float():
+            assert np.allclose(compact[name].to_numpy(), full[name].to_numpy(), rtol=1e-6, equal_nan=True)
+        else:
+            assert compact[name].cast(pl.Utf8).equals(full[name])
+
+
+def test_compact_snapshots_concatenate(synthetic_db, end_date):
+    snapshots = SnapshotFeatures.from_stride(end_date, 28, 3, response_duration=28)
+    full = snapshots.get_all_features_and_response(synthetic_db)
+    compact = snapshots.get_all_features_and_response(synthetic_db, compact=True)
+    assert compact.height == full.height
+    assert compact["label"].cast(pl.Int32).equals(full["label"])
+    assert compact["t_count_channel_2_year_1"].cast(pl.Int64).equals(full["t_count_channel_2_year_1"].cast(pl.Int64))
+
+
+def test_surrogate_keys_round_trip():
+    df = pl.DataFrame({"customer_id": ["b", "a", "b", "c"], "x": [1, 2, 3, 4]})
+    frame, keys = surrogate_keys(df)
+    assert frame.columns == ["customer_key", "x"]
+    assert frame["customer_key"].dtype == pl.Int32
+    assert frame.join(keys, on="customer_key")["customer_id"].to_list() == df["customer_id"].to_list()
+
+
+def test_float32_matrix_matches_to_numpy():
+    df = pl.DataFrame({"a": [1, 2, 3], "b": [0.5, None, 2.5], "c": pl.Series([True, False, True])}).with_columns(
+        pl.col("a").cast(pl.Int16))
+    expected = df.cast(pl.Float64).to_numpy().astype(np.float32)
+
+    for order in ("F", "C"):
+        matrix = to_float32_matrix(df, order=order)
+        assert matrix.dtype == np.float32
+        assert matrix.flags[f"{order}_CONTIGUOUS"]
+        np.testing.assert_array_equal(matrix, expected)
+
+    out = np.zeros((3, 2), dtype=np.float32)
+    assert to_float32_matrix(df, ["b", "a"], out=out) is out
+    np.testing.assert_array_equal(out, expected[:, [1, 0]])
+
+
+def test_compact_frames_preprocess_like_full_ones(synthetic_db, end_date):
+    features = Features(QueryConstants(end_date, response_duration=28))
+    full = features.get_all_features_and_response(synthetic_db)
+    compact = features.get_all_features_and_response(synthetic_db, compact=True)
+    assert compact["customer_fashion_news_frequency"].dtype == pl.Categorical
+
+    for make in (DataPreprocessor, StreamingPreprocessor):
+        expected = make().fit(full)
+        actual = make().fit(compact)
+        assert actual.cat_cols == ["customer_fashion_news_frequency"]
+        assert actual.get_feature_names() == expected.get_feature_names()
+        assert np.allclose(actual.transform(compact), expected.transform(full), atol=1e-4)
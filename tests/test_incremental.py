@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from features import Features, QueryConstants
+from incremental import IncrementalFeatures
+
+
+def expected_features(synthetic_db, end_date, feature_duration=365):
+    return (Features(QueryConstants(end_date, feature_duration=feature_duration), use_daily_cube=True)
+            .get_all_features(synthetic_db).sort("customer_id"))
+
+
+def test_daily_refresh_matches_full_recompute(synthetic_db, end_date):
+    start = end_date - timedelta(days=6)
+    incremental = IncrementalFeatures(QueryConstants(start))
+    incremental.initialize(synthetic_db)
+    assert incremental.get_all_features().sort("customer_id").equals(expected_features(synthetic_db, start))
+
+    for days in (1, 2, 3):
+        incremental.refresh(synthetic_db)
+        actual = incremental.get_all_features().sort("customer_id")
+        expected = expected_features(synthetic_db, start + timedelta(days=days))
+        assert actual.schema == expected.schema
+        assert actual.equals(expected)
+
+    # several days at once
+    incremental.refresh(synthetic_db, end_date)
+    assert incremental.get_all_features().sort("customer_id").equals(expected_features(synthetic_db, end_date))
+
+
+def test_refresh_picks_up_new_customers_and_days(synthetic_db, end_date):
+    incremental = IncrementalFeatures(QueryConstants(end_date))
+    incremental.initialize(synthetic_db)
+
+    new_day = end_date + timedelta(days=1)
+    synthetic_db.execute("INSERT INTO customers (customer_id, age) VALUES ('new customer', 30)")
+    synthetic_db.execute(f'''
+        INSERT INTO transactions VALUES
+            (DATE '{new_day}', 'new customer', '0000100001', 0.05, 2),
+            (DATE '{new_day}', 'new customer', '0000100002', 0.01, 1),
+            (DATE '{new_day}', (SELECT MIN(customer_id) FROM customers), '0000100003', 0.02, 1)
+    ''')
+    incremental.refresh(synthetic_db)
+
+    actual = incremental.get_all_features().sort("customer_id")
+    assert "new customer" in actual["customer_id"].to_list()
+    assert actual.equals(expected_features(synthetic_db, new_day))
+
+
+def test_feature_window_shorter_than_the_overlap_windows(synthetic_db, end_date):
+    # the year and half windows are longer than the feature window, which cuts them
+    start = end_date - timedelta(days=21)
+    for feature_duration in (180, 60):
+        incremental = IncrementalFeatures(QueryConstants(start, feature_duration=feature_duration))
+        incremental.initialize(synthetic_db)
+        for days in (1, 2, 3):
+            incremental.refresh(synthetic_db)
+            expected = expected_features(synthetic_db, start + timedelta(days=days), feature_duration)
+            assert incremental.get_all_features().sort("customer_id").equals(expected)
+        incremental.refresh(synthetic_db, end_date)
+        assert incremental.get_all_features().sort("customer_id").equals(
+            expected_features(synthetic_db, end_date, feature_duration))
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from features import Features, QueryConstants
+from preprocessing import DataPreprocessor, QuantileSketch, StreamingPreprocessor
+
+
+def test_quantile_sketch():
+    rng = np.random.default_rng(3)
+    X = np.column_stack([rng.lognormal(0, 2, 200_000), rng.normal(0, 1, 200_000)])
+    sketch = QuantileSketch(2, k=256, tail=64)
+    for batch in np.array_split(X, 37):
+        sketch.update(batch)
+
+    assert sketch.count == len(X)
+    # exact in the tails
+    for q in (0.001, 0.01, 99.99, 100):
+        assert np.array_equal(sketch.percentile(q), np.percentile(X, q, axis=0))
+    # approximate rank in the body
+    for q in (10, 50, 90):
+        estimate = sketch.percentile(q)
+        ranks = (X <= estimate).mean(axis=0)
+        assert np.all(np.abs(ranks - q / 100) < 0.02)
+
+
+def test_streaming_matches_in_memory(synthetic_db, end_date, tmp_path):
+    features = Features(QueryConstants(end_date=end_date, response_duration=28))
+    df = features.get_all_features_and_response(synthetic_db)
+
+    in_memory = DataPreprocessor()
+    in_memory.fit(df)
+    streaming = StreamingPreprocessor()
+    streaming.fit_batches(lambda: synthetic_db.execute(
+        features.get_feature_plan().compile()).fetch_record_batch(64))
+
+    assert streaming.get_feature_names() == in_memory.get_feature_names()
+    assert np.allclose(streaming.transform(df), in_memory.transform(df))
+
+    path = str(tmp_path / "preprocessor.json")
+    streaming.save(path)
+    loaded = StreamingPreprocessor.load(path)
+    batches = [loaded.transform(batch) for batch in df.iter_slices(100)]
+    assert np.array_equal(np.vstack(batches), streaming.transform(df))
+
+
+def test_streaming_requires_fit():
+    with pytest.raises(ValueError):
+        StreamingPreprocessor().transform(None)
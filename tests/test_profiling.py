@@ -0,0 +1,49 @@
+import json
+
+from features import Features, QueryConstants
+import profiling
+from profiling import RunProfiler
+
+
+def test_run_log_records_stages_and_queries(synthetic_db, end_date, tmp_path):
+    log_path = str(tmp_path / "runs" / "run_log.jsonl")
+    features = Features(QueryConstants(end_date, response_duration=28))
+
+    with RunProfiler(log_path, profile_dir=str(tmp_path / "profiles"), log_sql=True) as profiler:
+        df = features.get_all_features_and_response(synthetic_db, single_pass=False)
+    assert profiling.active() is None
+
+    with open(log_path) as f:
+        logged = [json.loads(line) for line in f]
+    assert len(logged) == len(profiler.records)
+
+    stages = {record["name"]: record for record in logged if record["kind"] == "stage"}
+    assert {"features_and_response", "features", "feature_plan", "label", "join"} <= set(stages)
+    assert stages["features_and_response"]["rows"] == df.height
+    assert stages["join"]["parent"] == "features_and_response"
+    assert stages["feature_plan"]["parent"] == "features_and_response/features"
+    assert all(record["seconds"] >= 0 and record["peak_rss_mb"] > 0 for record in logged)
+
+    queries = [record for record in logged if record["kind"] == "query"]
+    assert [query["parent"] for query in queries] == ["features_and_response/features/feature_plan",
+                                                      "features_and_response/label"]
+    transactions = synthetic_db.execute("SELECT COUNT(1) FROM transactions").fetchone()[0]
+    for query in queries:
+        assert query["rows_scanned"] >= transactions
+        with open(query["profile"]) as f:
+            assert json.load(f)["query_name"].strip() == query["sql"].strip()
+
+    summary = profiler.summary()
+    assert summary.filter(summary["name"] == "query")["calls"].to_list() == [1, 1]
+
+    # the default co-computes the label: one query, no join
+    with RunProfiler() as profiler:
+        features.get_all_features_and_response(synthetic_db)
+    assert [(record["name"], record["parent"]) for record in profiler.records if record["name"] in ("query", "join")] \
+        == [("query", "features_and_response/feature_plan")]
+
+
+def test_stages_are_free_without_a_profiler(synthetic_db, end_date):
+    assert profiling.active() is None
+    assert profiling.stage("anything", lambda: 42) == 42
+    Features(QueryConstants(end_date)).get_base_features(synthetic_db)
@@ -0,0 +1,58 @@
+import numpy as np
+import polars as pl
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+
+from features import Features, QueryConstants
+from scoring import BatchScorer
+
+
+class NumericColumns:
+    # stand-in for the fitted preprocessor: numeric features only
+    def __init__(self, columns):
+        self.columns = columns
+
+    def transform(self, df):
+        return df.select(self.columns).to_numpy().astype(float)
+
+
+def test_batch_scoring_matches_whole_frame(synthetic_db, end_date, tmp_path):
+    features = Features(QueryConstants(end_date=end_date, response_duration=28))
+    df = features.get_all_features_and_response(synthetic_db)
+    columns = ["total_revenue", "total_items", "total_transactions", "days_since_last"]
+    preprocessor = NumericColumns(columns)
+    model = LogisticRegression(max_iter=1000).fit(preprocessor.transform(df), df["label"].to_numpy())
+
+    expected = model.predict_proba(preprocessor.transform(df))[:, 1]
+
+    for n_jobs in (1, 2):
+        output_path = str(tmp_path / f"scores_{n_jobs}.parquet")
+        BatchScorer(preprocessor, model, batch_size=64, n_jobs=n_jobs).score_query(
+            synthetic_db, features.get_feature_plan().compile(), output_path)
+        scores = pl.read_parquet(output_path)
+
+        assert scores.columns == ["customer_id", "score", "rank"]
+        assert scores["rank"].to_list() == list(range(1, df.height + 1))
+        assert scores["score"].is_sorted(descending=True)
+        actual = df.select("customer_id").join(scores, on="customer_id", how="left")["score"].to_numpy()
+        assert np.allclose(actual, expected)
+
+
+def test_scoring_without_a_preprocessor_uses_the_numeric_columns(synthetic_db, end_date, tmp_path):
+    features = Features(QueryConstants(end_date=end_date, response_duration=28))
+    df = features.get_all_features_and_response(synthetic_db)
+    # the plan has a text column, customer_fashion_news_frequency
+    assert pl.Utf8 in df.schema.values()
+    X = df.select(pl.selectors.numeric().exclude("label")).fill_null(0).to_numpy()
+    model = DecisionTreeClassifier(max_depth=4, random_state=0).fit(X, df["label"].to_numpy())
+
+    output_dir = tmp_path / "o'brien"
+    output_dir.mkdir()
+    output_path = str(output_dir / "scores.parquet")
+    feature_sql = "SELECT * REPLACE ({}) FROM ({})".format(
+        ", ".join(f"COALESCE({name}, 0) AS {name}" for name in df.select(pl.selectors.numeric().exclude("label")).columns),
+        features.get_feature_plan().compile())
+    BatchScorer(None, model, batch_size=64).score_query(synthetic_db, feature_sql, output_path)
+    scores = pl.read_parquet(output_path)
+    actual = df.select("customer_id").join(scores, on="customer_id", how="left")["score"].to_numpy()
+    assert np.allclose(actual, model.predict_proba(X)[:, 1])
@@ -0,0 +1,64 @@
+import numpy as np
+import polars as pl
+from sklearn.tree import DecisionTreeClassifier
+
+from search import FeatureMatrix, SuccessiveHalvingSearch
+
+
+def make_matrix(directory):
+    rng = np.random.default_rng(9)
+    n = 6000
+    df = pl.DataFrame({"customer_id": [str(i) for i in range(n)], "a": rng.normal(size=n), "b": rng.normal(size=n),
+                       "noise": rng.normal(size=n)})
+    label = (rng.random(n) < 1 / (1 + np.exp(2.5 - 1.5 * df["a"].to_numpy()))).astype(int)
+    return FeatureMatrix.from_frame(df.with_columns(pl.Series("label", label)), directory)
+
+
+def test_feature_matrix_is_memory_mapped(tmp_path):
+    matrix = make_matrix(str(tmp_path / "matrix"))
+    loaded = FeatureMatrix.load(str(tmp_path / "matrix"))
+
+    assert isinstance(loaded.X, np.memmap)
+    assert loaded.X.dtype == np.float32 and loaded.X.flags["C_CONTIGUOUS"]
+    assert loaded.feature_names == ["a", "b", "noise"]
+    assert np.array_equal(loaded.y, matrix.y)
+
+
+def test_feature_matrix_samples_are_views(tmp_path):
+    rng = np.random.default_rng(3)
+    df = pl.DataFrame({"customer_id": [str(i) for i in range(1000)], "a": rng.normal(size=1000),
+                       "label": (rng.random(1000) < 0.2).astype(int)})
+    matrix = FeatureMatrix.from_frame(df, str(tmp_path / "matrix"), validation_fraction=0.25)
+
+    # shuffled rows map back to the frame, the validation block is a stratified quarter
+    rows = np.load(str(tmp_path / "matrix" / "rows.npy"))
+    assert np.array_equal(matrix.X[:, 0], df["a"].to_numpy()[rows].astype(np.float32))
+    assert np.array_equal(matrix.y, df["label"].to_numpy()[rows])
+    assert sorted(rows) == list(range(1000))
+    X_validation, y_validation = matrix.validation()
+    assert len(y_validation) == 250 and y_validation.sum() == round(df["label"].sum() * 0.25)
+
+    X_train, y_train = matrix.training_rows(300)
+    assert X_train.shape == (300, 1) and matrix.n_training_rows == 750
+    for part in (X_train, y_train, X_validation):
+        assert isinstance(part, np.memmap) and np.shares_memory(part, matrix.X if part.ndim == 2 else matrix.y)
+
+
+def test_successive_halving(tmp_path):
+    matrix = make_matrix(str(tmp_path / "matrix"))
+    # leaves bigger than the sample make a constant score, which can't compete
+    candidates = [{"max_depth": 2, "min_samples_leaf": 10_000}, {"max_depth": 3, "min_samples_leaf": 20},
+                  {"max_depth": 1, "min_samples_leaf": 10_000}, {"max_depth": 4, "min_samples_leaf": 50},
+                  {"max_depth": 3, "min_samples_leaf": 10_000}]
+
+    results = {}
+    for n_jobs in (1, 2):
+        search = SuccessiveHalvingSearch(matrix, DecisionTreeClassifier(random_state=0), candidates, min_rows=500, eta=2,
+                                         n_jobs=n_jobs)
+        results[n_jobs] = search.run()
+        assert search.best_params in (candidates[1], candidates[3])
+
+    per_rung = results[1].group_by("rung").agg(pl.len(), pl.col("rows").first()).sort("rung")
+    assert per_rung["len"].to_list() == [5, 3, 2, 1]
+    assert per_rung["rows"].to_list() == [500, 1000, 2000, 4000]
+    assert results[1].drop("fit_seconds").equals(results[2].drop("fit_seconds"))
@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../benchmarks')))
+
+from features import Features, QueryConstants
+from synthetic import make_synthetic_db
+
+
+def test_synthetic_data_is_reproducible_and_h_and_m_shaped(end_date):
+    conn = make_synthetic_db(20_000, seed=1)
+    assert conn.execute("SELECT COUNT(1) FROM transactions").fetchone()[0] == 20_000
+    # every transaction points at a known article, customers without transactions exist
+    assert conn.execute("SELECT COUNT(1) FROM transactions WHERE article_id NOT IN (SELECT article_id FROM articles)"
+                        ).fetchone()[0] == 0
+    buyers, customers = conn.execute(
+        "SELECT (SELECT COUNT(DISTINCT customer_id) FROM transactions), (SELECT COUNT(1) FROM customers)").fetchone()
+    assert buyers < customers
+
+    # power law: the top 10% of buyers account for a large share of the items
+    top_share = conn.execute('''
+        SELECT SUM(n) FILTER (WHERE rank <= 0.1 * buyers) / SUM(n) FROM (
+            SELECT COUNT(1) AS n, ROW_NUMBER() OVER (ORDER BY COUNT(1) DESC) AS rank, COUNT(1) OVER () AS buyers
+            FROM transactions GROUP BY customer_id)''').fetchone()[0]
+    assert top_share > 0.3
+
+    same = make_synthetic_db(20_000, seed=1)
+    other = make_synthetic_db(20_000, seed=2)
+    content = "SELECT SUM(HASH(t)) FROM transactions t"
+    assert conn.execute(content).fetchone() == same.execute(content).fetchone()
+    assert conn.execute(content).fetchone() != other.execute(content).fetchone()
+
+    df = Features(QueryConstants(end_date, response_duration=28), season_features=True,
+                  product_features=True).get_all_features_and_response(conn)
+    assert df.height > 0 and df["label"].sum() > 0
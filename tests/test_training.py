@@ -0,0 +1,69 @@
+import numpy as np
+import polars as pl
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+
+from training import DownsampledModel, WarmStartTrainer, negative_downsample, prior_correction, top_decile_lift
+
+
+@pytest.fixture
+def imbalanced():
+    rng = np.random.default_rng(5)
+    n = 20_000
+    X = rng.normal(size=(n, 4))
+    y = (rng.random(n) < 1 / (1 + np.exp(4 - 1.5 * X[:, 0] - X[:, 1]))).astype(int)
+    snapshot = rng.integers(0, 4, n)
+    return X, y, snapshot
+
+
+def test_negative_downsample_is_stratified_and_reweighted(imbalanced):
+    X, y, snapshot = imbalanced
+    df = pl.DataFrame({"x": X[:, 0], "label": y, "snapshot_date": snapshot})
+    sample = negative_downsample(df, 0.1, strata=["snapshot_date"], seed=1)
+
+    assert sample.filter(pl.col("label") == 1).height == y.sum()
+    # weighted counts give back the population, per snapshot
+    weighted = sample.group_by("snapshot_date", "label").agg(pl.col("sample_weight").sum()).sort("snapshot_date", "label")
+    actual = df.group_by("snapshot_date", "label").len().sort("snapshot_date", "label")
+    assert np.allclose(weighted["sample_weight"].to_numpy(), actual["len"].to_numpy())
+    assert sample.columns == df.columns + ["sample_weight"]
+
+
+def test_prior_correction_recovers_population_probabilities(imbalanced):
+    X, y, _ = imbalanced
+    df = pl.DataFrame({"x0": X[:, 0], "x1": X[:, 1], "label": y})
+    sample = negative_downsample(df, 0.1, seed=2)
+    features = ["x0", "x1"]
+
+    full = LogisticRegression().fit(df.select(features).to_numpy(), y)
+    corrected = DownsampledModel(LogisticRegression(), 0.1, reweighted=False).fit(
+        sample.select(features).to_numpy(), sample["label"].to_numpy())
+    p_full = full.predict_proba(X[:, :2])[:, 1]
+    p_corrected = corrected.predict_proba(X[:, :2])[:, 1]
+    assert p_corrected.mean() == pytest.approx(p_full.mean(), rel=0.1)
+    assert prior_correction(np.array([0.5]), 0.1)[0] == pytest.approx(0.05 / 0.55)
+
+
+def test_warm_start_early_stopping(imbalanced):
+    X, y, snapshot = imbalanced
+    validation = snapshot == 3
+    chunks = []
+    for s in range(3):
+        df = pl.DataFrame({"i": np.flatnonzero(snapshot == s), "label": y[snapshot == s]})
+        sample = negative_downsample(df, 0.2, seed=s)
+        chunks.append((X[sample["i"].to_numpy()], sample["label"].to_numpy(), sample["sample_weight"].to_numpy()))
+
+    trainer = WarmStartTrainer(RandomForestClassifier(max_depth=4, random_state=0), step=5, max_estimators=60,
+                               patience=2)
+    trainer.fit(chunks, X[validation], y[validation])
+
+    sizes = [n for n, _ in trainer.history]
+    assert sizes == sorted(sizes) and sizes[-1] <= 60
+    assert len(trainer.model.estimators_) == trainer.best_n_estimators
+    best_lift = max(lift for _, lift in trainer.history)
+    assert top_decile_lift(y[validation], trainer.model.predict_proba(X[validation])[:, 1]) == pytest.approx(best_lift)
+
+    full = RandomForestClassifier(max_depth=4, random_state=0, n_estimators=60).fit(X[~validation], y[~validation])
+    full_lift = top_decile_lift(y[validation], full.predict_proba(X[validation])[:, 1])
+    assert best_lift > 0.9 * full_lift